@@ -63,6 +63,10 @@ default_config_parameters = {
     "webuiport": "3080",
     "restfulapiport": "5000",
     "restfulapi": "restfulapi",
+    # mod_wsgi daemon processes of Restful API and threads per process, each
+    # process keeps its own mysql connection pool
+    "restfulapi_processes": "4",
+    "restfulapi_threads": "25",
     "repairmanager": "repairmanager",
     "ssh_cert": "./deploy/sshkey/id_rsa",
     "admin_username": "core",
@@ -49,16 +49,20 @@ class HealthResource(Resource):
         request.setHeader("Content-Type", "text/html; charset=utf-8")
         return "<html>Ok</html>".encode("utf-8")
 
-def exporter_thread(port):
+def exporter_thread(port, resources=None):
     root = Resource()
     root.putChild(b"metrics", MetricsResource())
     root.putChild(b"healthz", HealthResource())
+    for path, resource in (resources or {}).items():
+        root.putChild(path, resource)
     factory = Site(root)
     reactor.listenTCP(port, factory)
     reactor.run(installSignalHandlers=False)
 
-def setup_exporter_thread(port):
-    t = threading.Thread(target=exporter_thread, args=(port,),
+def setup_exporter_thread(port, resources=None):
+    """ resources maps top level path to extra twisted Resource served
+    besides /metrics and /healthz """
+    t = threading.Thread(target=exporter_thread, args=(port, resources),
             name="exporter")
     t.start()
     return t
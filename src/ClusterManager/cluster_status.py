@@ -0,0 +1,344 @@
+import json
+import time
+import logging
+import threading
+
+import requests
+
+from ResourceInfo import ResourceInfo
+
+logger = logging.getLogger(__name__)
+
+GPU_STR = "nvidia.com/gpu"
+
+GPU_USAGE_QUERY = "avg(avg_over_time(task_gpu_percent[4h])) by (pod_name)"
+
+
+class PodGpuUsage(object):
+    """ Average gpu utilization of pods in last 4 hours. Usage of all pods
+    is fetched by one grouped query and kept for ttl seconds. """
+    def __init__(self, prometheus_url, ttl=30, timeout=10):
+        self.query_url = prometheus_url.rstrip("/") + "/api/v1/query"
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        # pod name -> percent
+        self.usage = {}
+        self.fetched_at = None
+
+    def refresh(self):
+        try:
+            resp = self.session.get(self.query_url,
+                    params={"query": GPU_USAGE_QUERY}, timeout=self.timeout)
+            resp.raise_for_status()
+            usage = {}
+            for result in resp.json()["data"]["result"]:
+                pod_name = result["metric"].get("pod_name")
+                if pod_name is not None:
+                    usage[pod_name] = int(float(result["value"][1]))
+        except Exception as e:
+            logger.warning("query gpu usage from %s failed", self.query_url, exc_info=True)
+            usage = {}
+        self.usage = usage
+        # also keep failures for ttl, not to query on every pod
+        self.fetched_at = time.time()
+
+    def get(self, pod_name):
+        """ Returns gpu usage percent of pod, None if unknown """
+        with self.lock:
+            if self.fetched_at is None or time.time() - self.fetched_at >= self.ttl:
+                self.refresh()
+            return self.usage.get(pod_name)
+
+
+def parse_node(node):
+    """ node_status of a node in `kubectl get nodes -o yaml` form, without
+    usage of pods on it """
+    node_status = {}
+    node_status["name"] = node["metadata"]["name"]
+    node_status["labels"] = node["metadata"].get("labels") or {}
+    node_status["gpuType"] = ""
+
+    node_status["scheduled_service"] = []
+    for l, s in node_status["labels"].iteritems():
+        if s == "active" and l != "all" and l != "default":
+            node_status["scheduled_service"].append(l)
+        if l == "gpuType":
+            node_status["scheduled_service"].append(s)
+            node_status["gpuType"] = s
+
+    if GPU_STR in node["status"].get("allocatable", {}):
+        node_status["gpu_allocatable"] = {node_status["gpuType"]: int(node["status"]["allocatable"][GPU_STR])}
+    else:
+        node_status["gpu_allocatable"] = {}
+    if GPU_STR in node["status"].get("capacity", {}):
+        node_status["gpu_capacity"] = {node_status["gpuType"]: int(node["status"]["capacity"][GPU_STR])}
+    else:
+        node_status["gpu_capacity"] = {}
+    node_status["InternalIP"] = "unknown"
+    annotations = node["metadata"].get("annotations") or {}
+    if "node.alpha/DeviceInformation" in annotations:
+        node_info = json.loads(annotations["node.alpha/DeviceInformation"])
+        if (int(node_info["capacity"]["alpha.gpu/numgpu"]) > sum(node_status["gpu_capacity"].values())):
+            node_status["gpu_capacity"] = {node_status["gpuType"]: int(node_info["capacity"]["alpha.gpu/numgpu"])}
+        if (int(node_info["allocatable"]["alpha.gpu/numgpu"]) > sum(node_status["gpu_allocatable"].values())):
+            node_status["gpu_allocatable"] = {node_status["gpuType"]: int(node_info["allocatable"]["alpha.gpu/numgpu"])}
+
+    for addr in node["status"].get("addresses") or []:
+        if addr["type"] == "InternalIP":
+            node_status["InternalIP"] = addr["address"]
+
+    node_status["unschedulable"] = bool(node.get("spec", {}).get("unschedulable"))
+    for condi in node["status"].get("conditions") or []:
+        if condi.get("type") == "Ready" and "status" in condi and condi["status"] != "True":
+            node_status["unschedulable"] = True
+    return node_status
+
+
+def parse_pod(pod):
+    """ gpu accounting of a pod in `kubectl get pods -o yaml` form, None if
+    the pod is finished or not scheduled yet """
+    phase = pod.get("status", {}).get("phase")
+    if phase == "Succeeded" or phase == "Failed":
+        return None
+    if "nodeName" not in pod.get("spec", {}):
+        return None
+
+    labels = pod["metadata"].get("labels") or {}
+    preemption_allowed = labels.get("preemptionAllowed") == "True"
+    gpus = 0
+    preemptable_gpus = 0
+    gpu_desc = ""
+
+    pod_info_cont = {}
+    annotations = pod["metadata"].get("annotations") or {}
+    if "pod.alpha/DeviceInformation" in annotations:
+        pod_info = json.loads(annotations["pod.alpha/DeviceInformation"])
+        pod_info_cont = pod_info.get("runningcontainer", {})
+    for container in pod["spec"].get("containers") or []:
+        containerGPUs = 0
+        requests = (container.get("resources") or {}).get("requests") or {}
+        if GPU_STR in requests:
+            containerGPUs = int(requests[GPU_STR])
+        if container["name"] in pod_info_cont:
+            if "requests" in pod_info_cont[container["name"]] and "alpha.gpu/numgpu" in pod_info_cont[container["name"]]["requests"]:
+                containerGPUs = max(int(pod_info_cont[container["name"]]["requests"]["alpha.gpu/numgpu"]), containerGPUs)
+        if preemption_allowed:
+            preemptable_gpus += containerGPUs
+        else:
+            gpus += containerGPUs
+        gpu_desc += " (gpu #:" + str(containerGPUs) + ")"
+
+    return {
+        "name": pod["metadata"]["name"],
+        "nodeName": pod["spec"]["nodeName"],
+        "userName": labels.get("userName"),
+        "gpus": gpus,
+        "preemptableGpus": preemptable_gpus,
+        "gpuDesc": gpu_desc,
+    }
+
+
+class ClusterStatusAggregator(object):
+    """ Keeps gpu usage of nodes and users up to date as node and pod events
+    arrive, so cluster status need not be recomputed from full lists.
+
+    Usage is only accounted for pods on known nodes, and is moved over when
+    gpuType of a node changes. pending_since is the time of the earliest
+    change not taken by take_pending_since yet.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> parse_node result
+        self.nodes = {}
+        # name -> parse_pod result
+        self.pods = {}
+        # node name -> set of pod name, including nodes not known yet
+        self.node_pods = {}
+        # node name -> [gpus, preemptable gpus]
+        self.node_used = {}
+        # user name -> gpu type -> [gpus, preemptable gpus, pod count]
+        self.user_used = {}
+        self.pending_since = None
+        self.changed = threading.Event()
+
+    def _mark_changed(self):
+        if self.pending_since is None:
+            self.pending_since = time.time()
+        self.changed.set()
+
+    def _account(self, pod, sign):
+        node = self.nodes.get(pod["nodeName"])
+        if node is None:
+            return
+        used = self.node_used[pod["nodeName"]]
+        used[0] += sign * pod["gpus"]
+        used[1] += sign * pod["preemptableGpus"]
+
+        user_name = pod["userName"]
+        if user_name is None:
+            return
+        user = self.user_used.setdefault(user_name, {})
+        used = user.setdefault(node["gpuType"], [0, 0, 0])
+        used[0] += sign * pod["gpus"]
+        used[1] += sign * pod["preemptableGpus"]
+        used[2] += sign
+        if used[2] == 0:
+            del user[node["gpuType"]]
+            if len(user) == 0:
+                del self.user_used[user_name]
+
+    def _set_node(self, node_status):
+        name = node_status["name"]
+        old = self.nodes.get(name)
+        if old == node_status:
+            return False
+        pods = [self.pods[pod_name] for pod_name in self.node_pods.get(name, ())]
+        for pod in pods:
+            self._account(pod, -1)
+        self.nodes[name] = node_status
+        self.node_used[name] = [0, 0]
+        for pod in pods:
+            self._account(pod, 1)
+        return True
+
+    def _delete_node(self, name):
+        if name not in self.nodes:
+            return False
+        for pod_name in self.node_pods.get(name, ()):
+            self._account(self.pods[pod_name], -1)
+        del self.nodes[name]
+        del self.node_used[name]
+        return True
+
+    def _set_pod(self, name, pod):
+        old = self.pods.get(name)
+        if old == pod:
+            return False
+        if old is not None:
+            self._account(old, -1)
+            del self.pods[name]
+            self.node_pods[old["nodeName"]].discard(name)
+            if len(self.node_pods[old["nodeName"]]) == 0:
+                del self.node_pods[old["nodeName"]]
+        if pod is not None:
+            self.pods[name] = pod
+            self.node_pods.setdefault(pod["nodeName"], set()).add(name)
+            self._account(pod, 1)
+        return True
+
+    def on_node_event(self, event_type, node):
+        """ node is a node dict, or a list of node dicts for RELIST """
+        with self.lock:
+            if event_type == "RELIST":
+                names = set([n["metadata"]["name"] for n in node])
+                changed = False
+                for name in self.nodes.keys():
+                    if name not in names:
+                        changed = self._delete_node(name) or changed
+                for n in node:
+                    changed = self._set_node(parse_node(n)) or changed
+            elif event_type == "DELETED":
+                changed = self._delete_node(node["metadata"]["name"])
+            else:
+                changed = self._set_node(parse_node(node))
+            if changed:
+                self._mark_changed()
+
+    def on_pod_event(self, event_type, pod):
+        """ pod is a pod dict, or a list of pod dicts for RELIST """
+        with self.lock:
+            if event_type == "RELIST":
+                names = set([p["metadata"]["name"] for p in pod])
+                changed = False
+                for name in self.pods.keys():
+                    if name not in names:
+                        changed = self._set_pod(name, None) or changed
+                for p in pod:
+                    changed = self._set_pod(p["metadata"]["name"], parse_pod(p)) or changed
+            elif event_type == "DELETED":
+                changed = self._set_pod(pod["metadata"]["name"], None)
+            else:
+                changed = self._set_pod(pod["metadata"]["name"], parse_pod(pod))
+            if changed:
+                self._mark_changed()
+
+    def take_pending_since(self):
+        with self.lock:
+            pending_since = self.pending_since
+            self.pending_since = None
+            self.changed.clear()
+        return pending_since
+
+    def pod_description(self, pod, gpu_usage_func):
+        desc = pod["name"]
+        if pod["userName"] is not None:
+            desc += " : " + pod["userName"]
+        gpuUsage = gpu_usage_func(pod["name"]) if gpu_usage_func is not None else None
+        if gpuUsage is not None:
+            desc += " (gpu usage:" + str(gpuUsage) + "%)"
+            if gpuUsage <= 25:
+                desc += "!!!!!!"
+        return desc + pod["gpuDesc"]
+
+    def get_status(self, gpu_usage_func=None):
+        """ Cluster status in the format of clusterstatus table, except
+        AvaliableJobNum. gpu_usage_func(pod_name) returns gpu utilization
+        percent of a pod shown in node_status, or None. """
+        with self.lock:
+            nodes = [(name, node, list(self.node_used[name]),
+                [self.pods[pod_name] for pod_name in sorted(self.node_pods.get(name, ()))])
+                for name, node in self.nodes.iteritems()]
+            user_used = [(user_name, dict((gpu_type, list(used)) for gpu_type, used in user.iteritems()))
+                for user_name, user in self.user_used.iteritems()]
+
+        cluster_status = {}
+        nodes_status = {}
+        for name, node, used, pods in nodes:
+            node_status = dict(node)
+            gpu_type = node["gpuType"]
+            # NOTE gpu_used may include those unallocatable gpus
+            if len(pods) > 0:
+                node_status["gpu_used"] = {gpu_type: used[0]}
+                node_status["gpu_preemptable_used"] = {gpu_type: used[1]}
+            else:
+                node_status["gpu_used"] = {}
+                node_status["gpu_preemptable_used"] = {}
+            node_status["pods"] = [self.pod_description(pod, gpu_usage_func) for pod in pods]
+            nodes_status[name] = node_status
+
+        gpu_avaliable = ResourceInfo()
+        gpu_reserved = ResourceInfo()
+        gpu_capacity = ResourceInfo()
+        gpu_unschedulable = ResourceInfo()
+        gpu_used = ResourceInfo()
+
+        for node_name, node_status in nodes_status.iteritems():
+            if node_status["unschedulable"]:
+                gpu_unschedulable.Add(ResourceInfo(node_status["gpu_capacity"]))
+                gpu_reserved.Add(ResourceInfo.Difference(ResourceInfo(node_status["gpu_capacity"]), ResourceInfo(node_status["gpu_used"])))
+            else:
+                # gpu_used may larger than allocatable: used one GPU that has uncorrectable errors
+                gpu_avaliable.Add(ResourceInfo.DifferenceMinZero(ResourceInfo(node_status["gpu_allocatable"]), ResourceInfo(node_status["gpu_used"])))
+                gpu_unschedulable.Add(ResourceInfo.Difference(ResourceInfo(node_status["gpu_capacity"]), ResourceInfo(node_status["gpu_allocatable"])))
+                gpu_reserved.Add(ResourceInfo.Difference(ResourceInfo(node_status["gpu_capacity"]), ResourceInfo(node_status["gpu_allocatable"])))
+
+            gpu_used.Add(ResourceInfo(node_status["gpu_used"]))
+            gpu_capacity.Add(ResourceInfo(node_status["gpu_capacity"]))
+
+        cluster_status["user_status"] = []
+        cluster_status["user_status_preemptable"] = []
+        for user_name, user in user_used:
+            cluster_status["user_status"].append({"userName": user_name,
+                "userGPU": dict((gpu_type, used[0]) for gpu_type, used in user.iteritems())})
+            cluster_status["user_status_preemptable"].append({"userName": user_name,
+                "userGPU": dict((gpu_type, used[1]) for gpu_type, used in user.iteritems())})
+
+        cluster_status["gpu_avaliable"] = gpu_avaliable.ToSerializable()
+        cluster_status["gpu_capacity"] = gpu_capacity.ToSerializable()
+        cluster_status["gpu_unschedulable"] = gpu_unschedulable.ToSerializable()
+        cluster_status["gpu_used"] = gpu_used.ToSerializable()
+        cluster_status["gpu_reserved"] = gpu_reserved.ToSerializable()
+        cluster_status["node_status"] = [nodes_status[name] for name in sorted(nodes_status)]
+        return cluster_status
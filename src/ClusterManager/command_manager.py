@@ -24,6 +24,7 @@ from node_manager import get_cluster_status
 import base64
 
 import re
+import shlex
 
 import thread
 import threading
@@ -31,17 +32,177 @@ import random
 
 import logging
 
+import Queue
+import redis
+from prometheus_client import Histogram, Gauge
+
 from cluster_manager import setup_exporter_thread, manager_iteration_histogram, register_stack_trace_dump, update_file_modification_time, record
+from command_channel import COMMAND_CHANNEL
 
 logger = logging.getLogger(__name__)
 
+# output and stderr columns are TEXT, only the tail of a long output is kept
+MAX_OUTPUT_BYTES = 60000
+
+command_run_histogram = Histogram("command_run_latency_seconds",
+        "latency for running a command in job pod (seconds)",
+        buckets=(1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0, 128.0, 256.0, 512.0, 1024.0,
+            float("inf")),
+        labelnames=("result",))
+
+command_in_flight_gauge = Gauge("command_in_flight",
+        "number of commands being run or waiting for a worker")
+
+
+def truncate_output(output):
+    if output is None:
+        return None
+    if isinstance(output, unicode):
+        output = output.encode("utf-8")
+    if len(output) > MAX_OUTPUT_BYTES:
+        output = output[-MAX_OUTPUT_BYTES:]
+    return output.decode("utf-8", "ignore")
+
+
+@record
+def RunCommand(command, timeout):
+    """ Runs command in pod of the job, returns (status, output, stderr,
+    exit code) of the command """
+    output, stderr, exit_code = None, None, None
+    try:
+        args = shlex.split(command["command"])
+        if args[:1] == ["--"]:
+            args = args[1:]
+        exit_code, output, stderr = k8sUtils.exec_pod_command(command["jobId"], args, timeout)
+        if exit_code is None:
+            status = "timeout"
+            stderr = (stderr or "") + "\ncommand timed out after %s seconds" % timeout
+        elif exit_code == 0:
+            status = "run"
+        else:
+            status = "failed"
+    except Exception as e:
+        logger.warning("exec command %s failed", command["id"], exc_info=True)
+        status = "failed"
+        stderr = str(e)
+    return status, truncate_output(output), truncate_output(stderr), exit_code
+
+
 @record
-def RunCommand(command):
+def SaveCommandResult(command, result):
+    """ Saves result of RunCommand, returns True if saved """
+    status, output, stderr, exit_code = result
     dataHandler = DataHandler()
-    k8sUtils.kubectl_exec("exec %s %s" % (command["jobId"], command["command"]))
-    dataHandler.FinishCommand(command["id"])
-    dataHandler.Close()
-    return True
+    try:
+        return dataHandler.FinishCommand(command["id"], status, output, stderr, exit_code)
+    finally:
+        dataHandler.Close()
+
+
+class CommandRunner(object):
+    """ Runs commands by pool_size worker threads, so a hung exec doesn't
+    block commands of other jobs. Commands of a job run one at a time in the
+    order they were added, and each gives up after timeout seconds. """
+    def __init__(self, pool_size=8, timeout=600, wakeup=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        # set when a command finishes, next command of the job can be run
+        self.wakeup = wakeup
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        # jobId -> id of command being run
+        self.in_flight = {}
+        # commands finished but may still be pending in a list read before
+        self.finished = set()
+        # command id -> result of commands run but failed to be saved, only
+        # saving is retried, a command is never run twice
+        self.unsaved = {}
+        self.threads = []
+
+    def start(self):
+        for i in range(self.pool_size):
+            t = threading.Thread(target=self.run, name="command-runner-" + str(i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit_pending(self, pending_commands):
+        """ pending_commands are ordered by time, returns number of commands
+        submitted """
+        submitted = 0
+        with self.lock:
+            pending_ids = set([command["id"] for command in pending_commands])
+            self.finished &= pending_ids
+            for command_id in self.unsaved.keys():
+                if command_id not in pending_ids:
+                    del self.unsaved[command_id]
+            for command in pending_commands:
+                if command["id"] in self.finished or command["jobId"] in self.in_flight:
+                    continue
+                self.in_flight[command["jobId"]] = command["id"]
+                self.queue.put(command)
+                submitted += 1
+            command_in_flight_gauge.set(len(self.in_flight))
+        return submitted
+
+    def run(self):
+        while True:
+            command = self.queue.get()
+            finished = False
+            try:
+                finished = self.run_command(command)
+            finally:
+                with self.lock:
+                    # still pending in db if its result is not saved, saved
+                    # again by next poll
+                    if finished:
+                        self.finished.add(command["id"])
+                    self.in_flight.pop(command["jobId"], None)
+                    command_in_flight_gauge.set(len(self.in_flight))
+                if self.wakeup is not None:
+                    self.wakeup.set()
+                self.queue.task_done()
+
+    def run_command(self, command):
+        """ Returns True if the result of command is saved """
+        with self.lock:
+            result = self.unsaved.get(command["id"])
+        if result is None:
+            logger.info("Processing command: %s", command["id"])
+            start = time.time()
+            result = RunCommand(command, self.timeout)
+            command_run_histogram.labels(result[0]).observe(time.time() - start)
+        else:
+            logger.info("Saving result of command %s again", command["id"])
+
+        saved = False
+        try:
+            saved = SaveCommandResult(command, result)
+        except Exception as e:
+            logger.exception("save result of command %s failed", command["id"])
+        with self.lock:
+            if saved:
+                self.unsaved.pop(command["id"], None)
+            else:
+                self.unsaved[command["id"]] = result
+        return saved
+
+
+def listen_commands(redis_port, wakeup):
+    """ Sets wakeup whenever the REST API publishes a new command """
+    while True:
+        try:
+            redis_conn = redis.StrictRedis(host="localhost", port=redis_port, db=0)
+            pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(COMMAND_CHANNEL)
+            # commands added while not subscribed
+            wakeup.set()
+            for message in pubsub.listen():
+                wakeup.set()
+        except Exception as e:
+            logger.warning("listening on redis failed, retry in 10s", exc_info=True)
+        time.sleep(10)
+
 
 def create_log(logdir = '/var/log/dlworkspace'):
     if not os.path.exists(logdir):
@@ -52,31 +213,43 @@ def create_log(logdir = '/var/log/dlworkspace'):
         logging_config["handlers"]["file"]["filename"] = logdir+"/command_manager.log"
         logging.config.dictConfig(logging_config)
 
-def Run():
+def Run(redis_port, workers, timeout, poll_interval):
     register_stack_trace_dump()
     create_log()
 
+    wakeup = threading.Event()
+    runner = CommandRunner(workers, timeout, wakeup)
+    runner.start()
+
+    t = threading.Thread(target=listen_commands, name="command-listener", args=(redis_port, wakeup))
+    t.daemon = True
+    t.start()
+
     while True:
         update_file_modification_time("command_manager")
+        wakeup.clear()
 
         with manager_iteration_histogram.labels("command_manager").time():
             try:
                 dataHandler = DataHandler()
-                pendingCommands = dataHandler.GetPendingCommands()
-                for command in pendingCommands:
-                    try:
-                        logger.info("Processing command: %s", command["id"])
-                        RunCommand(command)
-                    except Exception as e:
-                        logger.exception("run command failed")
+                try:
+                    pendingCommands = dataHandler.GetPendingCommands()
+                finally:
+                    dataHandler.Close()
+                runner.submit_pending(pendingCommands)
             except Exception as e:
                 logger.exception("getting command failed")
-        time.sleep(1)
+        # polls in case a notification is lost
+        wakeup.wait(poll_interval)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", "-p", help="port of exporter", type=int, default=9204)
+    parser.add_argument("--redis_port", "-r", help="port of redis", type=int, default=9300)
+    parser.add_argument("--workers", help="number of commands to run concurrently", type=int, default=8)
+    parser.add_argument("--timeout", help="seconds to give up a command", type=int, default=600)
+    parser.add_argument("--poll_interval", help="seconds between polls of pending commands", type=int, default=10)
     args = parser.parse_args()
     setup_exporter_thread(args.port)
 
-    Run()
+    Run(args.redis_port, args.workers, args.timeout, args.poll_interval)
@@ -12,32 +12,54 @@ import re
 import logging
 import yaml
 import logging.config
+import threading
+import Queue
 
 import argparse
 from cluster_manager import setup_exporter_thread, manager_iteration_histogram, register_stack_trace_dump, update_file_modification_time
+from prometheus_client import Histogram, Gauge
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../utils"))
 import k8sUtils
 from config import config, GetStoragePath, GetWorkPath
 from DataHandler import DataHandler
 
-from job_launcher import JobDeployer
+from job_launcher import JobDeployer, start_k8s_cache
+from kubernetes import client
 
 logger = logging.getLogger(__name__)
 deployer = JobDeployer()
+k8s_api_client = client.ApiClient()
 
+endpoint_setup_histogram = Histogram("endpoint_setup_latency_seconds",
+        "latency for setting up an endpoint (seconds)",
+        buckets=(1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0, 128.0, 256.0, 512.0, 1024.0,
+            float("inf")),
+        labelnames=("endpoint_type", "result"))
 
-def is_ssh_server_ready(pod_name):
+endpoint_setup_in_flight_gauge = Gauge("endpoint_setup_in_flight",
+        "number of endpoints being set up or waiting for a worker")
+
+
+def time_left(deadline):
+    """ seconds left before deadline, raise if already passed """
+    left = deadline - time.time()
+    if left <= 0:
+        raise RuntimeError("deadline of endpoint setup exceeded")
+    return left
+
+
+def is_ssh_server_ready(pod_name, deadline):
     bash_script = "sudo service ssh status"
-    output = k8sUtils.kubectl_exec("exec %s %s" % (pod_name, " -- " + bash_script))
+    output = k8sUtils.pod_exec(pod_name, bash_script, time_left(deadline))
     if output == "":
         return False
     return True
 
 
-def query_ssh_port(pod_name):
+def query_ssh_port(pod_name, deadline):
     bash_script = "grep ^Port /etc/ssh/sshd_config | cut -d' ' -f2"
-    status_code, output = deployer.pod_exec(pod_name, ["/bin/bash", "-c", bash_script])
+    status_code, output = deployer.pod_exec(pod_name, ["/bin/bash", "-c", bash_script], timeout=min(60, time_left(deadline)))
     if status_code != 0:
         raise RuntimeError("Query ssh port failed: {}".format(pod_name))
     if not output:
@@ -45,7 +67,7 @@ def query_ssh_port(pod_name):
     return int(output)
 
 
-def start_ssh_server(pod_name, user_name, host_network=False, ssh_port=22):
+def start_ssh_server(pod_name, user_name, deadline, host_network=False, ssh_port=22):
     '''Setup the ssh server in container, and return the listening port.'''
     bash_script = "sudo bash -c 'apt-get update && apt-get install -y openssh-server && cd /home/" + user_name + " && (chown " + user_name + " -R .ssh; chmod 600 -R .ssh/*; chmod 700 .ssh; true) && service ssh restart'"
 
@@ -60,17 +82,18 @@ def start_ssh_server(pod_name, user_name, host_network=False, ssh_port=22):
         # TODO refine the script later
         bash_script = "sudo bash -c 'apt-get update && apt-get install -y openssh-server && sed -i \"s/^Port/#&/\" /etc/ssh/sshd_config && echo \"Port " + str(ssh_port) + "\" >> /etc/ssh/sshd_config && cd /home/" + user_name + " && (chown " + user_name + " -R .ssh; chmod 600 -R .ssh/*; chmod 700 .ssh; true) && service ssh restart'"
 
-    # TODO setup reasonable timeout
-    # output = k8sUtils.kubectl_exec("exec %s %s" % (jobId, " -- " + bash_script), 1)
-    output = k8sUtils.kubectl_exec("exec %s %s" % (pod_name, " -- " + bash_script))
+    output = k8sUtils.pod_exec(pod_name, bash_script, time_left(deadline))
     if output == "":
         raise Exception("Failed to setup ssh server in container. JobId: %s " % pod_name)
     return ssh_port
 
 
-def get_k8s_endpoint(endpoint_description_path):
-    endpoint_description_path = os.path.join(config["storage-mount-path"], endpoint_description_path)
-    return k8sUtils.kubectl_exec("get -o json -f %s" % endpoint_description_path)
+def get_k8s_endpoint(endpoint_id, cached=True):
+    '''Return the NodePort service of endpoint as dict, None if not existing'''
+    service = deployer.get_service(endpoint_id, cached)
+    if service is None:
+        return None
+    return k8s_api_client.sanitize_for_serialization(service)
 
 
 def generate_node_port_service(job_id, pod_name, endpoint_id, name, target_port):
@@ -96,52 +119,52 @@ spec:
     return endpoint_description
 
 
-def create_node_port(endpoint):
+def create_node_port(endpoint, deadline):
     endpoint_description = generate_node_port_service(endpoint["jobId"], endpoint["podName"], endpoint["id"], endpoint["name"], endpoint["podPort"])
     endpoint_description_path = os.path.join(config["storage-mount-path"], endpoint["endpointDescriptionPath"])
     logger.info("endpointDescriptionPath: %s", endpoint_description_path)
     with open(endpoint_description_path, 'w') as f:
         f.write(endpoint_description)
 
-    result = k8sUtils.kubectl_create(endpoint_description_path)
+    result = k8sUtils.kubectl_create(endpoint_description_path, timeout=time_left(deadline))
     if result == "":
         raise Exception("Failed to create NodePort for ssh. JobId: %s " % endpoint["jobId"])
 
     logger.info("Submitted endpoint %s to k8s, returned with status %s", endpoint["jobId"], result)
 
 
-def setup_ssh_server(user_name, pod_name, host_network=False):
+def setup_ssh_server(user_name, pod_name, deadline, host_network=False):
     '''Setup ssh server on pod and return the port'''
     # setup ssh server only is the ssh server is not up
-    if not is_ssh_server_ready(pod_name):
+    if not is_ssh_server_ready(pod_name, deadline):
         logger.info("Ssh server is not ready for pod: %s. Setup ...", pod_name)
-        ssh_port = start_ssh_server(pod_name, user_name, host_network)
+        ssh_port = start_ssh_server(pod_name, user_name, deadline, host_network)
     else:
-        ssh_port = query_ssh_port(pod_name)
+        ssh_port = query_ssh_port(pod_name, deadline)
     logger.info("Ssh server is ready for pod: %s. Ssh listen on %s", pod_name, ssh_port)
     return ssh_port
 
 
-def setup_jupyter_server(user_name, pod_name):
+def setup_jupyter_server(user_name, pod_name, deadline):
 
     jupyter_port = random.randint(40000, 49999)
     bash_script = "sudo bash -c 'export DEBIAN_FRONTEND=noninteractive; apt-get update && apt-get install -y python3-pip && python3 -m pip install --upgrade pip && python3 -m pip install jupyter && cd /home/" + user_name + " && runuser -l " + user_name + " -c \"jupyter notebook --no-browser --ip=0.0.0.0 --NotebookApp.token= --port=" + str(jupyter_port) + " &>/dev/null &\"'"
-    output = k8sUtils.kubectl_exec("exec %s %s" % (pod_name, " -- " + bash_script))
+    output = k8sUtils.pod_exec(pod_name, bash_script, time_left(deadline))
     if output == "":
         raise Exception("Failed to start jupyter server in container. JobId: %s " % pod_name)
     return jupyter_port
 
 
-def setup_tensorboard(user_name, pod_name):
+def setup_tensorboard(user_name, pod_name, deadline):
     tensorboard_port = random.randint(40000, 49999)
     bash_script = "sudo bash -c 'export DEBIAN_FRONTEND=noninteractive; pip install tensorboard; runuser -l " + user_name + " -c \"mkdir -p ~/tensorboard/\${DLWS_JOB_ID}/logs; nohup tensorboard --logdir=~/tensorboard/\${DLWS_JOB_ID}/logs --port=" + str(tensorboard_port) + " &>/dev/null &\"'"
-    output = k8sUtils.kubectl_exec("exec %s %s" % (pod_name, " -- " + bash_script))
+    output = k8sUtils.pod_exec(pod_name, bash_script, time_left(deadline))
     if output == "":
         raise Exception("Failed to start tensorboard in container. JobId: %s " % pod_name)
     return tensorboard_port
 
 
-def start_endpoint(endpoint):
+def start_endpoint(endpoint, deadline):
     # pending, running, stopped
     logger.info("Starting endpoint: %s", endpoint)
 
@@ -152,57 +175,141 @@ def start_endpoint(endpoint):
 
     port_name = endpoint["name"]
     if port_name == "ssh":
-        endpoint["podPort"] = setup_ssh_server(user_name, pod_name, host_network)
+        endpoint["podPort"] = setup_ssh_server(user_name, pod_name, deadline, host_network)
     elif port_name == "ipython":
-        endpoint["podPort"] = setup_jupyter_server(user_name, pod_name)
+        endpoint["podPort"] = setup_jupyter_server(user_name, pod_name, deadline)
     elif port_name == "tensorboard":
-        endpoint["podPort"] = setup_tensorboard(user_name, pod_name)
+        endpoint["podPort"] = setup_tensorboard(user_name, pod_name, deadline)
     else:
         endpoint["podPort"] = int(endpoint["podPort"])
 
     # create NodePort
-    create_node_port(endpoint)
+    create_node_port(endpoint, deadline)
+    # running from now on, not to be started again while the service is
+    # not in the watch cache yet
+    endpoint_description = get_k8s_endpoint(endpoint["id"], cached=False)
+    if endpoint_description is not None:
+        mark_endpoint_running(endpoint, endpoint_description)
+
+
+def mark_endpoint_running(endpoint, endpoint_description):
+    endpoint["endpointDescription"] = endpoint_description
+    endpoint["status"] = "running"
+    pods = deployer.get_pods(label_selector="podName=" + endpoint["podName"])
+    if len(pods) > 0:
+        endpoint["nodeName"] = pods[0].spec.node_name
 
 
-def start_endpoints():
+def setup_endpoint(endpoint, deadline):
+    endpoint_id = endpoint["id"]
+    data_handler = DataHandler()
     try:
-        data_handler = DataHandler()
+        job_description_path = data_handler.GetJobTextField(endpoint["jobId"], "jobDescriptionPath")
+
+        # get endpointDescriptionPath
+        # job["jobDescriptionPath"] = "jobfiles/" + time.strftime("%y%m%d") + "/" + jobParams["jobId"] + "/" + jobParams["jobId"] + ".yaml"
+        endpoint_description_dir = re.search("(.*/)[^/\.]+.yaml", job_description_path).group(1)
+        endpoint["endpointDescriptionPath"] = os.path.join(endpoint_description_dir, endpoint_id + ".yaml")
+
+        logger.info("\n\n\n\n\n\n----------------Begin to start endpoint %s", endpoint["id"])
+        endpoint_description = get_k8s_endpoint(endpoint_id)
+        if endpoint_description is None:
+            # the watch cache may not have a service created a moment ago
+            endpoint_description = get_k8s_endpoint(endpoint_id, cached=False)
+        if endpoint_description is not None:
+            mark_endpoint_running(endpoint, endpoint_description)
+        else:
+            start_endpoint(endpoint, deadline)
+
+        endpoint["lastUpdated"] = datetime.datetime.now().isoformat()
+        data_handler.UpdateEndpoint(endpoint)
+    finally:
+        data_handler.Close()
+
+
+class EndpointSetupPool(object):
+    """ Sets up endpoints by pool_size worker threads, so a slow pod doesn't
+    block endpoints of others. An endpoint is never queued twice while it is
+    still being set up, or set up but still pending in a list read before,
+    and each setup gives up after timeout seconds. """
+    def __init__(self, pool_size=8, timeout=600):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        # endpoints set up but may still be pending in a list read before
+        self.finished = set()
+        self.threads = []
+
+    def start(self):
+        for i in range(self.pool_size):
+            t = threading.Thread(target=self.run, name="endpoint-setup-" + str(i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit_pending(self, pending_endpoints):
+        """ pending_endpoints is endpoint id -> endpoint, returns number of
+        endpoints submitted """
+        submitted = 0
+        with self.lock:
+            self.finished &= set(pending_endpoints.keys())
+            for endpoint_id, endpoint in pending_endpoints.items():
+                if endpoint_id in self.finished or endpoint_id in self.in_flight:
+                    logger.debug("Endpoint %s is being set up, skip", endpoint_id)
+                    continue
+                self.in_flight.add(endpoint_id)
+                self.queue.put(endpoint)
+                submitted += 1
+            endpoint_setup_in_flight_gauge.set(len(self.in_flight))
+        return submitted
+
+    def run(self):
+        while True:
+            endpoint = self.queue.get()
+            succeeded = False
+            try:
+                succeeded = self.setup(endpoint)
+            finally:
+                with self.lock:
+                    # failed ones are set up again by next pass
+                    if succeeded:
+                        self.finished.add(endpoint["id"])
+                    self.in_flight.discard(endpoint["id"])
+                    endpoint_setup_in_flight_gauge.set(len(self.in_flight))
+                self.queue.task_done()
+
+    def setup(self, endpoint):
+        """ Returns True if the endpoint is set up """
+        name = endpoint["name"]
+        endpoint_type = name if name in ["ssh", "ipython", "tensorboard"] else "port"
+        start = time.time()
+        # deadline counts from start of setup, not from when it was queued
+        deadline = start + self.timeout
+        result = "success"
         try:
-            pending_endpoints = data_handler.GetPendingEndpoints()
+            setup_endpoint(endpoint, deadline)
+        except Exception as e:
+            result = "failure"
+            logger.warning("Process endpoint failed {}".format(endpoint), exc_info=True)
+        finally:
+            endpoint_setup_histogram.labels(endpoint_type, result).observe(time.time() - start)
+        return result == "success"
 
-            for endpoint_id, endpoint in pending_endpoints.items():
-                try:
-                    job = data_handler.GetJob(jobId=endpoint["jobId"])[0]
-                    if job["jobStatus"] != "running":
-                        continue
-
-                    # get endpointDescriptionPath
-                    # job["jobDescriptionPath"] = "jobfiles/" + time.strftime("%y%m%d") + "/" + jobParams["jobId"] + "/" + jobParams["jobId"] + ".yaml"
-                    endpoint_description_dir = re.search("(.*/)[^/\.]+.yaml", job["jobDescriptionPath"]).group(1)
-                    endpoint["endpointDescriptionPath"] = os.path.join(endpoint_description_dir, endpoint_id + ".yaml")
-
-                    logger.info("\n\n\n\n\n\n----------------Begin to start endpoint %s", endpoint["id"])
-                    output = get_k8s_endpoint(endpoint["endpointDescriptionPath"])
-                    if(output != ""):
-                        endpoint_description = json.loads(output)
-                        endpoint["endpointDescription"] = endpoint_description
-                        endpoint["status"] = "running"
-                        pod = k8sUtils.GetPod("podName=" + endpoint["podName"])
-                        if "items" in pod and len(pod["items"]) > 0:
-                            endpoint["nodeName"] = pod["items"][0]["spec"]["nodeName"]
-                    else:
-                        start_endpoint(endpoint)
 
-                    endpoint["lastUpdated"] = datetime.datetime.now().isoformat()
-                    data_handler.UpdateEndpoint(endpoint)
-                except Exception as e:
-                    logger.warning("Process endpoint failed {}".format(endpoint), exc_info=True)
-        except Exception as e:
-            logger.exception("start endpoint failed")
+def start_endpoints(setup_pool):
+    try:
+        data_handler = DataHandler()
+        try:
+            # only endpoints of running jobs
+            pending_endpoints = data_handler.GetPendingEndpoints()
         finally:
             data_handler.Close()
+
+        setup_pool.submit_pending(pending_endpoints)
     except Exception as e:
-        logger.exception("close data handler failed")
+        logger.exception("start endpoint failed")
 
 
 def cleanup_endpoints():
@@ -214,9 +321,8 @@ def cleanup_endpoints():
                 try:
                     logger.info("\n\n\n\n\n\n----------------Begin to cleanup endpoint %s", endpoint_id)
                     endpoint_description_path = os.path.join(config["storage-mount-path"], dead_endpoint["endpointDescriptionPath"])
-                    still_running = get_k8s_endpoint(endpoint_description_path)
-                    # empty mean not existing
-                    if still_running == "":
+                    still_running = get_k8s_endpoint(endpoint_id)
+                    if still_running is None:
                         logger.info("Endpoint already gone %s", endpoint_id)
                         status = "stopped"
                     else:
@@ -254,16 +360,20 @@ def create_log(logdir = '/var/log/dlworkspace'):
         logging.config.dictConfig(logging_config)
 
 
-def Run():
+def Run(setup_workers, setup_timeout):
     register_stack_trace_dump()
     create_log()
+    start_k8s_cache(("pod", "service"))
+
+    setup_pool = EndpointSetupPool(setup_workers, setup_timeout)
+    setup_pool.start()
 
     while True:
         update_file_modification_time("endpoint_manager")
 
         with manager_iteration_histogram.labels("endpoint_manager").time():
             # start endpoints
-            start_endpoints()
+            start_endpoints(setup_pool)
             time.sleep(1)
 
             # clean up endpoints for jobs which is NOT running
@@ -273,7 +383,9 @@ def Run():
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", "-p", help="port of exporter", type=int, default=9205)
+    parser.add_argument("--setup_workers", help="number of endpoints to set up concurrently", type=int, default=8)
+    parser.add_argument("--setup_timeout", help="seconds to give up setting up an endpoint", type=int, default=600)
     args = parser.parse_args()
     setup_exporter_thread(args.port)
 
-    Run()
+    Run(args.setup_workers, args.setup_timeout)
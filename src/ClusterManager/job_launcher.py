@@ -13,6 +13,8 @@ import base64
 import multiprocessing
 import hashlib
 
+from cachetools import LRUCache
+
 from kubernetes import client, config as k8s_config
 from kubernetes.client.rest import ApiException
 from kubernetes.stream import stream
@@ -28,6 +30,7 @@ from dist_pod_template import DistPodTemplate
 from config import config
 
 from cluster_manager import record
+from k8s_cache import K8sObjectCache
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +39,45 @@ k8s_config.load_kube_config()
 k8s_CoreAPI = client.CoreV1Api()
 k8s_AppsAPI = client.AppsV1Api()
 
+# kind -> K8sObjectCache, only populated in processes calling start_k8s_cache
+k8s_caches = {}
+
+
+def list_node(namespace=None, **kwargs):
+    """ list_node in the form of namespaced list functions, nodes are not
+    namespaced """
+    return k8s_CoreAPI.list_node(**kwargs)
+# watch finds the object type from docstring
+list_node.__doc__ = k8s_CoreAPI.list_node.__doc__
+
+
+def start_k8s_cache(kinds=("pod", "service", "secret"), handlers=None):
+    """ Start watching objects of kinds, JobDeployer/JobRole of this process
+    will read from local cache afterwards. Should be called after forking
+    worker processes, those will keep querying api server.
+
+    handlers is a dict of kind -> K8sObjectCache handler. """
+    list_funcs = {
+        "pod": k8s_CoreAPI.list_namespaced_pod,
+        "service": k8s_CoreAPI.list_namespaced_service,
+        "secret": k8s_CoreAPI.list_namespaced_secret,
+        "node": list_node,
+    }
+    for kind in kinds:
+        if kind not in k8s_caches:
+            k8s_caches[kind] = K8sObjectCache(kind, list_funcs[kind])
+            if handlers is not None and kind in handlers:
+                k8s_caches[kind].add_handler(handlers[kind])
+        k8s_caches[kind].start()
+
+
+def get_k8s_cache(kind):
+    """ Returns cache of kind if it is in sync, None otherwise """
+    cache = k8s_caches.get(kind)
+    if cache is not None and cache.is_ready():
+        return cache
+    return None
+
 class JobDeployer:
     def __init__(self):
         self.k8s_CoreAPI = k8s_CoreAPI
@@ -218,8 +260,17 @@ class JobDeployer:
             logging.info("Creating secret succeeded: %s" % created_secret.metadata.name)
         return created
 
+    def _get_from_cache(self, kind, field_selector="", label_selector=""):
+        cache = get_k8s_cache(kind)
+        if cache is None:
+            return None
+        return cache.list(field_selector=field_selector, label_selector=label_selector)
+
     @record
     def get_pods(self, field_selector="", label_selector=""):
+        pods = self._get_from_cache("pod", field_selector, label_selector)
+        if pods is not None:
+            return pods
         api_response = self.k8s_CoreAPI.list_namespaced_pod(
             namespace=self.namespace,
             pretty=self.pretty,
@@ -242,6 +293,9 @@ class JobDeployer:
 
     @record
     def _get_services_by_label(self, label_selector):
+        services = self._get_from_cache("service", label_selector=label_selector)
+        if services is not None:
+            return services
         api_response = self.k8s_CoreAPI.list_namespaced_service(
             namespace=self.namespace,
             pretty=self.pretty,
@@ -251,6 +305,9 @@ class JobDeployer:
 
     @record
     def get_secrets(self, field_selector="", label_selector=""):
+        secrets = self._get_from_cache("secret", field_selector, label_selector)
+        if secrets is not None:
+            return secrets
         api_response = self.k8s_CoreAPI.list_namespaced_secret(
             namespace=self.namespace,
             pretty=self.pretty,
@@ -260,6 +317,26 @@ class JobDeployer:
         logging.debug("Get secrets: {}".format(api_response))
         return api_response.items
 
+    @record
+    def get_service(self, name, cached=True):
+        """ Returns V1Service named name, None if not existing. With cached,
+        the watch cache is read if started, which may miss a service just
+        created. """
+        if cached:
+            services = self._get_from_cache("service", field_selector="metadata.name={}".format(name))
+            if services is not None:
+                return services[0] if len(services) > 0 else None
+        try:
+            return self.k8s_CoreAPI.read_namespaced_service(
+                name=name,
+                namespace=self.namespace,
+                pretty=self.pretty,
+            )
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+
     @record
     def delete_job(self, job_id, force=False):
         label_selector = "run={}".format(job_id)
@@ -326,6 +403,10 @@ class JobDeployer:
 class JobRole(object):
     MARK_ROLE_READY_FILE = "/pod/running/ROLE_READY"
 
+    # uid of pods whose role had been ready. ROLE_READY is never removed once
+    # created, so these pods need not be checked again.
+    ready_pod_uids = LRUCache(maxsize=20000)
+
     @staticmethod
     def get_job_roles(job_id):
         deployer = JobDeployer()
@@ -389,13 +470,26 @@ class JobRole(object):
         return status_code == 0
 
     def _is_role_ready(self):
+        uid = self.pod.metadata.uid
+        if uid in JobRole.ready_pod_uids:
+            return True
+
+        ready = self._check_role_ready()
+        if ready:
+            JobRole.ready_pod_uids[uid] = True
+        return ready
+
+    def _check_role_ready(self):
+        # readiness_probe result is pushed to pod status by kubelet
         for container in self.pod.spec.containers:
             if container.name == self.pod_name and container.readiness_probe is not None:
                 for status in self.pod.status.container_statuses:
                     if status.name == self.pod_name:
                         logger.info("pod %s have readiness_probe result", self.pod_name)
                         return status.ready
-        # no readiness_probe defined, fallback to old way
+        # no readiness_probe defined (pods created by old template), fallback to old way
+        logger.info("pod %s have no readiness_probe, check %s by exec",
+                self.pod_name, JobRole.MARK_ROLE_READY_FILE)
         return self._is_file_exist(JobRole.MARK_ROLE_READY_FILE)
 
 
@@ -582,11 +676,6 @@ class PythonLauncher(Launcher):
 
             ret["jobId"] = job_object.job_id
 
-            dataHandler.UpdateJobTextField(job_object.job_id, "jobStatus", "scheduling")
-            dataHandler.UpdateJobTextField(job_object.job_id, "jobDescriptionPath", job_description_path)
-            dataHandler.UpdateJobTextField(job_object.job_id, "jobDescription", base64.b64encode(job_description))
-            dataHandler.UpdateJobTextField(job_object.job_id, "lastUpdated", datetime.datetime.now().isoformat())
-
             jobMeta = {}
             jobMeta["jobDescriptionPath"] = job_description_path
             jobMeta["jobPath"] = job_object.job_path
@@ -595,18 +684,25 @@ class PythonLauncher(Launcher):
             jobMeta["LaunchCMD"] = pods[0].spec.containers[0].command
 
             jobMetaStr = base64.b64encode(json.dumps(jobMeta))
-            dataHandler.UpdateJobTextField(job_object.job_id, "jobMeta", jobMetaStr)
+            dataHandler.UpdateJobFields(job_object.job_id, {
+                "jobStatus": "scheduling",
+                "jobDescriptionPath": job_description_path,
+                "jobDescription": base64.b64encode(job_description),
+                "lastUpdated": datetime.datetime.now().isoformat(),
+                "jobMeta": jobMetaStr,
+                })
         except Exception as e:
             logging.error("Submit job failed: %s" % job, exc_info=True)
             ret["error"] = str(e)
             retries = dataHandler.AddandGetJobRetries(job["jobId"])
             if retries >= 5:
-                dataHandler.UpdateJobTextField(job["jobId"], "jobStatus", "error")
-                dataHandler.UpdateJobTextField(job["jobId"], "errorMsg", "Cannot submit job!" + str(e))
-
                 detail = get_job_status_detail(job)
                 detail = job_status_detail_with_finished_time(detail, "error", "Server error in job submission")
-                dataHandler.UpdateJobTextField(job["jobId"], "jobStatusDetail", base64.b64encode(json.dumps(detail)))
+                dataHandler.UpdateJobFields(job["jobId"], {
+                    "jobStatus": "error",
+                    "errorMsg": "Cannot submit job!" + str(e),
+                    "jobStatusDetail": base64.b64encode(json.dumps(detail)),
+                    })
 
                 # Try to clean up the job
                 try:
@@ -631,21 +727,25 @@ class PythonLauncher(Launcher):
         # TODO: Use JobDeployer?
         result, detail = k8sUtils.GetJobStatus(job_id)
         detail = job_status_detail_with_finished_time(detail, desired_state)
-        dataHandler.UpdateJobTextField(job_id, "jobStatusDetail", base64.b64encode(json.dumps(detail)))
         logging.info("Killing job %s, with status %s, %s" % (job_id, result, detail))
 
         job_deployer = JobDeployer()
         errors = job_deployer.delete_job(job_id, force=True)
 
+        fields = {
+            "jobStatusDetail": base64.b64encode(json.dumps(detail)),
+            "lastUpdated": datetime.datetime.now().isoformat(),
+            }
         if len(errors) == 0:
-            dataHandler.UpdateJobTextField(job_id, "jobStatus", desired_state)
-            dataHandler.UpdateJobTextField(job_id, "lastUpdated", datetime.datetime.now().isoformat())
+            fields["jobStatus"] = desired_state
+            dataHandler.UpdateJobFields(job_id, fields)
             if dataHandlerOri is None:
                 dataHandler.Close()
             return True
         else:
-            dataHandler.UpdateJobTextField(job_id, "jobStatus", "error", "{}".format(errors))
-            dataHandler.UpdateJobTextField(job_id, "lastUpdated", datetime.datetime.now().isoformat())
+            fields["jobStatus"] = "error"
+            fields["errorMsg"] = "{}".format(errors)
+            dataHandler.UpdateJobFields(job_id, fields)
             if dataHandlerOri is None:
                 dataHandler.Close()
             logging.error("Kill job failed with errors: {}".format(errors))
@@ -0,0 +1,152 @@
+import os
+import json
+import fcntl
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# seconds asked for in addition to the time since the last shipped line, to
+# cover clock skew between nodes and this host. Lines already shipped are
+# skipped by their timestamps.
+SINCE_OVERLAP_SECONDS = 60
+
+# lines of each pod kept in jobLog column
+DB_TAIL_LINES = 2000
+DB_FULL_LINES = 3000
+
+CURSOR_FILE = ".joblog-cursor.json"
+
+BANNER = "=========================================================\n"
+
+
+def normalize_timestamp(ts):
+    """ RFC3339Nano timestamp of kubelet has trailing zeros of fraction
+    trimmed, pad it to 9 digits so timestamps compare as strings """
+    ts = ts.rstrip("Z")
+    seconds, _, fraction = ts.partition(".")
+    return "%s.%sZ" % (seconds, fraction.ljust(9, "0")[:9])
+
+
+def since_seconds(ts, now=None):
+    """ since_seconds to ask for lines not earlier than normalized ts """
+    if now is None:
+        now = datetime.utcnow()
+    last = datetime.strptime(ts[:19], "%Y-%m-%dT%H:%M:%S")
+    return max(int((now - last).total_seconds()), 0) + SINCE_OVERLAP_SECONDS
+
+
+def parse_log(log):
+    """ [(normalized timestamp, line)] of a log read with timestamps=True,
+    line keeps its line break """
+    lines = []
+    for line in log.splitlines(True):
+        ts, _, content = line.partition(" ")
+        try:
+            lines.append((normalize_timestamp(ts), content))
+        except Exception:
+            logger.warning("unexpected log line without timestamp: %s", line[:200])
+    return lines
+
+
+def select_new_lines(lines, since, count):
+    """ Lines not shipped yet. since is the timestamp of the last shipped
+    line and count the number of shipped lines with that timestamp. Returns
+    (new lines, since, count) to continue from. """
+    new_lines = []
+    seen = 0
+    for ts, content in lines:
+        if since is not None:
+            if ts < since:
+                continue
+            if ts == since:
+                seen += 1
+                if seen <= count:
+                    continue
+        new_lines.append(content)
+        if ts == since:
+            count += 1
+        else:
+            since, count = ts, 1
+            seen = 1
+    return new_lines, since, count
+
+
+def read_tail_lines(path, num, block_size=65536):
+    """ Last num lines of file, without reading the whole file """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = ""
+        while pos > 0 and data.count("\n") <= num:
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos)
+            data = f.read(size) + data
+    lines = data.splitlines(True)
+    return lines[-num:]
+
+
+def pod_banner(pod_name):
+    return BANNER * 3 + "        logs from pod: %s\n" % pod_name + BANNER * 3
+
+
+def trimmed_log(pod_name, path):
+    """ Log of a pod shown in web page, only the last DB_TAIL_LINES lines of
+    a long log """
+    lines = read_tail_lines(path, DB_FULL_LINES)
+    parts = [pod_banner(pod_name)]
+    if len(lines) < DB_FULL_LINES:
+        parts += lines
+        parts += ["\n\n\n", BANNER, "        end of logs from pod: %s\n" % pod_name, BANNER, "\n\n\n"]
+    else:
+        parts += lines[-DB_TAIL_LINES:]
+        parts += ["\n\n\n", BANNER, "        end of logs from pod: %s\n" % pod_name,
+                "        Note: the log is too long to display in the webpage.\n",
+                "        Only the last %d lines are shown here.\n" % DB_TAIL_LINES,
+                "        Please check the log file (in Job Folder) for the full logs.\n",
+                BANNER, "\n\n\n"]
+    return "".join(parts)
+
+
+class JobLogCursor(object):
+    """ Where log shipping of a job is up to, kept in the job log dir so that
+    any process extracting the job log continues from it.
+
+    pods is pod name -> {"containerID", "path", "since", "count"}, see
+    select_new_lines for since and count. lastPod is the pod whose lines were
+    last appended to joblog.txt.
+    """
+    def __init__(self, log_dir):
+        self.path = os.path.join(log_dir, CURSOR_FILE)
+        self.lock_file = None
+        self.pods = {}
+        self.last_pod = None
+        # no cursor yet, files left by older versions are to be rewritten
+        self.is_new = True
+
+    def __enter__(self):
+        # joblog_manager and job_manager may extract the same job at once
+        self.lock_file = open(self.path + ".lock", "a")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    cursor = json.load(f)
+                self.pods = cursor.get("pods", {})
+                self.last_pod = cursor.get("lastPod")
+                self.is_new = False
+            except Exception:
+                logger.warning("invalid log cursor %s, ship logs from start", self.path, exc_info=True)
+        return self
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"pods": self.pods, "lastPod": self.last_pod}, f)
+        os.rename(tmp_path, self.path)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
@@ -7,6 +7,7 @@ import datetime
 import functools
 import timeit
 import collections
+import random
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"../storage"))
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"../utils"))
@@ -22,14 +23,18 @@ from node_manager import get_cluster_status
 import base64
 from ResourceInfo import ResourceInfo
 import quota
+from vc_usage import compute_vc_usage
 
 from prometheus_client import Histogram
 import redis
+from twisted.web.resource import Resource
 
 import logging
 import logging.config
 from job import Job, JobSchema
-from job_launcher import JobDeployer, JobRole, PythonLauncher
+from job_launcher import JobDeployer, JobRole, PythonLauncher, start_k8s_cache
+from job_queue import JobQueue, DEFAULT_RESYNC_INTERVAL, ACTIVE_STATUSES
+from job_params import DecodeJobParams, GetJobSchedulingFields, SCHEDULING_FIELDS
 
 from cluster_manager import setup_exporter_thread, manager_iteration_histogram, register_stack_trace_dump, update_file_modification_time, record
 
@@ -49,6 +54,20 @@ job_state_change_histogram = Histogram("job_state_change_latency_seconds",
             float("inf")),
         labelnames=("current_state",))
 
+# jobId -> decision of last TakeJobActions pass, see ScheduleExplainResource
+schedule_decisions = {}
+schedule_pass = {"id": 0, "time": None}
+
+# fraction of per job scheduling decisions logged at DEBUG level
+SCHEDULE_LOG_SAMPLE_RATE = 0.01
+
+# usage of vcs last written to db, see MaterializeVcUsage
+vc_usage_state = {"usage": None, "time": 0}
+
+# seconds between writes of unchanged usage of vcs, GetVC takes usage not
+# written in VC_USAGE_MAX_AGE of JobRestAPIUtils as stale
+VC_USAGE_REFRESH_INTERVAL = 30
+
 class JobTimeRecord(object):
     def __init__(self, create_time=None, approve_time=None,
             submit_time=None, running_time=None):
@@ -181,13 +200,6 @@ def get_scheduling_job_details(details):
     return pod_details
 
 
-def GetJobTotalGpu(jobParams):
-    numWorkers = 1
-    if "numpsworker" in jobParams:
-        numWorkers = int(jobParams["numpsworker"])
-    return int(jobParams["resourcegpu"]) * numWorkers
-
-
 @record
 def ApproveJob(redis_conn, job, dataHandlerOri=None):
     try:
@@ -196,19 +208,21 @@ def ApproveJob(redis_conn, job, dataHandlerOri=None):
 
         update_job_state_latency(redis_conn, job_id, "created", event_time=job["jobTime"])
 
-        jobParams = json.loads(base64.b64decode(job["jobParams"]))
-        job_total_gpus = GetJobTotalGpu(jobParams)
+        job_fields = GetJobSchedulingFields(job)
+        job_total_gpus = job_fields["totalGpu"]
 
         if dataHandlerOri is None:
             dataHandler = DataHandler()
         else:
             dataHandler = dataHandlerOri
 
-        if "preemptionAllowed" in jobParams and jobParams["preemptionAllowed"] is True:
+        if job_fields["preemptionAllowed"]:
             logging.info("Job {} preemptible, approve!".format(job_id))
             detail = [{"message": "waiting for available preemptible resource."}]
-            dataHandler.UpdateJobTextField(job["jobId"], "jobStatusDetail", base64.b64encode(json.dumps(detail)))
-            dataHandler.UpdateJobTextField(job_id, "jobStatus", "queued")
+            dataHandler.UpdateJobFields(job_id, {
+                "jobStatusDetail": base64.b64encode(json.dumps(detail)),
+                "jobStatus": "queued",
+                })
             update_job_state_latency(redis_conn, job_id, "approved")
             if dataHandlerOri is None:
                 dataHandler.Close()
@@ -228,14 +242,16 @@ def ApproveJob(redis_conn, job, dataHandlerOri=None):
         metadata = json.loads(vc["metadata"])
 
         if "user_quota" in metadata:
-            user_running_jobs = dataHandler.GetJobList(job["userName"], vcName, status="running,queued,scheduling", op=("=", "or"))
+            user_running_jobs = dataHandler.GetJobList(job["userName"], vcName,
+                    status="running,queued,scheduling", op=("=", "or"),
+                    columns=["jobId", "jobParams"] + SCHEDULING_FIELDS)
             running_gpus = 0
             for running_job in user_running_jobs:
-                running_jobParams = json.loads(base64.b64decode(running_job["jobParams"]))
+                running_job_fields = GetJobSchedulingFields(running_job)
                 # ignore preemptible GPUs
-                if "preemptionAllowed" in running_jobParams and running_jobParams["preemptionAllowed"] is True:
+                if running_job_fields["preemptionAllowed"]:
                     continue
-                running_job_total_gpus = GetJobTotalGpu(running_jobParams)
+                running_job_total_gpus = running_job_fields["totalGpu"]
                 running_gpus += running_job_total_gpus
 
             logging.info("Job {} require {}, used quota (exclude preemptible GPUs) {}, with user quota of {}.".format(job_id, job_total_gpus, running_gpus, metadata["user_quota"]))
@@ -248,8 +264,10 @@ def ApproveJob(redis_conn, job, dataHandlerOri=None):
                 return False
 
         detail = [{"message": "waiting for available resource."}]
-        dataHandler.UpdateJobTextField(job["jobId"], "jobStatusDetail", base64.b64encode(json.dumps(detail)))
-        dataHandler.UpdateJobTextField(job_id, "jobStatus", "queued")
+        dataHandler.UpdateJobFields(job_id, {
+            "jobStatusDetail": base64.b64encode(json.dumps(detail)),
+            "jobStatus": "queued",
+            })
         update_job_state_latency(redis_conn, job_id, "approved")
         if dataHandlerOri is None:
             dataHandler.Close()
@@ -264,13 +282,16 @@ def ApproveJob(redis_conn, job, dataHandlerOri=None):
 UnusualJobs = {}
 
 @record
-def UpdateJobStatus(redis_conn, launcher, job, notifier=None, dataHandlerOri=None):
+def UpdateJobStatus(redis_conn, launcher, job, notifier=None, dataHandlerOri=None, jobUpdates=None):
+    """ If jobUpdates (dict of jobId -> fields) is given, updates having no
+    follow up actions are put into it, caller should flush them by
+    BatchUpdateJobFields, expecting status of the jobs not changed. """
     assert(job["jobStatus"] == "scheduling" or job["jobStatus"] == "running")
     if dataHandlerOri is None:
         dataHandler = DataHandler()
     else:
         dataHandler = dataHandlerOri
-    jobParams = json.loads(base64.b64decode(job["jobParams"]))
+    jobParams = DecodeJobParams(job)
 
     result, details = check_job_status(job["jobId"])
     logging.info("++++++++ Job status: {} {}".format(job["jobId"], result))
@@ -282,17 +303,20 @@ def UpdateJobStatus(redis_conn, launcher, job, notifier=None, dataHandlerOri=Non
     jobDescriptionPath = None
     if "jobDescriptionPath" in job and job["jobDescriptionPath"] is not None:
         jobDescriptionPath = os.path.join(config["storage-mount-path"], job["jobDescriptionPath"])
-    if "userId" not in jobParams:
-        jobParams["userId"] = "0"
+    userId = jobParams.get("userId", "0")
 
     if result == "Succeeded":
-        joblog_manager.extract_job_log(job["jobId"], logPath, jobParams["userId"])
+        joblog_manager.extract_job_log(job["jobId"], logPath, userId)
 
         # TODO: Refactor
         detail = get_job_status_detail(job)
         detail = job_status_detail_with_finished_time(detail, "finished")
-        dataHandler.UpdateJobTextField(job["jobId"], "jobStatusDetail", base64.b64encode(json.dumps(detail)))
-        dataHandler.UpdateJobTextField(job["jobId"], "jobStatus", "finished")
+        # status must be updated before deleting pods, otherwise job will be
+        # seen as NotFound and resubmitted
+        dataHandler.UpdateJobFields(job["jobId"], {
+            "jobStatusDetail": base64.b64encode(json.dumps(detail)),
+            "jobStatus": "finished",
+            })
 
         # Retain the old code for reference
         # if jobDescriptionPath is not None and os.path.isfile(jobDescriptionPath):
@@ -309,8 +333,16 @@ def UpdateJobStatus(redis_conn, launcher, job, notifier=None, dataHandlerOri=Non
         if job["jobStatus"] != "running":
             started_at = k8sUtils.localize_time(datetime.datetime.now())
             detail = [{"startedAt": started_at, "message": "started at: {}".format(started_at)}]
-            dataHandler.UpdateJobTextField(job["jobId"], "jobStatusDetail", base64.b64encode(json.dumps(detail)))
-            dataHandler.UpdateJobTextField(job["jobId"], "jobStatus", "running")
+            fields = {
+                "jobStatusDetail": base64.b64encode(json.dumps(detail)),
+                "jobStatus": "running",
+                }
+            if jobUpdates is not None:
+                jobUpdates[job["jobId"]] = fields
+            else:
+                # not to overwrite killing or pausing requested meanwhile
+                dataHandler.BatchUpdateJobFields({job["jobId"]: fields},
+                        {job["jobId"]: job["jobStatus"]})
 
     elif result == "Failed":
         logging.warning("Job %s fails, cleaning...", job["jobId"])
@@ -319,14 +351,16 @@ def UpdateJobStatus(redis_conn, launcher, job, notifier=None, dataHandlerOri=Non
             notifier.notify(notify.new_job_state_change_message(
                 job["userName"], job["jobId"], result.strip()))
 
-        joblog_manager.extract_job_log(job["jobId"], logPath, jobParams["userId"])
+        joblog_manager.extract_job_log(job["jobId"], logPath, userId)
 
         # TODO: Refactor
         detail = get_job_status_detail(job)
         detail = job_status_detail_with_finished_time(detail, "failed")
-        dataHandler.UpdateJobTextField(job["jobId"], "jobStatusDetail", base64.b64encode(json.dumps(detail)))
-        dataHandler.UpdateJobTextField(job["jobId"], "jobStatus", "failed")
-        dataHandler.UpdateJobTextField(job["jobId"], "errorMsg", "pod failed")
+        dataHandler.UpdateJobFields(job["jobId"], {
+            "jobStatusDetail": base64.b64encode(json.dumps(detail)),
+            "jobStatus": "failed",
+            "errorMsg": "pod failed",
+            })
 
         # Retain the old code for reference
         # if jobDescriptionPath is not None and os.path.isfile(jobDescriptionPath):
@@ -360,7 +394,11 @@ def UpdateJobStatus(redis_conn, launcher, job, notifier=None, dataHandlerOri=Non
 
     elif result == "Pending":
         detail = get_scheduling_job_details(details)
-        dataHandler.UpdateJobTextField(job["jobId"], "jobStatusDetail", base64.b64encode(json.dumps(detail)))
+        fields = {"jobStatusDetail": base64.b64encode(json.dumps(detail))}
+        if jobUpdates is not None:
+            jobUpdates[job["jobId"]] = fields
+        else:
+            dataHandler.UpdateJobFields(job["jobId"], fields)
 
     if result != "Unknown" and result != "NotFound" and job["jobId"] in UnusualJobs:
         del UnusualJobs[job["jobId"]]
@@ -377,15 +415,17 @@ def check_job_status(job_id):
         return "NotFound", []
 
     # role status in ["NotFound", "Pending", "Running", "Succeeded", "Failed", "Unknown"]
+    # status() may exec into pod, so only call it once for each role
+    statuses = [job_role.status() for job_role in job_roles]
+
     # TODO ??? when ps/master role "Succeeded", return Succeeded
-    for job_role in job_roles:
+    for job_role, status in zip(job_roles, statuses):
         if job_role.role_name not in ["master", "ps"]:
             continue
-        if job_role.status() == "Succeeded":
+        if status == "Succeeded":
             logging.info("Job: {}, Succeeded!".format(job_id))
             return "Succeeded", []
 
-    statuses = [job_role.status() for job_role in job_roles]
     logging.info("Job: {}, status: {}".format(job_id, statuses))
 
     details = []
@@ -429,14 +469,8 @@ def get_priority_dict():
         dataHandler.Close()
 
 
-def get_job_priority(priority_dict, job_id):
-    if job_id in priority_dict.keys():
-        return priority_dict[job_id]
-    return 100
-
-
 @record
-def TakeJobActions(data_handler, redis_conn, launcher, jobs):
+def TakeJobActions(data_handler, redis_conn, launcher, job_queue):
     vc_list = data_handler.ListVCs()
     cluster_status, _ = data_handler.GetClusterStatus()
     cluster_total = cluster_status["gpu_capacity"]
@@ -444,22 +478,17 @@ def TakeJobActions(data_handler, redis_conn, launcher, jobs):
     cluster_reserved = cluster_status["gpu_reserved"]
 
     vc_info = {}
-    vc_usage = collections.defaultdict(lambda :
-            collections.defaultdict(lambda : 0))
-
     for vc in vc_list:
         vc_info[vc["vcName"]] = json.loads(vc["quota"])
 
-    active_job_list = data_handler.GetActiveJobList()
-    for job in active_job_list:
-        jobParam = json.loads(base64.b64decode(job["jobParams"]))
-        if "gpuType" in jobParam:
-            vc_usage[job["vcName"]][jobParam["gpuType"]] += GetJobTotalGpu(jobParam)
+    vc_usage = job_queue.get_vc_usage()
 
     result = quota.calculate_vc_gpu_counts(cluster_total, cluster_available,
             cluster_reserved, vc_info, vc_usage)
     vc_total, vc_used, vc_available, vc_unschedulable = result
 
+    MaterializeVcUsage(data_handler, cluster_status, vc_list, job_queue)
+
     cluster_gpu_capacity = cluster_status["gpu_capacity"]
     cluster_gpu_unschedulable = cluster_status["gpu_unschedulable"]
     global_total = ResourceInfo(cluster_gpu_capacity)
@@ -470,6 +499,7 @@ def TakeJobActions(data_handler, redis_conn, launcher, jobs):
 
     priority_dict = get_priority_dict()
     logging.info("Job priority dict: {}".format(priority_dict))
+    job_queue.set_priorities(priority_dict)
 
     for vc in vc_list:
         vc_name = vc["vcName"]
@@ -478,89 +508,133 @@ def TakeJobActions(data_handler, redis_conn, launcher, jobs):
             vc_schedulable[gpu_type] = total - vc_unschedulable[vc_name][gpu_type]
         vc_resources[vc_name] = ResourceInfo(vc_schedulable)
 
+    # job_queue keeps jobs sorted by sortKey, see job_queue.get_job_sort_key
     jobsInfo = []
-    for job in jobs:
-        if job["jobStatus"] in ["queued", "scheduling", "running"]:
-            singleJobInfo = {}
-            singleJobInfo["job"] = job
-            job_params = json.loads(base64.b64decode(job["jobParams"]))
-            singleJobInfo["preemptionAllowed"] = job_params["preemptionAllowed"]
-            singleJobInfo["jobId"] = job_params["jobId"]
-            jobGpuType = "any"
-            if "gpuType" in job_params:
-                jobGpuType = job_params["gpuType"]
-            singleJobInfo["globalResInfo"] = ResourceInfo({jobGpuType : GetJobTotalGpu(job_params)})
-
-            # Job lists will be sorted based on and in the order of below
-            # 1. non-preemptible precedes preemptible
-            # 2. running precedes scheduling, precedes queued
-            # 3. larger priority value precedes lower priority value
-            # 4. early job time precedes later job time
-
-            # Non-Preemptible jobs first
-            preemptible = 1 if singleJobInfo["preemptionAllowed"] else 0
-
-            # Job status
-            job_status = 0
-            if job["jobStatus"] == "scheduling":
-                job_status = 1
-            elif job["jobStatus"] == "queued":
-                job_status = 2
-
-            # Priority value
-            reverse_priority = get_job_priority(priority_dict, singleJobInfo["jobId"])
-            priority = 999999 - reverse_priority
-
-            # Job time
-            job_time = str(job["jobTime"])
-
-            singleJobInfo["sortKey"] = "{}_{}_{:06d}_{}".format(preemptible, job_status, priority, job_time)
-
-            singleJobInfo["allowed"] = False
-            jobsInfo.append(singleJobInfo)
-
-    jobsInfo.sort(key=lambda x: x["sortKey"])
-
-    logging.info("TakeJobActions : local resources : %s" % (vc_resources))
-    logging.info("TakeJobActions : global resources : %s" % (globalResInfo.CategoryToCountMap))
+    for entry in job_queue.sorted_entries():
+        singleJobInfo = dict(entry)
+        singleJobInfo["allowed"] = False
+        jobsInfo.append(singleJobInfo)
+
+    logging.info("TakeJobActions : local resources : %s", vc_resources)
+    logging.info("TakeJobActions : global resources : %s", globalResInfo.CategoryToCountMap)
+
+    pass_id = schedule_pass["id"] + 1
+    decisions = {}
+    for sji in jobsInfo:
+        decisions[sji["jobId"]] = {
+            "jobId": sji["jobId"],
+            "passId": pass_id,
+            "jobStatus": sji["job"]["jobStatus"],
+            "vcName": sji["job"]["vcName"],
+            "preemptionAllowed": sji["preemptionAllowed"],
+            "sortKey": sji["sortKey"],
+            "requested": sji["globalResInfo"].CategoryToCountMap,
+            }
 
     for sji in jobsInfo:
-        logging.info("TakeJobActions : job : %s : %s : %s" % (sji["jobId"], sji["globalResInfo"].CategoryToCountMap, sji["sortKey"]))
         vc_name = sji["job"]["vcName"]
         vc_resource = vc_resources[vc_name]
+        if sji["preemptionAllowed"]:
+            continue
 
-        if (not sji["preemptionAllowed"]) and (vc_resource.CanSatisfy(sji["globalResInfo"])):
+        decision = decisions[sji["jobId"]]
+        decision["vcAvailable"] = dict(vc_resource.CategoryToCountMap)
+        if vc_resource.CanSatisfy(sji["globalResInfo"]):
             vc_resource.Subtract(sji["globalResInfo"])
             globalResInfo.Subtract(sji["globalResInfo"])
             sji["allowed"] = True
-            logging.info("TakeJobActions : local assignment : %s : %s" % (sji["jobId"], sji["globalResInfo"].CategoryToCountMap))
+            decision["reason"] = "fits in vc quota"
+        else:
+            decision["reason"] = "not enough gpu left in vc quota"
+        log_sampled("TakeJobActions : local assignment : %s", decision)
 
     for sji in jobsInfo:
         if sji["preemptionAllowed"] and (sji["allowed"] is False):
+            decision = decisions[sji["jobId"]]
+            decision["globalAvailable"] = dict(globalResInfo.CategoryToCountMap)
             if globalResInfo.CanSatisfy(sji["globalResInfo"]):
-                logging.info("TakeJobActions : job : %s : %s" % (sji["jobId"], sji["globalResInfo"].CategoryToCountMap))
                 # Strict FIFO policy not required for global (bonus) tokens since these jobs are anyway pre-emptible.
                 globalResInfo.Subtract(sji["globalResInfo"])
                 sji["allowed"] = True
-                logging.info("TakeJobActions : global assignment : %s : %s" % (sji["jobId"], sji["globalResInfo"].CategoryToCountMap))
+                decision["reason"] = "fits in unused gpu of cluster"
+            else:
+                decision["reason"] = "not enough unused gpu in cluster"
+            log_sampled("TakeJobActions : global assignment : %s", decision)
 
-    logging.info("TakeJobActions : global resources : %s" % (globalResInfo.CategoryToCountMap))
+    logging.info("TakeJobActions : global resources : %s", globalResInfo.CategoryToCountMap)
 
     for sji in jobsInfo:
+        decisions[sji["jobId"]]["allowed"] = sji["allowed"]
         try:
             if sji["job"]["jobStatus"] == "queued" and (sji["allowed"] is True):
                 launcher.submit_job(sji["job"])
                 update_job_state_latency(redis_conn, sji["jobId"], "scheduling")
-                logging.info("TakeJobActions : submitting job : %s : %s" % (sji["jobId"], sji["sortKey"]))
+                decisions[sji["jobId"]]["action"] = "submit"
+                logging.info("TakeJobActions : submitting job : %s : %s", sji["jobId"], sji["sortKey"])
             elif sji["preemptionAllowed"] and (sji["job"]["jobStatus"] == "scheduling" or sji["job"]["jobStatus"] == "running") and (sji["allowed"] is False):
                 launcher.kill_job(sji["job"]["jobId"], "queued")
-                logging.info("TakeJobActions : pre-empting job : %s : %s" % (sji["jobId"], sji["sortKey"]))
+                decisions[sji["jobId"]]["action"] = "preempt"
+                logging.info("TakeJobActions : pre-empting job : %s : %s", sji["jobId"], sji["sortKey"])
         except Exception as e:
             logging.error("Process job failed {}".format(sji["job"]), exc_info=True)
 
+    # replaced as a whole, so ScheduleExplainResource never sees a pass half done
+    global schedule_decisions
+    schedule_decisions = decisions
+    schedule_pass["id"] = pass_id
+    schedule_pass["time"] = time.time()
+
     logging.info("TakeJobActions : job desired actions taken")
 
-def Run(redis_port, target_status):
+
+def MaterializeVcUsage(data_handler, cluster_status, vc_list, job_queue):
+    """ Writes usage of vcs shown by GetVC to db when jobs in job_queue,
+    cluster status or vcs change it, so that GetVC reads it instead of
+    computing it from all active jobs """
+    try:
+        jobs = [(entry["job"], entry) for entry in job_queue.entries.values()
+                if entry["job"]["jobStatus"] in ACTIVE_STATUSES]
+        usage = compute_vc_usage(cluster_status, vc_list, jobs)
+        now = time.time()
+        if usage == vc_usage_state["usage"] and \
+                now - vc_usage_state["time"] < VC_USAGE_REFRESH_INTERVAL:
+            return
+        if data_handler.UpdateVcUsage(usage):
+            vc_usage_state["usage"] = usage
+            vc_usage_state["time"] = now
+    except Exception:
+        logging.warning("materialize usage of vcs failed", exc_info=True)
+
+
+def log_sampled(msg, *args):
+    """ Per job logs of TakeJobActions, only a sample of them are logged at
+    DEBUG level, use /jobs/<jobId>/schedule-explain for a specific job. """
+    if logging.getLogger().isEnabledFor(logging.DEBUG) and random.random() < SCHEDULE_LOG_SAMPLE_RATE:
+        logging.debug(msg, *args)
+
+
+class ScheduleExplainResource(Resource):
+    """ Serves /jobs/<jobId>/schedule-explain, the decision of last
+    TakeJobActions pass about a job """
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "application/json")
+        if len(request.postpath) != 2 or request.postpath[1] != "schedule-explain":
+            request.setResponseCode(404)
+            return json.dumps({"error": "not found"})
+
+        job_id = request.postpath[0]
+        decision = schedule_decisions.get(job_id)
+        if decision is None:
+            request.setResponseCode(404)
+            return json.dumps({"error": "job %s is not in last schedule pass %d" % (job_id, schedule_pass["id"])})
+        ret = dict(decision)
+        ret["passTime"] = schedule_pass["time"]
+        return json.dumps(ret)
+
+
+def Run(redis_port, target_status, resync_interval=DEFAULT_RESYNC_INTERVAL):
     register_stack_trace_dump()
     process_name = "job_manager_" + target_status
 
@@ -572,9 +646,15 @@ def Run(redis_port, target_status):
     launcher = PythonLauncher()
     launcher.start()
 
+    if target_status in ["scheduling", "running"]:
+        # after launcher.start(), so that forked launcher processes query api server directly
+        start_k8s_cache()
+
     redis_conn = redis.StrictRedis(host="localhost",
             port=redis_port, db=0)
 
+    job_queue = JobQueue(resync_interval)
+
     while True:
         update_file_modification_time(process_name)
 
@@ -591,15 +671,15 @@ def Run(redis_port, target_status):
                 dataHandler = DataHandler()
 
                 if target_status == "queued":
-                    jobs = dataHandler.GetJobList("all", "all", num=None,
-                            status="queued,scheduling,running")
-                    TakeJobActions(dataHandler, redis_conn, launcher, jobs)
+                    job_queue.refresh(dataHandler)
+                    TakeJobActions(dataHandler, redis_conn, launcher, job_queue)
                 else:
                     jobs = dataHandler.GetJobList("all", "all", num=None,
                             status=target_status)
                     logging.info("Updating status for %d %s jobs",
                             len(jobs), target_status)
 
+                    jobUpdates = {}
                     for job in jobs:
                         logging.info("Processing job: %s, status: %s" % (job["jobId"], job["jobStatus"]))
                         if job["jobStatus"] == "killing":
@@ -607,14 +687,22 @@ def Run(redis_port, target_status):
                         elif job["jobStatus"] == "pausing":
                             launcher.kill_job(job["jobId"], "paused")
                         elif job["jobStatus"] == "running":
-                            UpdateJobStatus(redis_conn, launcher, job, notifier, dataHandlerOri=dataHandler)
+                            UpdateJobStatus(redis_conn, launcher, job, notifier, dataHandlerOri=dataHandler, jobUpdates=jobUpdates)
                         elif job["jobStatus"] == "scheduling":
-                            UpdateJobStatus(redis_conn, launcher, job, notifier, dataHandlerOri=dataHandler)
+                            UpdateJobStatus(redis_conn, launcher, job, notifier, dataHandlerOri=dataHandler, jobUpdates=jobUpdates)
                         elif job["jobStatus"] == "unapproved":
                             ApproveJob(redis_conn, job, dataHandlerOri=dataHandler)
                         else:
                             logging.error("unknown job status %s for job %s",
                                     job["jobStatus"], job["jobId"])
+
+                    if len(jobUpdates) > 0:
+                        logging.info("Flushing updates of %d jobs", len(jobUpdates))
+                        # jobs killed or paused during the pass are left
+                        # as they are
+                        expected_statuses = dict([(job["jobId"], job["jobStatus"])
+                            for job in jobs if job["jobId"] in jobUpdates])
+                        dataHandler.BatchUpdateJobFields(jobUpdates, expected_statuses)
             except Exception as e:
                 logging.warning("Process job failed!", exc_info=True)
             finally:
@@ -631,8 +719,12 @@ if __name__ == '__main__':
     parser.add_argument("--redis_port", "-r", help="port of redis", type=int, default=9300)
     parser.add_argument("--port", "-p", help="port of exporter", type=int, default=9200)
     parser.add_argument("--status", "-s", help="target status to update, queued is a special status", type=str, default="queued")
+    parser.add_argument("--resync_interval", help="seconds between full reloads of job queue, 0 to reload every iteration", type=int, default=DEFAULT_RESYNC_INTERVAL)
 
     args = parser.parse_args()
-    setup_exporter_thread(args.port)
+    if args.status == "queued":
+        setup_exporter_thread(args.port, {"jobs": ScheduleExplainResource()})
+    else:
+        setup_exporter_thread(args.port)
 
-    Run(args.redis_port, args.status)
+    Run(args.redis_port, args.status, args.resync_interval)
@@ -0,0 +1,170 @@
+import time
+import bisect
+import logging
+import collections
+
+from ResourceInfo import ResourceInfo
+from job_params import GetJobSchedulingFields
+
+logger = logging.getLogger(__name__)
+
+SCHEDULABLE_STATUSES = ["queued", "scheduling", "running"]
+ACTIVE_STATUSES = ["scheduling", "running"]
+
+DEFAULT_JOB_PRIORITY = 100
+
+# seconds between two full reloads of the job queue, 0 means always reload
+DEFAULT_RESYNC_INTERVAL = 300
+
+
+def get_job_priority(priority_dict, job_id):
+    if job_id in priority_dict:
+        return priority_dict[job_id]
+    return DEFAULT_JOB_PRIORITY
+
+
+def get_job_sort_key(preemption_allowed, job_status, priority, job_time):
+    # Job lists will be sorted based on and in the order of below
+    # 1. non-preemptible precedes preemptible
+    # 2. running precedes scheduling, precedes queued
+    # 3. larger priority value precedes lower priority value
+    # 4. early job time precedes later job time
+
+    # Non-Preemptible jobs first
+    preemptible = 1 if preemption_allowed else 0
+
+    # Job status
+    status = 0
+    if job_status == "scheduling":
+        status = 1
+    elif job_status == "queued":
+        status = 2
+
+    # Priority value
+    reverse_priority = 999999 - priority
+
+    return "{}_{}_{:06d}_{}".format(preemptible, status, reverse_priority, str(job_time))
+
+
+class JobQueue(object):
+    """In-memory view of queued/scheduling/running jobs, ordered by sort key.
+
+    The queue is reloaded from scratch every resync_interval seconds. In
+    between, only the jobs whose status changed since the previous pass are
+    fetched from db.
+    """
+    def __init__(self, resync_interval=DEFAULT_RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self.last_resync = None
+        self.priority_dict = {}
+        # job_id -> entry
+        self.entries = {}
+        # sorted list of (sort_key, job_id)
+        self.keys = []
+
+    def need_resync(self, now):
+        return self.last_resync is None or self.resync_interval <= 0 or \
+            now - self.last_resync >= self.resync_interval
+
+    def refresh(self, data_handler):
+        now = time.time()
+        try:
+            if self.need_resync(now):
+                jobs = data_handler.GetJobList("all", "all", num=None,
+                        status=",".join(SCHEDULABLE_STATUSES))
+                self.reset(jobs)
+                self.last_resync = now
+                logger.info("JobQueue: reloaded %d jobs", len(self.entries))
+                return
+
+            statuses = data_handler.GetJobStatuses(",".join(SCHEDULABLE_STATUSES))
+            for job_id in self.entries.keys():
+                if job_id not in statuses:
+                    self._remove(job_id)
+
+            changed = [job_id for job_id, job_status in statuses.items()
+                    if job_id not in self.entries or
+                    self.entries[job_id]["job"]["jobStatus"] != job_status]
+            if len(changed) > 0:
+                self.apply(data_handler.GetJobsByIds(changed))
+            logger.info("JobQueue: %d jobs changed, %d jobs in queue",
+                    len(changed), len(self.entries))
+        except Exception:
+            # do not trust partial updates, start over in next pass
+            self.last_resync = None
+            raise
+
+    def reset(self, jobs):
+        self.entries = {}
+        self.keys = []
+        self.apply(jobs)
+
+    def apply(self, jobs):
+        for job in jobs:
+            self._remove(job["jobId"])
+            if job["jobStatus"] in SCHEDULABLE_STATUSES:
+                self._add(job)
+
+    def set_priorities(self, priority_dict):
+        old_priority_dict = self.priority_dict
+        self.priority_dict = priority_dict
+        for job_id in self.entries.keys():
+            if get_job_priority(old_priority_dict, job_id) != get_job_priority(priority_dict, job_id):
+                entry = self.entries[job_id]
+                self._remove(job_id)
+                self._insert(entry)
+
+    def sorted_entries(self):
+        return [self.entries[job_id] for _, job_id in self.keys]
+
+    def get_vc_usage(self):
+        vc_usage = collections.defaultdict(lambda :
+                collections.defaultdict(lambda : 0))
+        for entry in self.entries.values():
+            if entry["job"]["jobStatus"] in ACTIVE_STATUSES and entry["gpuType"] is not None:
+                vc_usage[entry["job"]["vcName"]][entry["gpuType"]] += entry["totalGpu"]
+        return vc_usage
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, job_id):
+        return job_id in self.entries
+
+    def _add(self, job):
+        try:
+            fields = GetJobSchedulingFields(job)
+        except Exception:
+            logger.exception("JobQueue: failed to parse jobParams of job %s", job["jobId"])
+            return
+        total_gpu = fields["totalGpu"]
+        if total_gpu is None:
+            logger.error("JobQueue: invalid gpu number of job %s", job["jobId"])
+            return
+
+        gpu_type = fields["gpuType"]
+        entry = {
+            "job": job,
+            "jobId": job["jobId"],
+            "preemptionAllowed": fields["preemptionAllowed"],
+            "gpuType": gpu_type,
+            "totalGpu": total_gpu,
+            "globalResInfo": ResourceInfo({gpu_type if gpu_type is not None else "any": total_gpu}),
+        }
+        self._insert(entry)
+
+    def _insert(self, entry):
+        job = entry["job"]
+        priority = get_job_priority(self.priority_dict, entry["jobId"])
+        entry["sortKey"] = get_job_sort_key(entry["preemptionAllowed"],
+                job["jobStatus"], priority, job["jobTime"])
+        self.entries[entry["jobId"]] = entry
+        bisect.insort(self.keys, (entry["sortKey"], entry["jobId"]))
+
+    def _remove(self, job_id):
+        entry = self.entries.pop(job_id, None)
+        if entry is None:
+            return
+        index = bisect.bisect_left(self.keys, (entry["sortKey"], job_id))
+        if index < len(self.keys) and self.keys[index] == (entry["sortKey"], job_id):
+            del self.keys[index]
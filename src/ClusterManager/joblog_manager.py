@@ -31,6 +31,8 @@ import k8sUtils
 from osUtils import mkdirsAsUser
 from config import config, GetStoragePath
 from DataHandler import DataHandler
+from job_params import DecodeJobParams
+import job_log
 
 from cluster_manager import setup_exporter_thread, manager_iteration_histogram, register_stack_trace_dump, update_file_modification_time, record
 
@@ -47,90 +49,83 @@ def create_log(logdir = '/var/log/dlworkspace'):
 
 
 
+def get_pod_logs(jobId, cursor):
+    """ [(pod name, containerID, new lines, since, count)] of pods of job,
+    lines after cursor. since is None for a container seen first time. """
+    podInfo = k8sUtils.GetPod("run=" + jobId)
+    if podInfo is None:
+        return []
+    logs = []
+    for item in podInfo.get("items", []):
+        try:
+            pod_name = item["metadata"]["name"]
+            containerID = item["status"]["containerStatuses"][0]["containerID"].replace("docker://", "")
+        except (KeyError, IndexError, TypeError):
+            continue
+        pod_cursor = cursor.pods.get(pod_name)
+        if pod_cursor is not None and pod_cursor["containerID"] != containerID:
+            # container restarted, its log goes to a new file
+            pod_cursor = None
+        since, count, seconds = None, 0, None
+        if pod_cursor is not None and pod_cursor["since"] is not None:
+            since, count = pod_cursor["since"], pod_cursor["count"]
+            seconds = job_log.since_seconds(since)
+        log = k8sUtils.read_pod_log(pod_name, since_seconds=seconds, timestamps=True)
+        new_lines, since, count = job_log.select_new_lines(job_log.parse_log(log), since, count)
+        logs.append((pod_name, containerID, new_lines, since, count))
+    return logs
+
+
+def append_file(path, data, userId, overwrite=False):
+    created = not os.path.exists(path)
+    with open(path, "w" if overwrite else "a") as f:
+        f.write(data)
+    if created:
+        os.chown(path, int(userId), -1)
+
+
 @record
 def extract_job_log(jobId,logPath,userId):
+    """ Appends log lines of job pods not shipped yet to container log files
+    and joblog.txt, and keeps a bounded tail of each pod in jobLog column """
     try:
-        dataHandler = DataHandler()
-
-        # TODO: Replace joblog manager with elastic search
-        logs = k8sUtils.GetLog(jobId, tail=None)
-
-        # Do not overwrite existing logs with empty log
-        # DLTS bootstrap will generate logs for all containers.
-        # If one container has empty log, skip writing.
-        for log in logs:
-            if "containerLog" in log and log["containerLog"] == "":
-                return
-
         jobLogDir = os.path.dirname(logPath)
         if not os.path.exists(jobLogDir):
             mkdirsAsUser(jobLogDir,userId)
-        logStr = ""
-        trimlogstr = ""
-
-
-        for log in logs:
-            if "podName" in log and "containerID" in log and "containerLog" in log:
-                logStr += "=========================================================\n"
-                logStr += "=========================================================\n"
-                logStr += "=========================================================\n"
-                logStr += "        logs from pod: %s\n" % log["podName"]
-                logStr += "=========================================================\n"
-                logStr += "=========================================================\n"
-                logStr += "=========================================================\n"
-                logStr += log["containerLog"]
-                logStr += "\n\n\n"
-                logStr += "=========================================================\n"
-                logStr += "        end of logs from pod: %s\n" % log["podName"] 
-                logStr += "=========================================================\n"
-                logStr += "\n\n\n"
-
-
-                trimlogstr += "=========================================================\n"
-                trimlogstr += "=========================================================\n"
-                trimlogstr += "=========================================================\n"
-                trimlogstr += "        logs from pod: %s\n" % log["podName"]
-                trimlogstr += "=========================================================\n"
-                trimlogstr += "=========================================================\n"
-                trimlogstr += "=========================================================\n"
-                logLines = log["containerLog"].split('\n')
-                if (len(logLines) < 3000):
-                    trimlogstr += log["containerLog"]
-                    trimlogstr += "\n\n\n"
-                    trimlogstr += "=========================================================\n"
-                    trimlogstr += "        end of logs from pod: %s\n" % log["podName"] 
-                    trimlogstr += "=========================================================\n"
-                    trimlogstr += "\n\n\n"
-                else:
-                    trimlogstr += "\n".join(logLines[-2000:])
-                    trimlogstr += "\n\n\n"
-                    trimlogstr += "=========================================================\n"
-                    trimlogstr += "        end of logs from pod: %s\n" % log["podName"] 
-                    trimlogstr += "        Note: the log is too long to display in the webpage.\n"
-                    trimlogstr += "        Only the last 2000 lines are shown here.\n"
-                    trimlogstr += "        Please check the log file (in Job Folder) for the full logs.\n"
-                    trimlogstr += "=========================================================\n"
-                    trimlogstr += "\n\n\n"
 
+        with job_log.JobLogCursor(jobLogDir) as cursor:
+            updated = False
+            for pod_name, containerID, new_lines, since, count in get_pod_logs(jobId, cursor):
+                containerLogPath = os.path.join(jobLogDir,"log-container-" + containerID + ".txt")
+                pod_cursor = cursor.pods.get(pod_name)
+                first_read = pod_cursor is None or pod_cursor["containerID"] != containerID
+                if len(new_lines) > 0:
+                    data = "".join(new_lines)
+                    append_file(containerLogPath, data, userId, overwrite=first_read)
+                    if cursor.last_pod != pod_name:
+                        data = "\n" + job_log.pod_banner(pod_name) + data
+                    append_file(logPath, data, userId, overwrite=cursor.is_new and not updated)
+                    cursor.last_pod = pod_name
+                    updated = True
+                cursor.pods[pod_name] = {
+                    "containerID": containerID,
+                    "path": containerLogPath,
+                    "since": since,
+                    "count": count,
+                }
+            cursor.save()
+
+            if updated:
+                trimlogstr = "".join([job_log.trimmed_log(pod_name, pod["path"])
+                    for pod_name, pod in sorted(cursor.pods.items())
+                    if os.path.exists(pod["path"])])
+                dataHandler = DataHandler()
                 try:
-                    containerLogPath = os.path.join(jobLogDir,"log-container-" + log["containerID"] + ".txt")
-                    with open(containerLogPath, 'w') as f:
-                        f.write(log["containerLog"])
-                    f.close()
-                    os.system("chown -R %s %s" % (userId, containerLogPath))
-                except Exception as e:
-                    logger.exception("write container log failed")
-
-
-        if len(trimlogstr.strip()) > 0:
-            dataHandler.UpdateJobTextField(jobId,"jobLog",base64.b64encode(trimlogstr))
-            with open(logPath, 'w') as f:
-                f.write(logStr)
-            f.close()
-            os.system("chown -R %s %s" % (userId, logPath))
-
+                    dataHandler.UpdateJobLog(jobId,trimlogstr)
+                finally:
+                    dataHandler.Close()
     except Exception as e:
-        logging.error(e)
+        logger.exception("extract log of job %s failed", jobId)
 
 
 
@@ -138,12 +133,12 @@ def update_job_logs():
     while True:
         try:
             dataHandler = DataHandler()
-            pendingJobs = dataHandler.GetPendingJobs()
-            for job in pendingJobs:
+            activeJobs = dataHandler.GetActiveJobList()
+            for job in activeJobs:
                 try:
                     if job["jobStatus"] == "running" :
                         logging.info("updating job logs for job %s" % job["jobId"])
-                        jobParams = json.loads(base64.b64decode(job["jobParams"]))
+                        jobParams = DecodeJobParams(job)
                         jobPath,workPath,dataPath = GetStoragePath(jobParams["jobPath"],jobParams["workPath"],jobParams["dataPath"])
                         localJobPath = os.path.join(config["storage-mount-path"],jobPath)
                         logPath = os.path.join(localJobPath,"logs/joblog.txt")
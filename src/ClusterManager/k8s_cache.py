@@ -0,0 +1,208 @@
+import os
+import time
+import logging
+import threading
+
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+
+from prometheus_client import Gauge, Counter
+
+logger = logging.getLogger(__name__)
+
+k8s_cache_staleness_gauge = Gauge("k8s_cache_staleness_seconds",
+        "seconds since the local k8s object cache was last known in sync with api server",
+        labelnames=("kind",))
+
+k8s_cache_relist_counter = Counter("k8s_cache_relist_count",
+        "times the local k8s object cache did a full list from api server",
+        labelnames=("kind",))
+
+
+class K8sObjectCache(object):
+    """Local copy of one kind of namespaced k8s objects, kept up to date by
+    list + watch, so readers need not query api server every time.
+
+    Objects are indexed by name and by INDEXED_LABELS. A watch is resumed
+    from the last seen resourceVersion, a full list is only done at start
+    or when api server tells the resourceVersion is too old (410 Gone).
+
+    Readers should check is_ready() and fall back to api server otherwise,
+    e.g. in a process forked after the watch thread started.
+
+    Handlers added by add_handler are called from the watch thread with
+    (event_type, obj) for every event, and with ("RELIST", objs) after a
+    full list.
+    """
+    INDEXED_LABELS = ["run", "jobId", "podName"]
+
+    def __init__(self, kind, list_func, namespace="default",
+            watch_timeout=30, max_staleness=90):
+        self.kind = kind
+        self.list_func = list_func
+        self.namespace = namespace
+        self.watch_timeout = watch_timeout
+        self.max_staleness = max_staleness
+
+        self.lock = threading.Lock()
+        # name -> object
+        self.objects = {}
+        # label -> label value -> set of name
+        self.indexes = dict([(label, {}) for label in K8sObjectCache.INDEXED_LABELS])
+
+        self.resource_version = None
+        self.last_sync = None
+        self.pid = None
+        self.thread = None
+        self.handlers = []
+
+        k8s_cache_staleness_gauge.labels(kind).set_function(self.staleness)
+
+    def start(self):
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._run,
+                name="k8s-cache-" + self.kind)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def _notify(self, event_type, obj):
+        for handler in self.handlers:
+            try:
+                handler(event_type, obj)
+            except Exception:
+                logger.exception("k8s cache %s handler failed on %s event",
+                        self.kind, event_type)
+
+    def staleness(self):
+        if self.last_sync is None:
+            return float("inf")
+        return time.time() - self.last_sync
+
+    def is_ready(self):
+        # threads do not survive fork, the copy in child process is frozen
+        return self.pid == os.getpid() and \
+                self.staleness() <= self.max_staleness
+
+    def get(self, name):
+        with self.lock:
+            return self.objects.get(name)
+
+    def list(self, field_selector="", label_selector=""):
+        """ Supports empty selectors, "metadata.name=<name>" as
+        field_selector and "<label>=<value>" as label_selector where label
+        is one of INDEXED_LABELS. Returns None for other selectors. """
+        names = None
+        with self.lock:
+            if field_selector:
+                key, value = K8sObjectCache._parse_selector(field_selector)
+                if key != "metadata.name":
+                    return None
+                names = set([value]) if value in self.objects else set()
+
+            if label_selector:
+                key, value = K8sObjectCache._parse_selector(label_selector)
+                if key not in self.indexes:
+                    return None
+                labelled = self.indexes[key].get(value, set())
+                names = labelled if names is None else names & labelled
+
+            if names is None:
+                return self.objects.values()
+            return [self.objects[name] for name in sorted(names)]
+
+    @staticmethod
+    def _parse_selector(selector):
+        if "," in selector or "!=" in selector or "=" not in selector:
+            return None, None
+        key, value = selector.split("=", 1)
+        return key.strip(), value.strip()
+
+    def _index(self, name, obj, add):
+        labels = obj.metadata.labels or {}
+        for label, index in self.indexes.items():
+            if label not in labels:
+                continue
+            names = index.setdefault(labels[label], set())
+            if add:
+                names.add(name)
+            else:
+                names.discard(name)
+                if len(names) == 0:
+                    del index[labels[label]]
+
+    def _set(self, obj):
+        name = obj.metadata.name
+        old = self.objects.get(name)
+        if old is not None:
+            self._index(name, old, False)
+        self.objects[name] = obj
+        self._index(name, obj, True)
+
+    def _delete(self, obj):
+        name = obj.metadata.name
+        old = self.objects.pop(name, None)
+        if old is not None:
+            self._index(name, old, False)
+
+    def _relist(self):
+        resp = self.list_func(namespace=self.namespace)
+        with self.lock:
+            self.objects = {}
+            for index in self.indexes.values():
+                index.clear()
+            for obj in resp.items:
+                self._set(obj)
+            self.resource_version = resp.metadata.resource_version
+        self.last_sync = time.time()
+        k8s_cache_relist_counter.labels(self.kind).inc()
+        logger.info("k8s cache %s listed %d objects at resourceVersion %s",
+                self.kind, len(resp.items), self.resource_version)
+        self._notify("RELIST", resp.items)
+
+    def _apply(self, event_type, obj):
+        with self.lock:
+            if event_type == "DELETED":
+                self._delete(obj)
+            else:
+                self._set(obj)
+            self.resource_version = obj.metadata.resource_version
+        self.last_sync = time.time()
+        self._notify(event_type, obj)
+
+    def _watch(self):
+        w = watch.Watch()
+        for event in w.stream(self.list_func,
+                namespace=self.namespace,
+                resource_version=self.resource_version,
+                timeout_seconds=self.watch_timeout,
+                _request_timeout=self.watch_timeout + 30):
+            if event["type"] == "ERROR":
+                w.stop()
+                status = event["raw_object"]
+                if status.get("code") == 410:
+                    logger.info("k8s cache %s resourceVersion %s is too old, relist",
+                            self.kind, self.resource_version)
+                    self.resource_version = None
+                    return
+                raise RuntimeError("watch {} failed: {}".format(self.kind, status))
+            self._apply(event["type"], event["object"])
+        # watch ended by server side timeout without error, nothing missed
+        self.last_sync = time.time()
+
+    def _run(self):
+        while True:
+            try:
+                if self.resource_version is None:
+                    self._relist()
+                self._watch()
+            except Exception as e:
+                if isinstance(e, ApiException) and e.status == 410:
+                    self.resource_version = None
+                logger.warning("k8s cache %s watch failed, retry later", self.kind,
+                        exc_info=True)
+                time.sleep(1)
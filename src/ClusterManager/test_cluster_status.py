@@ -0,0 +1,200 @@
+import unittest
+import json
+import threading
+import urlparse
+import BaseHTTPServer
+
+from cluster_status import ClusterStatusAggregator, PodGpuUsage, parse_pod, GPU_USAGE_QUERY
+
+
+def make_node(name, gpu_type="P40", gpus=4, unschedulable=False):
+    return {
+        "metadata": {"name": name, "labels": {"gpuType": gpu_type, "worker": "active"}},
+        "spec": {"unschedulable": unschedulable},
+        "status": {
+            "allocatable": {"nvidia.com/gpu": str(gpus)},
+            "capacity": {"nvidia.com/gpu": str(gpus)},
+            "addresses": [{"type": "InternalIP", "address": "10.0.0.1"}],
+            "conditions": [{"type": "Ready", "status": "True"}],
+        },
+    }
+
+
+def make_pod(name, node_name, user_name="user", gpus=1, preemptible=False, phase="Running"):
+    pod = {
+        "metadata": {"name": name, "labels": {"userName": user_name,
+            "preemptionAllowed": str(preemptible)}},
+        "spec": {"containers": [{"name": name,
+            "resources": {"requests": {"nvidia.com/gpu": str(gpus)}}}]},
+        "status": {"phase": phase},
+    }
+    if node_name is not None:
+        pod["spec"]["nodeName"] = node_name
+    return pod
+
+
+def user_status(status, key="user_status"):
+    return dict((user["userName"], user["userGPU"]) for user in status[key])
+
+
+class TestClusterStatusAggregator(unittest.TestCase):
+
+    def create_aggregator(self):
+        aggregator = ClusterStatusAggregator()
+        aggregator.on_node_event("RELIST", [make_node("node1"), make_node("node2", unschedulable=True)])
+        aggregator.on_pod_event("RELIST", [
+            make_pod("pod1", "node1", gpus=2),
+            make_pod("pod2", "node1", user_name="other", gpus=1, preemptible=True),
+            make_pod("pod3", "node2", gpus=1),
+            make_pod("pending", None, gpus=4),
+            make_pod("finished", "node1", gpus=4, phase="Succeeded"),
+        ])
+        return aggregator
+
+    def test_status(self):
+        status = self.create_aggregator().get_status()
+        self.assertEqual({"P40": 8}, status["gpu_capacity"])
+        self.assertEqual({"P40": 3}, status["gpu_used"])
+        self.assertEqual({"P40": 2}, status["gpu_avaliable"])
+        self.assertEqual({"P40": 4}, status["gpu_unschedulable"])
+        self.assertEqual({"P40": 3}, status["gpu_reserved"])
+        self.assertEqual({"user": {"P40": 3}, "other": {"P40": 0}}, user_status(status))
+        self.assertEqual({"user": {"P40": 0}, "other": {"P40": 1}},
+                user_status(status, "user_status_preemptable"))
+
+        node1 = status["node_status"][0]
+        self.assertEqual("node1", node1["name"])
+        self.assertEqual({"P40": 2}, node1["gpu_used"])
+        self.assertEqual({"P40": 1}, node1["gpu_preemptable_used"])
+        self.assertEqual(["pod1 : user (gpu #:2)", "pod2 : other (gpu #:1)"], node1["pods"])
+        self.assertEqual(["P40", "worker"], sorted(node1["scheduled_service"]))
+
+    def test_gpu_usage(self):
+        status = self.create_aggregator().get_status(lambda pod_name: 20 if pod_name == "pod1" else None)
+        self.assertEqual("pod1 : user (gpu usage:20%)!!!!!! (gpu #:2)", status["node_status"][0]["pods"][0])
+
+    def test_pod_events(self):
+        aggregator = self.create_aggregator()
+        aggregator.on_pod_event("DELETED", make_pod("pod1", "node1"))
+        aggregator.on_pod_event("MODIFIED", make_pod("pending", "node1", gpus=4))
+        aggregator.on_pod_event("MODIFIED", make_pod("pod3", "node2", phase="Failed"))
+        status = aggregator.get_status()
+        self.assertEqual({"P40": 4}, status["gpu_used"])
+        self.assertEqual({"user": {"P40": 4}, "other": {"P40": 0}}, user_status(status))
+        self.assertEqual({}, status["node_status"][1]["gpu_used"])
+
+    def test_node_events(self):
+        aggregator = self.create_aggregator()
+        # pods move to the new gpu type
+        aggregator.on_node_event("MODIFIED", make_node("node1", gpu_type="V100"))
+        status = aggregator.get_status()
+        self.assertEqual({"user": {"V100": 2, "P40": 1}, "other": {"V100": 0}}, user_status(status))
+
+        aggregator.on_node_event("DELETED", make_node("node1"))
+        status = aggregator.get_status()
+        self.assertEqual({"P40": 1}, status["gpu_used"])
+        self.assertEqual({"user": {"P40": 1}}, user_status(status))
+
+        # pods of a node seen again are accounted
+        aggregator.on_node_event("ADDED", make_node("node1"))
+        self.assertEqual({"P40": 3}, aggregator.get_status()["gpu_used"])
+
+    def test_pending_since(self):
+        aggregator = self.create_aggregator()
+        self.assertIsNotNone(aggregator.take_pending_since())
+        self.assertIsNone(aggregator.take_pending_since())
+
+        # nothing accounted changed
+        aggregator.on_node_event("MODIFIED", make_node("node1"))
+        aggregator.on_pod_event("MODIFIED", make_pod("pod1", "node1", gpus=2))
+        self.assertIsNone(aggregator.take_pending_since())
+        self.assertFalse(aggregator.changed.is_set())
+
+        aggregator.on_pod_event("ADDED", make_pod("pod4", "node1"))
+        self.assertTrue(aggregator.changed.is_set())
+        self.assertIsNotNone(aggregator.take_pending_since())
+
+    def test_relist_removes_gone(self):
+        aggregator = self.create_aggregator()
+        aggregator.on_pod_event("RELIST", [make_pod("pod3", "node2", gpus=1)])
+        aggregator.on_node_event("RELIST", [make_node("node2", unschedulable=True)])
+        status = aggregator.get_status()
+        self.assertEqual(1, len(status["node_status"]))
+        self.assertEqual({"P40": 1}, status["gpu_used"])
+        self.assertEqual({"user": {"P40": 1}}, user_status(status))
+
+    def test_device_information(self):
+        pod = make_pod("pod1", "node1", gpus=1)
+        pod["metadata"]["annotations"] = {"pod.alpha/DeviceInformation": json.dumps(
+            {"runningcontainer": {"pod1": {"requests": {"alpha.gpu/numgpu": "2"}}}})}
+        self.assertEqual(2, parse_pod(pod)["gpus"])
+
+
+class FakePrometheusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.queries.append(urlparse.parse_qs(urlparse.urlparse(self.path).query))
+        if self.server.status != 200:
+            self.send_error(self.server.status)
+            return
+        body = json.dumps({"status": "success", "data": {"resultType": "vector", "result": [
+            {"metric": {"pod_name": pod_name}, "value": [1570000000, str(value)]}
+            for pod_name, value in self.server.usage.items()]}})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestPodGpuUsage(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), FakePrometheusHandler)
+        self.server.queries = []
+        self.server.usage = {"pod1": 12.5, "pod2": 80}
+        self.server.status = 200
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/prometheus" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_one_query_per_pass(self):
+        gpu_usage = PodGpuUsage(self.url, ttl=3600)
+        self.assertEqual(12, gpu_usage.get("pod1"))
+        self.assertEqual(80, gpu_usage.get("pod2"))
+        self.assertIsNone(gpu_usage.get("pod3"))
+        self.assertEqual([{"query": [GPU_USAGE_QUERY]}], self.server.queries)
+
+    def test_expired(self):
+        gpu_usage = PodGpuUsage(self.url, ttl=0)
+        gpu_usage.get("pod1")
+        self.server.usage = {"pod1": 30}
+        self.assertEqual(30, gpu_usage.get("pod1"))
+        self.assertEqual(2, len(self.server.queries))
+
+    def test_failure(self):
+        self.server.status = 500
+        gpu_usage = PodGpuUsage(self.url, ttl=3600)
+        self.assertIsNone(gpu_usage.get("pod1"))
+        self.assertIsNone(gpu_usage.get("pod2"))
+        self.assertEqual(1, len(self.server.queries))
+
+    def test_status(self):
+        aggregator = ClusterStatusAggregator()
+        aggregator.on_node_event("RELIST", [make_node("node1")])
+        aggregator.on_pod_event("RELIST", [make_pod("pod1", "node1"), make_pod("pod2", "node1")])
+        status = aggregator.get_status(PodGpuUsage(self.url, ttl=3600).get)
+        self.assertEqual(["pod1 : user (gpu usage:12%)!!!!!! (gpu #:1)",
+            "pod2 : user (gpu usage:80%) (gpu #:1)"], status["node_status"][0]["pods"])
+        self.assertEqual(1, len(self.server.queries))
+
+
+if __name__ == '__main__':
+    unittest.main()
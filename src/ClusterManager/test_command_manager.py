@@ -0,0 +1,74 @@
+import unittest
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../utils"))
+import command_manager
+from command_manager import CommandRunner
+
+
+def make_command(command_id, job_id):
+    return {"id": command_id, "jobId": job_id, "command": "ls"}
+
+
+class FakeRunCommand(object):
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, command, timeout):
+        self.calls.append(command["id"])
+        return "run", "output of %s" % command["id"], "", 0
+
+
+class FakeSaveCommandResult(object):
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+
+    def __call__(self, command, result):
+        self.calls.append((command["id"], result[1]))
+        return not self.fail
+
+
+class TestCommandRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.run_command = command_manager.RunCommand
+        self.save_result = command_manager.SaveCommandResult
+        self.fake_run = FakeRunCommand()
+        self.fake_save = FakeSaveCommandResult()
+        command_manager.RunCommand = self.fake_run
+        command_manager.SaveCommandResult = self.fake_save
+        self.runner = CommandRunner(pool_size=2, timeout=10)
+        self.runner.start()
+
+    def tearDown(self):
+        command_manager.RunCommand = self.run_command
+        command_manager.SaveCommandResult = self.save_result
+
+    def test_finished_not_submitted_while_pending(self):
+        pending = [make_command(1, "job1"), make_command(2, "job1")]
+        # one command of a job at a time
+        self.assertEqual(1, self.runner.submit_pending(pending))
+        self.runner.queue.join()
+        self.assertEqual(1, self.runner.submit_pending(pending))
+        self.runner.queue.join()
+        self.assertEqual(0, self.runner.submit_pending(pending))
+        self.assertEqual([1, 2], self.fake_run.calls)
+
+    def test_not_saved_saved_again_without_running(self):
+        self.fake_save.fail = True
+        pending = [make_command(1, "job1")]
+        self.assertEqual(1, self.runner.submit_pending(pending))
+        self.runner.queue.join()
+        self.fake_save.fail = False
+        self.assertEqual(1, self.runner.submit_pending(pending))
+        self.runner.queue.join()
+        self.assertEqual(0, self.runner.submit_pending(pending))
+        self.assertEqual([1], self.fake_run.calls)
+        self.assertEqual([(1, "output of 1"), (1, "output of 1")], self.fake_save.calls)
+        self.assertEqual({}, self.runner.unsaved)
+
+
+if __name__ == '__main__':
+    unittest.main()
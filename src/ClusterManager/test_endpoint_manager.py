@@ -0,0 +1,75 @@
+import unittest
+import threading
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../utils"))
+import endpoint_manager
+from endpoint_manager import EndpointSetupPool
+
+
+def make_endpoint(endpoint_id):
+    return {"id": endpoint_id, "name": "ssh", "jobId": "job1", "podName": "job1"}
+
+
+class FakeSetup(object):
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+        # setup blocks until set
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, endpoint, deadline):
+        self.calls.append(endpoint["id"])
+        self.release.wait()
+        if self.fail:
+            raise RuntimeError("setup failed")
+
+
+class TestEndpointSetupPool(unittest.TestCase):
+
+    def setUp(self):
+        self.setup_endpoint = endpoint_manager.setup_endpoint
+        self.fake_setup = FakeSetup()
+        endpoint_manager.setup_endpoint = self.fake_setup
+        self.pool = EndpointSetupPool(pool_size=2, timeout=10)
+        self.pool.start()
+
+    def tearDown(self):
+        self.fake_setup.release.set()
+        endpoint_manager.setup_endpoint = self.setup_endpoint
+
+    def test_in_flight_not_submitted_again(self):
+        self.fake_setup.release.clear()
+        pending = {"e1": make_endpoint("e1"), "e2": make_endpoint("e2")}
+        self.assertEqual(2, self.pool.submit_pending(pending))
+        self.assertEqual(0, self.pool.submit_pending(pending))
+        self.fake_setup.release.set()
+        self.pool.queue.join()
+        self.assertEqual(["e1", "e2"], sorted(self.fake_setup.calls))
+
+    def test_finished_not_submitted_while_pending(self):
+        pending = {"e1": make_endpoint("e1")}
+        self.assertEqual(1, self.pool.submit_pending(pending))
+        self.pool.queue.join()
+        # still pending in a list read before it was marked running
+        self.assertEqual(0, self.pool.submit_pending(pending))
+        # no longer pending, then pending again
+        self.assertEqual(0, self.pool.submit_pending({}))
+        self.assertEqual(1, self.pool.submit_pending(pending))
+        self.pool.queue.join()
+        self.assertEqual(["e1", "e1"], self.fake_setup.calls)
+
+    def test_failed_submitted_again(self):
+        self.fake_setup.fail = True
+        pending = {"e1": make_endpoint("e1")}
+        self.assertEqual(1, self.pool.submit_pending(pending))
+        self.pool.queue.join()
+        self.assertEqual(1, self.pool.submit_pending(pending))
+        self.pool.queue.join()
+        self.assertEqual(["e1", "e1"], self.fake_setup.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
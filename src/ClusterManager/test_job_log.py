@@ -0,0 +1,81 @@
+import unittest
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import job_log
+from job_log import normalize_timestamp, since_seconds, parse_log, select_new_lines, read_tail_lines, trimmed_log, JobLogCursor
+
+
+class TestJobLog(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_normalize_timestamp(self):
+        self.assertEqual("2019-10-10T01:02:03.120000000Z", normalize_timestamp("2019-10-10T01:02:03.12Z"))
+        self.assertEqual("2019-10-10T01:02:03.000000000Z", normalize_timestamp("2019-10-10T01:02:03Z"))
+        self.assertTrue(normalize_timestamp("2019-10-10T01:02:03.1234Z") <
+                normalize_timestamp("2019-10-10T01:02:03.123456789Z"))
+
+    def test_since_seconds(self):
+        self.assertEqual(10 + job_log.SINCE_OVERLAP_SECONDS,
+                since_seconds("2019-10-10T01:02:03.500000000Z", datetime(2019, 10, 10, 1, 2, 13)))
+
+    def test_parse_log(self):
+        lines = parse_log("2019-10-10T01:02:03.1Z hello world\n2019-10-10T01:02:04Z \n2019-10-10T01:02:05Z no newline")
+        self.assertEqual([
+            ("2019-10-10T01:02:03.100000000Z", "hello world\n"),
+            ("2019-10-10T01:02:04.000000000Z", "\n"),
+            ("2019-10-10T01:02:05.000000000Z", "no newline"),
+            ], lines)
+
+    def test_select_new_lines(self):
+        lines = [("t1", "a\n"), ("t2", "b\n"), ("t2", "c\n"), ("t3", "d\n")]
+        self.assertEqual((["a\n", "b\n", "c\n", "d\n"], "t3", 1), select_new_lines(lines, None, 0))
+        self.assertEqual((["c\n", "d\n"], "t3", 1), select_new_lines(lines, "t2", 1))
+        self.assertEqual(([], "t3", 1), select_new_lines(lines, "t3", 1))
+
+        more = lines + [("t3", "e\n"), ("t3", "f\n")]
+        self.assertEqual((["e\n", "f\n"], "t3", 3), select_new_lines(more, "t3", 1))
+
+    def test_read_tail_lines(self):
+        path = os.path.join(self.dir, "log.txt")
+        with open(path, "w") as f:
+            f.write("".join(["line %d\n" % i for i in range(1000)]))
+        self.assertEqual(["line 997\n", "line 998\n", "line 999\n"], read_tail_lines(path, 3, block_size=7))
+        self.assertEqual(1000, len(read_tail_lines(path, 2000, block_size=100)))
+
+    def test_trimmed_log(self):
+        path = os.path.join(self.dir, "log.txt")
+        with open(path, "w") as f:
+            f.write("".join(["line %d\n" % i for i in range(job_log.DB_FULL_LINES)]))
+        log = trimmed_log("pod1", path)
+        self.assertNotIn("line 999\n", log)
+        self.assertIn("line %d\n" % (job_log.DB_FULL_LINES - job_log.DB_TAIL_LINES), log)
+        self.assertIn("Only the last", log)
+
+        with open(path, "w") as f:
+            f.write("short\n")
+        self.assertIn("short\n", trimmed_log("pod1", path))
+        self.assertNotIn("Only the last", trimmed_log("pod1", path))
+
+    def test_cursor(self):
+        with JobLogCursor(self.dir) as cursor:
+            self.assertTrue(cursor.is_new)
+            cursor.pods["pod1"] = {"containerID": "c1", "path": "p", "since": "t1", "count": 2}
+            cursor.last_pod = "pod1"
+            cursor.save()
+
+        with JobLogCursor(self.dir) as cursor:
+            self.assertFalse(cursor.is_new)
+            self.assertEqual(2, cursor.pods["pod1"]["count"])
+            self.assertEqual("pod1", cursor.last_pod)
+
+
+if __name__ == '__main__':
+    unittest.main()
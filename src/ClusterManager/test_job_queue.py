@@ -0,0 +1,163 @@
+import unittest
+import json
+import base64
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../utils"))
+from job_queue import JobQueue
+
+
+def make_job(job_id, status, job_time, gpu=1, gpu_type="P40", preemptible=False, vc_name="platform"):
+    job_params = {
+        "jobId": job_id,
+        "resourcegpu": gpu,
+        "preemptionAllowed": preemptible,
+    }
+    if gpu_type is not None:
+        job_params["gpuType"] = gpu_type
+    return {
+        "jobId": job_id,
+        "jobStatus": status,
+        "jobTime": job_time,
+        "vcName": vc_name,
+        "jobParams": base64.b64encode(json.dumps(job_params)),
+    }
+
+
+class FakeDataHandler(object):
+    def __init__(self, jobs):
+        self.jobs = dict((job["jobId"], job) for job in jobs)
+        self.full_loads = 0
+        self.fetched_ids = []
+
+    def GetJobList(self, userName, vcName, num=None, status=None, op=("=", "or")):
+        self.full_loads += 1
+        status_list = status.split(",")
+        return [dict(job) for job in self.jobs.values() if job["jobStatus"] in status_list]
+
+    def GetJobStatuses(self, status):
+        status_list = status.split(",")
+        return dict((job_id, job["jobStatus"]) for job_id, job in self.jobs.items()
+                if job["jobStatus"] in status_list)
+
+    def GetJobsByIds(self, job_ids):
+        self.fetched_ids.extend(job_ids)
+        return [dict(self.jobs[job_id]) for job_id in job_ids]
+
+
+def job_ids(queue):
+    return [entry["jobId"] for entry in queue.sorted_entries()]
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def test_order(self):
+        queue = JobQueue()
+        queue.reset([
+            make_job("queued-early", "queued", "2019-01-01 00:00:01"),
+            make_job("preemptible", "running", "2019-01-01 00:00:00", preemptible=True),
+            make_job("queued-late", "queued", "2019-01-01 00:00:02"),
+            make_job("running", "running", "2019-01-01 00:00:03"),
+            make_job("scheduling", "scheduling", "2019-01-01 00:00:04"),
+        ])
+        self.assertEqual(["running", "scheduling", "queued-early", "queued-late", "preemptible"],
+                job_ids(queue))
+
+    def test_priority(self):
+        queue = JobQueue()
+        queue.reset([
+            make_job("a", "queued", "2019-01-01 00:00:01"),
+            make_job("b", "queued", "2019-01-01 00:00:02"),
+        ])
+        queue.set_priorities({"b": 200})
+        self.assertEqual(["b", "a"], job_ids(queue))
+
+        queue.set_priorities({})
+        self.assertEqual(["a", "b"], job_ids(queue))
+
+    def test_apply_removes_finished_job(self):
+        queue = JobQueue()
+        queue.reset([
+            make_job("a", "running", "2019-01-01 00:00:01"),
+            make_job("b", "queued", "2019-01-01 00:00:02"),
+        ])
+        queue.apply([make_job("a", "finished", "2019-01-01 00:00:01")])
+        self.assertEqual(["b"], job_ids(queue))
+        self.assertFalse("a" in queue)
+
+    def test_vc_usage(self):
+        queue = JobQueue()
+        queue.reset([
+            make_job("a", "running", "2019-01-01 00:00:01", gpu=2),
+            make_job("b", "scheduling", "2019-01-01 00:00:02", gpu=1),
+            make_job("c", "queued", "2019-01-01 00:00:03", gpu=4),
+            make_job("d", "running", "2019-01-01 00:00:04", gpu_type=None),
+        ])
+        vc_usage = queue.get_vc_usage()
+        self.assertEqual(3, vc_usage["platform"]["P40"])
+        self.assertEqual(1, len(vc_usage))
+
+    def test_scheduling_columns(self):
+        job = make_job("a", "running", "2019-01-01 00:00:01")
+        job["jobParams"] = "not used when columns are filled"
+        job.update({"gpuType": "K80", "totalGpu": 8, "preemptionAllowed": 0})
+        queue = JobQueue()
+        queue.reset([job])
+        self.assertEqual(8, queue.get_vc_usage()["platform"]["K80"])
+        self.assertFalse(queue.entries["a"]["preemptionAllowed"])
+
+    def test_invalid_job_params_is_skipped(self):
+        job = make_job("a", "queued", "2019-01-01 00:00:01")
+        job["jobParams"] = "not base64 json"
+        queue = JobQueue()
+        queue.reset([job, make_job("b", "queued", "2019-01-01 00:00:02")])
+        self.assertEqual(["b"], job_ids(queue))
+
+    def test_refresh_fetches_changed_jobs_only(self):
+        data_handler = FakeDataHandler([
+            make_job("a", "running", "2019-01-01 00:00:01"),
+            make_job("b", "queued", "2019-01-01 00:00:02"),
+            make_job("c", "queued", "2019-01-01 00:00:03"),
+        ])
+        queue = JobQueue(resync_interval=3600)
+        queue.refresh(data_handler)
+        self.assertEqual(1, data_handler.full_loads)
+        self.assertEqual(["a", "b", "c"], job_ids(queue))
+
+        data_handler.jobs["a"]["jobStatus"] = "finished"
+        data_handler.jobs["b"]["jobStatus"] = "scheduling"
+        data_handler.jobs["d"] = make_job("d", "queued", "2019-01-01 00:00:04")
+        queue.refresh(data_handler)
+
+        self.assertEqual(1, data_handler.full_loads)
+        self.assertEqual(["b", "d"], sorted(data_handler.fetched_ids))
+        self.assertEqual(["b", "c", "d"], job_ids(queue))
+        self.assertEqual("scheduling", queue.entries["b"]["job"]["jobStatus"])
+
+    def test_refresh_resyncs_after_failure(self):
+        data_handler = FakeDataHandler([make_job("a", "queued", "2019-01-01 00:00:01")])
+        queue = JobQueue(resync_interval=3600)
+        queue.refresh(data_handler)
+
+        def broken(job_ids):
+            raise Exception("db is down")
+        data_handler.jobs["b"] = make_job("b", "queued", "2019-01-01 00:00:02")
+        data_handler.GetJobsByIds = broken
+        self.assertRaises(Exception, queue.refresh, data_handler)
+
+        queue.refresh(data_handler)
+        self.assertEqual(2, data_handler.full_loads)
+        self.assertEqual(["a", "b"], job_ids(queue))
+
+    def test_zero_resync_interval_always_reloads(self):
+        data_handler = FakeDataHandler([make_job("a", "queued", "2019-01-01 00:00:01")])
+        queue = JobQueue(resync_interval=0)
+        queue.refresh(data_handler)
+        queue.refresh(data_handler)
+        self.assertEqual(2, data_handler.full_loads)
+        self.assertEqual([], data_handler.fetched_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
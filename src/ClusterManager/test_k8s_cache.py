@@ -0,0 +1,102 @@
+import unittest
+import time
+import os
+
+from kubernetes import client
+from k8s_cache import K8sObjectCache
+
+
+def make_pod(name, resource_version, **labels):
+    return client.V1Pod(metadata=client.V1ObjectMeta(name=name,
+        labels=labels, resource_version=str(resource_version)))
+
+
+class FakeLister(object):
+    def __init__(self, pods, resource_version):
+        self.pods = pods
+        self.resource_version = resource_version
+
+    def __call__(self, namespace, **kwargs):
+        return client.V1PodList(items=self.pods,
+                metadata=client.V1ListMeta(resource_version=str(self.resource_version)))
+
+
+def names(objs):
+    return sorted([obj.metadata.name for obj in objs])
+
+
+class TestK8sObjectCache(unittest.TestCase):
+
+    def create_cache(self):
+        lister = FakeLister([
+            make_pod("job1-ps0", 1, run="job1", jobId="job1", podName="job1-ps0"),
+            make_pod("job1-worker0", 2, run="job1", jobId="job1", podName="job1-worker0"),
+            make_pod("job2", 3, run="job2", jobId="job2", podName="job2"),
+        ], 3)
+        cache = K8sObjectCache("test-pod", lister)
+        cache._relist()
+        return cache
+
+    def test_list_by_selector(self):
+        cache = self.create_cache()
+        self.assertEqual(["job1-ps0", "job1-worker0", "job2"], names(cache.list()))
+        self.assertEqual(["job1-ps0", "job1-worker0"], names(cache.list(label_selector="run=job1")))
+        self.assertEqual(["job2"], names(cache.list(label_selector="podName=job2")))
+        self.assertEqual(["job2"], names(cache.list(field_selector="metadata.name=job2")))
+        self.assertEqual([], names(cache.list(field_selector="metadata.name=job2",
+            label_selector="run=job1")))
+        self.assertEqual([], cache.list(label_selector="run=job3"))
+        self.assertEqual("3", cache.resource_version)
+
+    def test_unsupported_selector(self):
+        cache = self.create_cache()
+        self.assertIsNone(cache.list(label_selector="userName=user"))
+        self.assertIsNone(cache.list(label_selector="run=job1,jobId=job1"))
+        self.assertIsNone(cache.list(label_selector="run!=job1"))
+        self.assertIsNone(cache.list(field_selector="spec.nodeName=node1"))
+
+    def test_apply_events(self):
+        cache = self.create_cache()
+        cache._apply("ADDED", make_pod("job3", 4, run="job3"))
+        cache._apply("DELETED", make_pod("job1-ps0", 5, run="job1"))
+        # label changed
+        cache._apply("MODIFIED", make_pod("job2", 6, run="job4"))
+
+        self.assertEqual(["job3"], names(cache.list(label_selector="run=job3")))
+        self.assertEqual(["job1-worker0"], names(cache.list(label_selector="run=job1")))
+        self.assertEqual([], cache.list(label_selector="run=job2"))
+        self.assertEqual(["job2"], names(cache.list(label_selector="run=job4")))
+        self.assertIsNone(cache.get("job1-ps0"))
+        self.assertEqual("6", cache.resource_version)
+
+    def test_relist_drops_deleted(self):
+        cache = self.create_cache()
+        cache.list_func = FakeLister([make_pod("job2", 7, run="job2")], 7)
+        cache._relist()
+        self.assertEqual(["job2"], names(cache.list()))
+        self.assertEqual([], cache.list(label_selector="run=job1"))
+
+    def test_handler(self):
+        cache = self.create_cache()
+        events = []
+        cache.add_handler(lambda event_type, obj: events.append((event_type, obj)))
+        cache._apply("ADDED", make_pod("job3", 4, run="job3"))
+        cache._relist()
+        self.assertEqual(["ADDED", "RELIST"], [event_type for event_type, _ in events])
+        self.assertEqual("job3", events[0][1].metadata.name)
+        self.assertEqual(["job1-ps0", "job1-worker0", "job2"], names(events[1][1]))
+
+    def test_is_ready(self):
+        cache = self.create_cache()
+        # not started in this process
+        self.assertFalse(cache.is_ready())
+
+        cache.pid = os.getpid()
+        self.assertTrue(cache.is_ready())
+
+        cache.last_sync = time.time() - cache.max_staleness - 1
+        self.assertFalse(cache.is_ready())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import os
+import sys
+import shutil
+import stat
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../utils"))
+import user_manager
+from user_manager import set_user_directory, UserProvisioner
+
+# writes a fake key pair to the path after -f
+FAKE_SSH_KEYGEN = """#!/bin/sh
+while [ "$1" != "-f" ]; do shift; done
+echo private > "$2"
+echo "ssh-rsa fake" > "$2.pub"
+"""
+
+
+class TestSetUserDirectory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        bin_path = os.path.join(self.tmpdir, "bin")
+        os.mkdir(bin_path)
+        ssh_keygen = os.path.join(bin_path, "ssh-keygen")
+        with open(ssh_keygen, "w") as f:
+            f.write(FAKE_SSH_KEYGEN)
+        os.chmod(ssh_keygen, 0o755)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = bin_path + os.pathsep + self.path
+        self.gid = user_manager.USER_GID
+        user_manager.USER_GID = os.getgid()
+        self.work_path = os.path.join(self.tmpdir, "work")
+        os.mkdir(self.work_path)
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        user_manager.USER_GID = self.gid
+        shutil.rmtree(self.tmpdir)
+
+    def test_set_user_directory(self):
+        self.assertTrue(set_user_directory("alice", os.getuid(), self.work_path))
+        ssh_path = os.path.join(self.work_path, "alice", ".ssh")
+        with open(os.path.join(ssh_path, "authorized_keys")) as f:
+            self.assertEqual("ssh-rsa fake\n", f.read())
+        self.assertEqual(0o700, stat.S_IMODE(os.stat(os.path.join(ssh_path, "id_rsa")).st_mode))
+        # nothing is missing
+        self.assertFalse(set_user_directory("alice", os.getuid(), self.work_path))
+
+    def test_missing_key_recreated(self):
+        set_user_directory("alice", os.getuid(), self.work_path)
+        os.remove(os.path.join(self.work_path, "alice", ".ssh", "id_rsa"))
+        self.assertTrue(set_user_directory("alice", os.getuid(), self.work_path))
+        self.assertTrue(os.path.exists(os.path.join(self.work_path, "alice", ".ssh", "id_rsa")))
+
+
+class FakeDataHandler(object):
+    def __init__(self, identities):
+        # [(id, identityName, uid)] committed
+        self.identities = identities
+
+    def GetUsersSince(self, lastId, limit=1000):
+        return sorted([identity for identity in self.identities if identity[0] > lastId])[:limit]
+
+
+class TestUserProvisioner(unittest.TestCase):
+
+    def setUp(self):
+        self.set_user_directory = user_manager.set_user_directory
+        self.set_up = []
+        user_manager.set_user_directory = lambda username, userid, work_path: self.set_up.append((username, userid))
+
+    def tearDown(self):
+        user_manager.set_user_directory = self.set_user_directory
+
+    def test_new_users(self):
+        provisioner = UserProvisioner("/work", reconcile_interval=3600, reconcile_batch=100)
+        data_handler = FakeDataHandler([(1, "alice@example.com", 10001)])
+        provisioner.provision(data_handler, now=0)
+        # first reconciliation starts at once
+        self.assertEqual([("alice", 10001), ("alice", 10001)], self.set_up)
+
+        del self.set_up[:]
+        data_handler.identities.append((2, "DOMAIN\\bob", 10002))
+        provisioner.provision(data_handler, now=1)
+        self.assertEqual([("bob", 10002)], self.set_up)
+        self.assertEqual({"alice": 10001, "bob": 10002}, provisioner.users)
+
+    def test_gap_reconciled(self):
+        provisioner = UserProvisioner("/work", reconcile_interval=3600, reconcile_batch=2)
+        data_handler = FakeDataHandler([(1, "alice", 10001), (3, "carol", 10003)])
+        provisioner.provision(data_handler, now=0)
+        provisioner.provision(data_handler, now=1)
+        self.assertEqual(3, provisioner.last_id)
+        self.assertIsNone(provisioner.reconcile_id)
+
+        # committed after id 3 was seen, and a changed uid
+        del self.set_up[:]
+        data_handler.identities = [(1, "alice", 20001), (2, "bob", 10002), (3, "carol", 10003)]
+        provisioner.provision(data_handler, now=2)
+        self.assertEqual([], self.set_up)
+
+        provisioner.provision(data_handler, now=3600)
+        provisioner.provision(data_handler, now=3601)
+        self.assertEqual([("alice", 20001), ("bob", 10002), ("carol", 10003)], self.set_up)
+        self.assertEqual({"alice": 20001, "bob": 10002, "carol": 10003}, provisioner.users)
+        self.assertIsNone(provisioner.reconcile_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
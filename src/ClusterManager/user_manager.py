@@ -6,6 +6,7 @@ import uuid
 import subprocess
 import sys
 import datetime
+import errno
 
 import yaml
 from jinja2 import Environment, FileSystemLoader, Template
@@ -28,9 +29,6 @@ from multiprocessing import Process, Manager
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"../storage"))
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"../utils"))
 
-from jobs_tensorboard import GenTensorboardMeta
-import k8sUtils
-
 from config import config
 from DataHandler import DataHandler
 
@@ -47,50 +45,153 @@ def create_log(logdir = '/var/log/dlworkspace'):
         logging.config.dictConfig(logging_config)
 
 
-def set_user_directory():
-    dataHandler = DataHandler()
-    users = dataHandler.GetUsers()
-    for username,userid in users:
-        if "@" in username:
-            username = username.split("@")[0]
-        if "/" in username:
-            username = username.split("/")[1]
-        if "\\" in username:
-            username = username.split("\\")[1]    
-        userpath = os.path.join(config["storage-mount-path"],"work/"+username)
-        if not os.path.exists(userpath):
-            logging.info("Found a new user %s" %username)
-            logging.info("Creating home directory %s for user %s" % (userpath, username))
-            os.system("mkdir -p "+userpath)
-            os.system("chown -R "+str(userid)+":"+"500000513 "+userpath)
-
-        sshkeypath = os.path.join(userpath,".ssh/id_rsa")
-        pubkeypath = os.path.join(userpath,".ssh/id_rsa.pub")
-        authorized_keyspath = os.path.join(userpath,".ssh/authorized_keys")
-        if not os.path.exists(sshkeypath):
-            logging.info("Creating sshkey for user %s" % (username))
-            os.system("mkdir -p "+os.path.dirname(sshkeypath))
-            os.system("ssh-keygen -t rsa -b 4096 -f %s -P ''" % sshkeypath)
-            os.system("chown -R "+str(userid)+":"+"500000513 "+userpath)
-            os.system("chmod 700 -R "+os.path.dirname(sshkeypath))
-
-        if not os.path.exists(authorized_keyspath):
-            logging.info("Creating authorized_keys for user %s" % (username))
-            os.system("chown -R "+str(userid)+":"+"500000513 "+authorized_keyspath)
-            os.system("cat "+pubkeypath+" >> "+authorized_keyspath)
-            os.system("chmod 644 "+authorized_keyspath)
-
-def Run():
+# group of home directories and ssh keys of users
+USER_GID = 500000513
+
+# identities read from db at a time
+USERS_BATCH = 1000
+
+
+def get_home_name(identity_name):
+    """ Name of home directory of an identity such as domain\\alias or
+    alias@domain """
+    if "@" in identity_name:
+        identity_name = identity_name.split("@")[0]
+    if "/" in identity_name:
+        identity_name = identity_name.split("/")[1]
+    if "\\" in identity_name:
+        identity_name = identity_name.split("\\")[1]
+    return identity_name
+
+
+def makedirs(path):
+    """ Returns True if the directory is created """
+    try:
+        os.makedirs(path)
+        return True
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return False
+
+
+def set_user_directory(username, userid, work_path):
+    """ Creates home directory, ssh key and authorized_keys of a user when
+    they are missing. Returns True if anything is created. """
+    created = False
+    userpath = os.path.join(work_path, username)
+    if makedirs(userpath):
+        logging.info("Creating home directory %s for user %s", userpath, username)
+        os.chown(userpath, userid, USER_GID)
+        created = True
+
+    sshpath = os.path.join(userpath, ".ssh")
+    sshkeypath = os.path.join(sshpath, "id_rsa")
+    pubkeypath = os.path.join(sshpath, "id_rsa.pub")
+    authorized_keyspath = os.path.join(sshpath, "authorized_keys")
+    if not os.path.exists(sshkeypath):
+        logging.info("Creating sshkey for user %s", username)
+        makedirs(sshpath)
+        # an incomplete key pair left by a failed run
+        for path in [sshkeypath, pubkeypath]:
+            if os.path.exists(path):
+                os.remove(path)
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(["ssh-keygen", "-q", "-t", "rsa", "-b", "4096", "-f", sshkeypath, "-P", ""],
+                    stdout=devnull)
+        for path in [sshpath, sshkeypath, pubkeypath]:
+            os.chown(path, userid, USER_GID)
+            os.chmod(path, 0o700)
+        created = True
+
+    if not os.path.exists(authorized_keyspath):
+        logging.info("Creating authorized_keys for user %s", username)
+        with open(pubkeypath) as f:
+            pubkey = f.read()
+        fd = os.open(authorized_keyspath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        with os.fdopen(fd, "w") as f:
+            f.write(pubkey)
+        os.chown(authorized_keyspath, userid, USER_GID)
+        os.chmod(authorized_keyspath, 0o644)
+        created = True
+    return created
+
+
+class UserProvisioner(object):
+    """ Sets up directories of identities added since the last one seen,
+    which is a cheap query by primary key, so the shared storage is only
+    touched for new users. Every reconcile_interval seconds all identities
+    are read again from db, reconcile_batch of them per call of provision,
+    to cover ids committed after a larger one was seen, changed uids, and
+    directories removed or failed to set up. """
+    def __init__(self, work_path, reconcile_interval=3600, reconcile_batch=100):
+        self.work_path = work_path
+        self.reconcile_interval = reconcile_interval
+        self.reconcile_batch = reconcile_batch
+        self.last_id = 0
+        # username -> uid of all users seen
+        self.users = {}
+        # id of the last identity reconciled, None if not reconciling
+        self.reconcile_id = None
+        self.next_reconcile = 0
+
+    def set_up(self, username, userid):
+        try:
+            set_user_directory(username, userid, self.work_path)
+        except Exception:
+            logging.exception("set user directory of %s failed", username)
+
+    def update_user(self, identity_name, uid):
+        username = get_home_name(identity_name)
+        if username not in self.users:
+            logging.info("Found a new user %s", username)
+        elif self.users[username] != uid:
+            logging.info("Uid of user %s changed from %s to %s", username, self.users[username], uid)
+        self.users[username] = uid
+        self.set_up(username, uid)
+
+    def provision(self, data_handler, now=None):
+        if now is None:
+            now = time.time()
+        while True:
+            users = data_handler.GetUsersSince(self.last_id, USERS_BATCH)
+            for id, identity_name, uid in users:
+                self.update_user(identity_name, uid)
+                self.last_id = id
+            if len(users) < USERS_BATCH:
+                break
+
+        if self.reconcile_id is None and now >= self.next_reconcile:
+            self.reconcile_id = 0
+            self.next_reconcile = now + self.reconcile_interval
+        if self.reconcile_id is not None:
+            users = data_handler.GetUsersSince(self.reconcile_id, self.reconcile_batch)
+            for id, identity_name, uid in users:
+                self.update_user(identity_name, uid)
+                self.reconcile_id = id
+            if len(users) < self.reconcile_batch:
+                logging.info("Reconciled directories of %d users", len(self.users))
+                self.reconcile_id = None
+
+
+def Run(reconcile_interval, reconcile_batch):
     register_stack_trace_dump()
     create_log()
     logging.info("start to update user directory...")
 
+    provisioner = UserProvisioner(os.path.join(config["storage-mount-path"], "work"),
+            reconcile_interval, reconcile_batch)
+
     while True:
         update_file_modification_time("user_manager")
 
         with manager_iteration_histogram.labels("user_manager").time():
             try:
-                set_user_directory()
+                dataHandler = DataHandler()
+                try:
+                    provisioner.provision(dataHandler)
+                finally:
+                    dataHandler.Close()
             except Exception as e:
                 logging.exception("set user directory failed")
         time.sleep(1)
@@ -99,7 +200,9 @@ def Run():
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", "-p", help="port of exporter", type=int, default=9201)
+    parser.add_argument("--reconcile_interval", help="seconds between checks of directories of all users", type=int, default=3600)
+    parser.add_argument("--reconcile_batch", help="number of users checked per second in a reconciliation", type=int, default=100)
     args = parser.parse_args()
     setup_exporter_thread(args.port)
 
-    Run()
+    Run(args.reconcile_interval, args.reconcile_batch)
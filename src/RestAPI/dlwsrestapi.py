@@ -4,10 +4,11 @@ import os
 
 from flask import Flask, Response
 from flask_restful import reqparse, abort, Api, Resource
-from flask import request, jsonify
+from flask import request, jsonify, g
 import base64
 import yaml
 import uuid
+import hashlib
 
 import logging
 import timeit
@@ -22,6 +23,7 @@ from config import config
 from config import global_vars
 import authorization
 from DataHandler import DataHandler
+from job_params import DecodeJobParams
 
 import time
 import sys
@@ -29,9 +31,16 @@ import traceback
 import threading
 
 import prometheus_client
+from prometheus_client import multiprocess, Histogram
 
 CONTENT_TYPE_LATEST = str("text/plain; version=0.0.4; charset=utf-8")
 
+request_histogram = Histogram("restfulapi_request_latency_seconds",
+        "latency for serving a request of restful api (seconds)",
+        buckets=(.01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0,
+            7.5, 10.0, 12.5, 15.0, 17.5, 20.0, float("inf")),
+        labelnames=("resource", "method", "status"))
+
 dir_path = os.path.dirname(os.path.realpath(__file__))
 with open(os.path.join(dir_path, 'logging.yaml'), 'r') as f:
     logging_config = yaml.load(f)
@@ -40,6 +49,23 @@ logger = logging.getLogger('restfulapi')
 
 app = Flask(__name__)
 api = Api(app)
+
+
+@app.before_request
+def start_request_timer():
+    g.start_time = timeit.default_timer()
+
+
+@app.after_request
+def observe_request_latency(response):
+    start_time = g.get("start_time")
+    if start_time is not None:
+        # rule instead of path, so that there is one series per resource
+        resource = request.url_rule.rule if request.url_rule is not None else "unknown"
+        request_histogram.labels(resource, request.method, str(response.status_code)).observe(
+                timeit.default_timer() - start_time)
+    return response
+
 verbose = True
 logger.info( "------------------- Restful API started ------------------------------------- ")
 logger.info("%s", config)
@@ -326,6 +352,10 @@ class ListJobs(Resource):
         parser.add_argument('num')
         parser.add_argument('vcName')
         parser.add_argument('jobOwner')
+        # comma separated job fields, e.g. jobName,userName for list views
+        parser.add_argument('fields')
+        # meta.nextCursor of previous page, to get next page of finished jobs
+        parser.add_argument('cursor')
         args = parser.parse_args()
         num = None
         if args["num"] is not None:
@@ -333,7 +363,23 @@ class ListJobs(Resource):
                 num = int(args["num"])
             except:
                 pass
-        jobs = JobRestAPIUtils.GetJobList(args["userName"], args["vcName"], args["jobOwner"], num)
+        fields = None
+        if args["fields"] is not None:
+            fields = [field for field in args["fields"].split(",") if len(field) > 0]
+        try:
+            jobs, nextCursor = JobRestAPIUtils.GetJobListPage(args["userName"], args["vcName"], args["jobOwner"], num,
+                    fields=fields, cursor=args["cursor"])
+        except ValueError as e:
+            abort(400, message=str(e))
+
+        # raw rows decide the response, so portal polling an unchanged page
+        # gets 304 without decoding and serializing jobs again
+        etag = hashlib.md5(repr(([sorted(job.items()) for job in jobs], nextCursor))).hexdigest()
+        if etag in request.if_none_match:
+            resp = Response(status=304)
+            resp.set_etag(etag)
+            resp.headers["Access-Control-Allow-Origin"] = "*"
+            return resp
 
         jobList = []
         queuedJobs = []
@@ -344,10 +390,8 @@ class ListJobs(Resource):
             job.pop("jobDescriptionPath",None)
             job.pop("jobDescription",None)
 
-            job["jobParams"] = json.loads(base64.b64decode(job["jobParams"]))
-
-            if "endpoints" in job and job["endpoints"] is not None and len(job["endpoints"].strip()) > 0:
-                job["endpoints"] = json.loads(job["endpoints"])
+            if "jobParams" in job:
+                job["jobParams"] = DecodeJobParams(job)
 
             if "jobStatusDetail" in job and job["jobStatusDetail"] is not None and len(job["jobStatusDetail"].strip()) > 0:
                 try:
@@ -374,8 +418,9 @@ class ListJobs(Resource):
         ret["runningJobs"] = runningJobs
         ret["finishedJobs"] = finishedJobs
         ret["visualizationJobs"] = visualizationJobs
-        ret["meta"] = {"queuedJobs": len(queuedJobs),"runningJobs": len(runningJobs),"finishedJobs": len(finishedJobs),"visualizationJobs": len(visualizationJobs)}
+        ret["meta"] = {"queuedJobs": len(queuedJobs),"runningJobs": len(runningJobs),"finishedJobs": len(finishedJobs),"visualizationJobs": len(visualizationJobs),"nextCursor": nextCursor}
         resp = jsonify(ret)
+        resp.set_etag(etag)
         resp.headers["Access-Control-Allow-Origin"] = "*"
         resp.headers["dataType"] = "json"
 
@@ -545,18 +590,37 @@ api.add_resource(GetCommands, '/GetCommands')
 
 
 
+class ScheduleExplain(Resource):
+    def get(self, jobId):
+        parser = reqparse.RequestParser()
+        parser.add_argument('userName')
+        args = parser.parse_args()
+        code, ret = JobRestAPIUtils.GetScheduleExplain(args["userName"], jobId)
+        resp = jsonify(ret)
+        resp.status_code = code
+        resp.headers["Access-Control-Allow-Origin"] = "*"
+        resp.headers["dataType"] = "json"
+
+        return resp
+##
+## Actually setup the Api resource routing here
+##
+api.add_resource(ScheduleExplain, '/jobs/<jobId>/schedule-explain')
+
+
+
 class GetJobDetail(Resource):
     def get(self):
         parser = reqparse.RequestParser()
         parser.add_argument('jobId')
         parser.add_argument('userName')
+        # bytes of log to return, from the end of log
+        parser.add_argument('tail', type=int)
         args = parser.parse_args()
         jobId = args["jobId"]
         userName = args["userName"]
-        job = JobRestAPIUtils.GetJobDetail(userName, jobId)
-        job["jobParams"] = json.loads(base64.b64decode(job["jobParams"]))
-        if "endpoints" in job and job["endpoints"] is not None and len(job["endpoints"].strip()) > 0:
-            job["endpoints"] = json.loads(job["endpoints"])
+        job = JobRestAPIUtils.GetJobDetail(userName, jobId, args["tail"])
+        job["jobParams"] = DecodeJobParams(job)
         if "jobStatusDetail" in job and job["jobStatusDetail"] is not None and len(job["jobStatusDetail"].strip()) > 0:
             try:
                 job["jobStatusDetail"] = Json.loads(base64.b64decode(job["jobStatusDetail"]))
@@ -1016,12 +1080,7 @@ class Endpoint(Resource):
 
         vc_admin = AuthorizationManager.HasAccess(username, ResourceType.VC, job["vcName"], Permission.Admin)
         if job["userName"] == username or vc_admin:
-            try:
-                endpoints = json.loads(job["endpoints"])
-            except:
-                endpoints = {}
-
-            for [_, endpoint] in endpoints.items():
+            for [_, endpoint] in job["endpoints"].items():
                 ret = {
                     "id": endpoint["id"],
                     "name": endpoint["name"],
@@ -1074,7 +1133,7 @@ class Endpoint(Resource):
             logger.error(msg)
             return msg, 403
 
-        job_params = json.loads(base64.b64decode(job["jobParams"]))
+        job_params = DecodeJobParams(job)
         job_type = job_params["jobtrainingtype"]
 
         # get pods
@@ -1110,15 +1169,14 @@ class Endpoint(Resource):
 
         endpoints = {}
 
-        def endpoint_exist(endpoint_id):
-            try:
-                curr_endpoints = json.loads(job["endpoints"])
-            except:
-                curr_endpoints = {}
+        data_handler = DataHandler()
+        try:
+            curr_endpoints = data_handler.GetJobEndpoints(job_id)
+        finally:
+            data_handler.Close()
 
-            if endpoint_id in curr_endpoints:
-                return True
-            return False
+        def endpoint_exist(endpoint_id):
+            return endpoint_id in curr_endpoints
 
         if "ssh" in requested_endpoints:
             # setup ssh for each pod
@@ -1377,6 +1435,11 @@ api.add_resource(JobPriority, '/jobs/priorities')
 
 @app.route("/metrics")
 def metrics():
+    if "prometheus_multiproc_dir" in os.environ:
+        # served by several processes, merge metrics of all of them
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(prometheus_client.generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
     return Response(prometheus_client.generate_latest(), mimetype=CONTENT_TYPE_LATEST)
 
 if __name__ == '__main__':
@@ -0,0 +1,136 @@
+""" Drives concurrent requests against a restful api and prints latency of
+each resource.
+
+Against a local mysql stand-in, e.g.
+
+    docker run -d -p 3306:3306 -e MYSQL_ROOT_PASSWORD=test mysql:5.7
+
+point mysql in utils/config.yaml to it, seed jobs, start the api in the
+restfulapi image (or `python dlwsrestapi.py` for the development server)
+and run
+
+    python load_test.py --seed_jobs 10000 --url http://localhost:5000 --concurrency 50 --duration 60
+
+Per resource latency seen by the server is also in
+restfulapi_request_latency_seconds of /metrics.
+"""
+import argparse
+import random
+import threading
+import time
+import uuid
+
+import requests
+
+# (resource, weight), roughly what portal, reaper and cli send
+REQUEST_MIX = [
+    ("/ListJobs", 6),
+    ("/GetJobDetail", 3),
+    ("/GetVC", 1),
+]
+
+
+def seed_jobs(count, users, vcs):
+    """ Adds jobs to db in config, returns their jobIds """
+    import os
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../utils"))
+    from DataHandler import DataHandler
+
+    data_handler = DataHandler()
+    job_ids = []
+    try:
+        for i in range(count):
+            job_id = str(uuid.uuid4())
+            data_handler.AddJob({
+                "jobId": job_id,
+                "familyToken": str(uuid.uuid4()),
+                "isParent": 1,
+                "jobName": "load-test-%d" % i,
+                "userName": random.choice(users),
+                "vcName": random.choice(vcs),
+                "jobType": "training",
+                "resourcegpu": random.choice([0, 1, 2, 4, 8]),
+                "gpuType": "P40",
+                "preemptionAllowed": False,
+                "userId": 10000,
+                "jobtrainingtype": "RegularJob",
+            })
+            job_ids.append(job_id)
+    finally:
+        data_handler.Close()
+    return job_ids
+
+
+def build_request(resource, args, job_ids):
+    params = {"userName": random.choice(args.users)}
+    vc_name = random.choice(args.vcs)
+    if resource == "/ListJobs":
+        params.update({"vcName": vc_name, "jobOwner": params["userName"], "num": 100})
+    elif resource == "/GetJobDetail":
+        params["jobId"] = random.choice(job_ids) if job_ids else str(uuid.uuid4())
+    elif resource == "/GetVC":
+        params["vcName"] = vc_name
+    return params
+
+
+def worker(args, job_ids, deadline, results, lock):
+    session = requests.Session()
+    resources = [resource for resource, weight in REQUEST_MIX for _ in range(weight)]
+    while time.time() < deadline:
+        resource = random.choice(resources)
+        params = build_request(resource, args, job_ids)
+        start = time.time()
+        try:
+            resp = session.get(args.url + resource, params=params, timeout=args.timeout)
+            ok = resp.status_code == 200
+        except Exception:
+            ok = False
+        elapsed = time.time() - start
+        with lock:
+            results.setdefault(resource, []).append((elapsed, ok))
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(int(len(sorted_values) * p), len(sorted_values) - 1)]
+
+
+def main(args):
+    job_ids = []
+    if args.seed_jobs > 0:
+        job_ids = seed_jobs(args.seed_jobs, args.users, args.vcs)
+        print "seeded %d jobs" % len(job_ids)
+        if args.seed_only:
+            return
+
+    results = {}
+    lock = threading.Lock()
+    deadline = time.time() + args.duration
+    threads = [threading.Thread(target=worker, args=(args, job_ids, deadline, results, lock))
+            for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print "%-16s %8s %8s %8s %8s %8s %8s" % ("resource", "requests", "errors", "req/s", "p50 ms", "p90 ms", "p99 ms")
+    for resource in sorted(results):
+        latencies = sorted([elapsed for elapsed, _ in results[resource]])
+        errors = len([ok for _, ok in results[resource] if not ok])
+        print "%-16s %8d %8d %8.1f %8.1f %8.1f %8.1f" % (resource, len(latencies), errors,
+                len(latencies) / float(args.duration), percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.9) * 1000, percentile(latencies, 0.99) * 1000)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="load test of restful api")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=int, default=30, help="seconds to send requests")
+    parser.add_argument("--timeout", type=int, default=60, help="seconds to wait for a response")
+    parser.add_argument("--users", default="user1,user2,user3,user4,user5",
+            type=lambda value: value.split(","))
+    parser.add_argument("--vcs", default="platform,vc1,vc2", type=lambda value: value.split(","))
+    parser.add_argument("--seed_jobs", type=int, default=0, help="number of jobs added to db in config first")
+    parser.add_argument("--seed_only", action="store_true")
+    main(parser.parse_args())
@@ -6,6 +6,11 @@ ln -s /RestfulAPI/config.yaml /DLWorkspace/src/utils/config.yaml
 chmod -R 0777 /var/log/apache2
 echo "Change permission on /var/log/apache2"
 
+# metric files of processes from last start
+rm -rf /var/run/dlws-restfulapi-metrics
+mkdir -p /var/run/dlws-restfulapi-metrics
+chown www-data:www-data /var/run/dlws-restfulapi-metrics
+
 #/usr/sbin/apache2ctl -D FOREGROUND
 apachectl start
 sleep infinity
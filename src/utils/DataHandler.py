@@ -19,7 +19,10 @@ class DataManager:
         return ret
 
 
+    # vc list is small and read by every ListVCs, shared by processes of
+    # restful api. Callers copy vcs before changing them.
     @staticmethod
+    @fcache(TTLInSec=30, immutable=True, shared=True)
     def ListVCs():
         dataHandler = DataHandler()
         ret = None
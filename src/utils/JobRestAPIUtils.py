@@ -5,7 +5,6 @@ import argparse
 import uuid
 import subprocess
 import sys
-import collections
 
 from jobs_tensorboard import GenTensorboardMeta
 
@@ -21,15 +20,15 @@ import re
 from config import global_vars
 from authorization import ResourceType, Permission, AuthorizationManager, IdentityManager
 import authorization
-from cache import CacheManager
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"../ClusterManager"))
-from ResourceInfo import ResourceInfo
-import quota
+from job_params import GetJobTotalGpu, GetJobSchedulingFields, JOB_LIST_COLUMNS
+from vc_usage import compute_vc_usage
+from command_channel import PublishCommandAdded
 
 import copy
+import datetime
 import logging
-from cachetools import cached, TTLCache
-from threading import Lock
+import requests
 
 
 DEFAULT_JOB_PRIORITY = 100
@@ -258,34 +257,87 @@ def SubmitJob(jobParamsJsonStr):
 
 
     dataHandler.Close()
-    InvalidateJobListCache(jobParams["vcName"])
     return ret
 
 
 
-def GetJobList(userName, vcName, jobOwner, num=None):
+# always returned by ListJobs, needed to group and page jobs
+JOB_LIST_REQUIRED_FIELDS = ["jobId", "jobStatus", "jobType", "jobTime"]
+
+UNFINISHED_JOB_STATUS = "running,queued,scheduling,unapproved,pausing,paused"
+
+
+def EncodeJobListCursor(job):
+    return base64.urlsafe_b64encode(json.dumps([job["jobTime"].strftime("%Y-%m-%d %H:%M:%S"), job["id"]]))
+
+
+def DecodeJobListCursor(cursor):
+    """ Returns (jobTime, id) of the last job of previous page, raises
+    ValueError if the cursor is malformed """
     try:
-        dataHandler = DataHandler()
-        jobs = []
-        hasAccessOnAllJobs = False
+        jobTime, id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return datetime.datetime.strptime(jobTime, "%Y-%m-%d %H:%M:%S"), int(id)
+    except Exception:
+        raise ValueError("invalid cursor %s" % cursor)
 
-        if AuthorizationManager.HasAccess(userName, ResourceType.VC, vcName, Permission.Collaborator):
-            hasAccessOnAllJobs = True
 
-        if jobOwner != "all" or not hasAccessOnAllJobs:
-            jobs = jobs + GetUserPendingJobs(userName, vcName)
-            jobs = jobs + dataHandler.GetJobList(userName,vcName,num, "running,queued,scheduling,unapproved,pausing,paused", ("<>","and"))
-        else:
-            jobs = GetUserPendingJobs(jobOwner, vcName)
+def GetJobList(userName, vcName, jobOwner, num=None):
+    jobs, _ = GetJobListPage(userName, vcName, jobOwner, num)
+    return jobs
 
-        for job in jobs:
-            job.pop('jobMeta', None)
-        dataHandler.Close()
-        return jobs
+
+def GetJobListPage(userName, vcName, jobOwner, num=None, fields=None, cursor=None):
+    """ Returns (jobs, nextCursor). Unfinished jobs are only returned by the
+    first page (cursor is None), finished jobs are paged by (jobTime, id),
+    num jobs a page. fields limits the returned columns, None for all but
+    jobMeta. Raises ValueError for unknown fields or malformed cursor. """
+    if fields is not None:
+        unknown = [field for field in fields if field not in JOB_LIST_COLUMNS]
+        if len(unknown) > 0:
+            raise ValueError("unknown fields %s" % ",".join(unknown))
+        columns = JOB_LIST_REQUIRED_FIELDS + [field for field in fields if field not in JOB_LIST_REQUIRED_FIELDS]
+    else:
+        columns = [column for column in JOB_LIST_COLUMNS if column != "jobMeta"]
+    after = DecodeJobListCursor(cursor) if cursor is not None else None
+
+    try:
+        dataHandler = DataHandler()
+        try:
+            jobs = []
+            finishedJobs = []
+            hasAccessOnAllJobs = False
+
+            if AuthorizationManager.HasAccess(userName, ResourceType.VC, vcName, Permission.Collaborator):
+                hasAccessOnAllJobs = True
+
+            if jobOwner != "all" or not hasAccessOnAllJobs:
+                if after is None:
+                    jobs = jobs + GetUserPendingJobs(userName, vcName)
+                # endpoints are kept in their own table
+                finishedJobs = dataHandler.GetJobList(userName, vcName, num, UNFINISHED_JOB_STATUS, ("<>","and"),
+                        columns=[column for column in columns if column != "endpoints"] + ["id"], after=after)
+                jobs = jobs + finishedJobs
+            elif after is None:
+                jobs = GetUserPendingJobs(jobOwner, vcName)
+
+            if "endpoints" in columns:
+                endpoints = dataHandler.GetEndpointsByJobIds([job["jobId"] for job in jobs])
+                for job in jobs:
+                    job["endpoints"] = endpoints.get(job["jobId"], {})
+        finally:
+            dataHandler.Close()
+
+        nextCursor = None
+        # SQLDataHandler doesn't return id and doesn't support paging
+        if num is not None and num > 0 and len(finishedJobs) == num and "id" in finishedJobs[-1]:
+            nextCursor = EncodeJobListCursor(finishedJobs[-1])
+
+        jobs = [dict([(column, job.get(column)) for column in columns]) for job in jobs]
+        return jobs, nextCursor
     except Exception as e:
         logger.error('Exception: %s', str(e))
         logger.warn("Fail to get job list for user %s, return empty list", userName)
-        return []
+        return [], None
 
 
 def GetUserPendingJobs(userName, vcName):
@@ -321,15 +373,9 @@ def KillJob(userName, jobId):
             else:
                 ret = dataHandler.UpdateJobTextField(jobId,"jobStatus","killing")
     dataHandler.Close()
-    InvalidateJobListCache(jobs[0]["vcName"])
     return ret
 
 
-def InvalidateJobListCache(vcName):
-    CacheManager.Invalidate("GetAllPendingJobs", vcName)
-    DataManager.GetAllPendingJobs(vcName)
-
-
 def AddCommand(userName, jobId,command):
     dataHandler = DataHandler()
     ret = False
@@ -338,6 +384,8 @@ def AddCommand(userName, jobId,command):
         if jobs[0]["userName"] == userName or AuthorizationManager.HasAccess(userName, ResourceType.VC, jobs[0]["vcName"], Permission.Collaborator):
             ret = dataHandler.AddCommand(jobId,command)
     dataHandler.Close()
+    if ret:
+        PublishCommandAdded(jobId)
     return ret
 
 
@@ -349,7 +397,6 @@ def ApproveJob(userName, jobId):
         if AuthorizationManager.HasAccess(userName, ResourceType.VC, jobs[0]["vcName"], Permission.Admin):
             ret = dataHandler.UpdateJobTextField(jobId,"jobStatus","queued")
     dataHandler.Close()
-    InvalidateJobListCache(jobs[0]["vcName"])
     return ret
 
 
@@ -384,7 +431,29 @@ def isBase64(s):
     return False
 
 
-def GetJobDetail(userName, jobId):
+def GetScheduleExplain(userName, jobId):
+    """ Returns (http status, body) of the last scheduling decision about the
+    job, kept by job manager of queued jobs. """
+    dataHandler = DataHandler()
+    try:
+        jobs = dataHandler.GetJob(jobId=jobId)
+    finally:
+        dataHandler.Close()
+    if len(jobs) != 1:
+        return 404, {"error": "job %s not found" % jobId}
+    if jobs[0]["userName"] != userName and not AuthorizationManager.HasAccess(userName, ResourceType.VC, jobs[0]["vcName"], Permission.Collaborator):
+        return 403, {"error": "no access to job %s" % jobId}
+
+    scheduler_url = config.get("job-manager", {}).get("scheduler-url", "http://localhost:9208")
+    try:
+        resp = requests.get("%s/jobs/%s/schedule-explain" % (scheduler_url, jobId), timeout=5)
+        return resp.status_code, resp.json()
+    except Exception as e:
+        logger.warning("failed to get schedule explain of job %s", jobId, exc_info=True)
+        return 503, {"error": "job manager is not available"}
+
+
+def GetJobDetail(userName, jobId, logTail=None):
     job = None
     dataHandler = DataHandler()
     jobs =  dataHandler.GetJob(jobId=jobId)
@@ -404,15 +473,23 @@ def GetJobDetail(userName, jobId):
             #    f.close()
             if "jobDescription" in job:
                 job.pop("jobDescription",None)
+            job["endpoints"] = dataHandler.GetJobEndpoints(jobId)
             try:
-                log = dataHandler.GetJobTextField(jobId,"jobLog")
-                try:
-                    if isBase64(log):
-                        log = base64.b64decode(log)
-                except Exception:
-                    pass
+                log, logSize = dataHandler.GetJobLog(jobId, logTail)
+                if log is None:
+                    # written by older versions
+                    log = dataHandler.GetJobTextField(jobId,"jobLog")
+                    try:
+                        if isBase64(log):
+                            log = base64.b64decode(log)
+                    except Exception:
+                        pass
+                    logSize = len(log) if log is not None else 0
+                    if log is not None and logTail is not None:
+                        log = log[max(logSize - logTail, 0):]
                 if log is not None:
                     job["log"] = log
+                job["logSize"] = logSize
             except:
                 job["log"] = "fail-to-get-logs"
     dataHandler.Close()
@@ -453,6 +530,7 @@ def AddUser(username,uid,gid,groups):
         ret =  dataHandler.UpdateIdentityInfo(username,uid,gid,groups)
         ret = ret & dataHandler.UpdateAclIdentityId(username,uid)
         dataHandler.Close()
+        authorization.acl_cache.invalidate()
     return ret
 
 
@@ -527,108 +605,57 @@ def AddVC(userName, vcName, quota, metadata):
     dataHandler = DataHandler()
     if AuthorizationManager.IsClusterAdmin(userName):
         ret =  dataHandler.AddVC(vcName, quota, metadata)
+        DataManager.ListVCs.invalidate()
     else:
         ret = "Access Denied!"
     dataHandler.Close()
     return ret
 
 
-@cached(cache=TTLCache(maxsize=10240, ttl=1800), lock=Lock())
 def ListVCs(userName):
     ret = []
     vcList =  DataManager.ListVCs()
     for vc in vcList:
         if AuthorizationManager.HasAccess(userName, ResourceType.VC, vc["vcName"], Permission.User):
+            # shared by the cache of DataManager.ListVCs
+            vc = dict(vc)
             vc['admin'] = AuthorizationManager.HasAccess(userName, ResourceType.VC, vc["vcName"], Permission.Admin)
             ret.append(vc)
     # web portal (client) can filter out Default VC
     return ret
 
 
-def GetVC(userName, vcName):
-    ret = None
-
-    data_handler = DataHandler()
-
-    cluster_status, _ = data_handler.GetClusterStatus()
-    cluster_total = cluster_status["gpu_capacity"]
-    cluster_available = cluster_status["gpu_avaliable"]
-    cluster_reserved = cluster_status["gpu_reserved"]
-
-    user_status = collections.defaultdict(lambda : ResourceInfo())
-    user_status_preemptable = collections.defaultdict(lambda : ResourceInfo())
-
-    vc_list =  data_handler.ListVCs()
-    vc_info = {}
-    vc_usage = collections.defaultdict(lambda :
-            collections.defaultdict(lambda : 0))
-    vc_preemptable_usage = collections.defaultdict(lambda :
-            collections.defaultdict(lambda : 0))
-
-    for vc in vc_list:
-        vc_info[vc["vcName"]] = json.loads(vc["quota"])
-
-    active_job_list = data_handler.GetActiveJobList()
-    for job in active_job_list:
-        jobParam = json.loads(base64.b64decode(job["jobParams"]))
-        if "gpuType" in jobParam:
-            if not jobParam["preemptionAllowed"]:
-                vc_usage[job["vcName"]][jobParam["gpuType"]] += GetJobTotalGpu(jobParam)
-            else:
-                vc_preemptable_usage[job["vcName"]][jobParam["gpuType"]] += GetJobTotalGpu(jobParam)
+# seconds, usage of a vc materialized by job manager is stale if it is not
+# written in this long, see job_manager.MaterializeVcUsage
+VC_USAGE_MAX_AGE = 120
 
-    result = quota.calculate_vc_gpu_counts(cluster_total, cluster_available,
-            cluster_reserved, vc_info, vc_usage)
 
-    vc_total, vc_used, vc_available, vc_unschedulable = result
+def GetVC(userName, vcName):
+    ret = None
 
-    for vc in vc_list:
+    for vc in DataManager.ListVCs():
         if vc["vcName"] == vcName and AuthorizationManager.HasAccess(userName, ResourceType.VC, vcName, Permission.User):
-
-            num_active_jobs = 0
-            for job in active_job_list:
-                if job["vcName"] == vcName and job["jobStatus"] == "running":
-                    num_active_jobs += 1
-                    username = job["userName"]
-                    jobParam = json.loads(base64.b64decode(job["jobParams"]))
-                    if "gpuType" in jobParam:
-                        if not jobParam["preemptionAllowed"]:
-                            if username not in user_status:
-                                user_status[username] = ResourceInfo()
-                            user_status[username].Add(ResourceInfo({jobParam["gpuType"] : GetJobTotalGpu(jobParam)}))
-                        else:
-                            if username not in user_status_preemptable:
-                                user_status_preemptable[username] = ResourceInfo()
-                            user_status_preemptable[username].Add(ResourceInfo({jobParam["gpuType"] : GetJobTotalGpu(jobParam)}))
-
-            vc["gpu_capacity"] = vc_total[vcName]
-            vc["gpu_used"] = vc_used[vcName]
-            vc["gpu_preemptable_used"] = vc_preemptable_usage[vcName]
-            vc["gpu_unschedulable"] = vc_unschedulable[vcName]
-            vc["gpu_avaliable"] = vc_available[vcName]
-            vc["AvaliableJobNum"] = num_active_jobs
-            vc["node_status"] = cluster_status["node_status"]
-            vc["user_status"] = []
-            for user_name, user_gpu in user_status.iteritems():
-                # TODO: job_manager.getAlias should be put in a util file
-                user_name = user_name.split("@")[0].strip()
-                vc["user_status"].append({"userName":user_name, "userGPU":user_gpu.ToSerializable()})
-
-            vc["user_status_preemptable"] = []
-            for user_name, user_gpu in user_status_preemptable.iteritems():
-                user_name = user_name.split("@")[0].strip()
-                vc["user_status_preemptable"].append({"userName": user_name, "userGPU": user_gpu.ToSerializable()})
-
-            ret = vc
+            # shared by the cache of DataManager.ListVCs
+            ret = dict(vc)
             break
-    return ret
+    if ret is None:
+        return ret
 
+    data_handler = DataHandler()
+    try:
+        cluster_status, _ = data_handler.GetClusterStatus()
+        usage = data_handler.GetVcUsage(vcName, VC_USAGE_MAX_AGE).get(vcName)
+        if usage is None:
+            # job manager is down or has not seen the vc yet
+            logger.warning("usage of vc %s is not materialized, computing it", vcName)
+            jobs = [(job, GetJobSchedulingFields(job)) for job in data_handler.GetActiveJobList()]
+            usage = compute_vc_usage(cluster_status, DataManager.ListVCs(), jobs)[vcName]
+    finally:
+        data_handler.Close()
 
-def GetJobTotalGpu(jobParams):
-    numWorkers = 1
-    if "numpsworker" in jobParams:
-        numWorkers = int(jobParams["numpsworker"])
-    return int(jobParams["resourcegpu"]) * numWorkers
+    ret.update(usage)
+    ret["node_status"] = cluster_status["node_status"]
+    return ret
 
 
 def DeleteVC(userName, vcName):
@@ -636,6 +663,7 @@ def DeleteVC(userName, vcName):
     dataHandler = DataHandler()
     if AuthorizationManager.IsClusterAdmin(userName):
         ret =  dataHandler.DeleteVC(vcName)
+        DataManager.ListVCs.invalidate()
     else:
         ret = "Access Denied!"
     dataHandler.Close()
@@ -647,6 +675,7 @@ def UpdateVC(userName, vcName, quota, metadata):
     dataHandler = DataHandler()
     if AuthorizationManager.IsClusterAdmin(userName):
         ret =  dataHandler.UpdateVC(vcName, quota, metadata)
+        DataManager.ListVCs.invalidate()
     else:
         ret = "Access Denied!"
     dataHandler.Close()
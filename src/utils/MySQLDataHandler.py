@@ -1,9 +1,13 @@
 import mysql.connector
+from mysql.connector import errorcode
 import json
 import base64
+import zlib
 import os
+import time
 import logging
 import functools
+import threading
 
 import timeit
 
@@ -12,7 +16,10 @@ from Queue import Queue
 from config import config
 from config import global_vars
 
-from prometheus_client import Histogram
+from prometheus_client import Histogram, Gauge
+
+from job_params import GetSchedulingFields, DecodeJobParams, JOB_LIST_COLUMNS
+from cluster_status_history import CompressStatus, DecompressStatus, ToKeyedStatus, FromKeyedStatus, DiffStatus, PatchStatus
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +33,35 @@ db_connect_histogram = Histogram("db_connect_latency_seconds",
         "latency for connecting to db (seconds)",
         buckets=(.05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, float("inf")))
 
+db_pool_wait_histogram = Histogram("db_pool_wait_latency_seconds",
+        "latency for getting a connection from db connection pool (seconds)",
+        buckets=(.001, .005, .01, .05, .1, .5, 1.0, 5.0, 10.0, 30.0, float("inf")))
+
+# livesum: in multiprocess mode of restfulapi, summed over live processes only
+db_pool_connection_gauge = Gauge("db_pool_connections",
+        "number of db connections in connection pool of this process",
+        labelnames=("state",), multiprocess_mode="livesum")
+
+pool_lock = threading.Lock()
+
+# (name, columns, unique), kept in sync with CREATE TABLE of jobs table
+JOB_TABLE_INDEXES = [
+    ("jobId", ("jobId",), True),
+    ("jobTime", ("jobTime",), False),
+    ("jobStatus_jobTime", ("jobStatus", "jobTime"), False),
+    ("vcName_jobStatus_jobTime", ("vcName", "jobStatus", "jobTime"), False),
+    ("userName_vcName_jobTime", ("userName", "vcName", "jobTime"), False),
+    ]
+
+# single column indexes of old jobs table, covered by JOB_TABLE_INDEXES
+JOB_TABLE_REDUNDANT_INDEXES = [("jobId",), ("userName",), ("jobStatus",)]
+
+# jobs in these status will never be scheduled again
+FINISHED_JOB_STATUS = ["finished", "failed", "killed", "error"]
+
+# bytes of uncompressed log in one row of joblogs table
+JOB_LOG_CHUNK_SIZE = 65536
+
 
 def record(fn):
     @functools.wraps(fn)
@@ -40,6 +76,142 @@ def record(fn):
     return wrapped
 
 
+class MySQLConnManager(object):
+    """ Process wide pool of mysql connections, DataHandler borrows one in
+    __init__ and returns it in Close.
+
+    At most max_size connections are open at the same time, borrower waits
+    up to wait_timeout seconds for a connection returned by others. A
+    connection idle for more than check_interval seconds is pinged before
+    being handed out. Connections inherited from parent process (e.g.
+    PythonLauncher workers) are dropped, never used or closed in child.
+    """
+    def __init__(self, max_size=32, max_idle=8, wait_timeout=30, check_interval=30):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.wait_timeout = wait_timeout
+        self.check_interval = check_interval
+
+        self.cond = threading.Condition(threading.Lock())
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        # list of (conn, time of return), the last returned one is reused first
+        self.idle = []
+        # number of connections opened by this process and not closed yet
+        self.size = 0
+        self._update_gauge()
+
+    def _update_gauge(self):
+        db_pool_connection_gauge.labels("idle").set(len(self.idle))
+        db_pool_connection_gauge.labels("in_use").set(self.size - len(self.idle))
+
+    @staticmethod
+    def Connect():
+        server = config["mysql"]["hostname"]
+        username = config["mysql"]["username"]
+        password = config["mysql"]["password"]
+        database = "DLWSCluster-%s" % config["clusterId"]
+        with db_connect_histogram.time():
+            return mysql.connector.connect(user=username, password=password,
+                                           host=server, database=database)
+
+    @staticmethod
+    def TestConnection(conn):
+        try:
+            return conn.is_connected()
+        except Exception as e:
+            logger.warning("Exception: %s", str(e))
+            return False
+
+    @staticmethod
+    def CloseConnection(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def GetConnection(self):
+        conn = None
+        start = timeit.default_timer()
+        with self.cond:
+            if self.pid != os.getpid():
+                # socket is shared with parent process, closing it will
+                # disconnect parent as well
+                self._reset()
+
+            deadline = time.time() + self.wait_timeout
+            while True:
+                if len(self.idle) > 0:
+                    conn, returned = self.idle.pop()
+                    break
+                if self.size < self.max_size:
+                    self.size += 1
+                    returned = None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError("timeout getting db connection, %d connections in use" % self.size)
+                self.cond.wait(remaining)
+            self._update_gauge()
+        db_pool_wait_histogram.observe(timeit.default_timer() - start)
+
+        try:
+            if conn is not None and time.time() - returned > self.check_interval:
+                if not MySQLConnManager.TestConnection(conn):
+                    logger.info("db connection in pool is disconnected, reconnect")
+                    MySQLConnManager.CloseConnection(conn)
+                    conn = None
+            if conn is None:
+                conn = MySQLConnManager.Connect()
+        except:
+            with self.cond:
+                self.size -= 1
+                self._update_gauge()
+                self.cond.notify()
+            raise
+        return conn
+
+    def ReturnConnection(self, conn):
+        if self.pid != os.getpid():
+            # borrowed by parent process, it is not counted in this pool
+            return
+
+        try:
+            # end the transaction opened by reads, so next borrower will not
+            # read from a stale snapshot. Same as what close does.
+            conn.rollback()
+            healthy = True
+        except Exception as e:
+            logger.warning("Exception: %s", str(e))
+            healthy = False
+
+        with self.cond:
+            if healthy and len(self.idle) < self.max_idle:
+                self.idle.append((conn, time.time()))
+                conn = None
+            else:
+                self.size -= 1
+            self._update_gauge()
+            self.cond.notify()
+
+        if conn is not None:
+            MySQLConnManager.CloseConnection(conn)
+
+
+def get_connection_pool():
+    with pool_lock:
+        if "mysql_pool" not in global_vars:
+            pool_config = config["mysql"]
+            global_vars["mysql_pool"] = MySQLConnManager(
+                max_size=pool_config.get("pool_max_size", 32),
+                max_idle=pool_config.get("pool_max_idle", 8),
+                wait_timeout=pool_config.get("pool_wait_timeout", 30),
+                )
+        return global_vars["mysql_pool"]
+
+
 class DataHandler(object):
     def __init__(self):
         start_time = timeit.default_timer()
@@ -47,21 +219,22 @@ class DataHandler(object):
         self.jobtablename = "jobs"
         self.identitytablename = "identity"
         self.acltablename = "acl"
+        self.aclversiontablename = "aclversion"
         self.vctablename = "vc"
         self.storagetablename = "storage"
         self.clusterstatustablename = "clusterstatus"
+        self.clusterstatuslatesttablename = "clusterstatuslatest"
+        self.vcusagetablename = "vcusage"
         self.commandtablename = "commands"
         self.templatetablename = "templates"
         self.jobprioritytablename = "job_priorities"
-        server = config["mysql"]["hostname"]
-        username = config["mysql"]["username"]
-        password = config["mysql"]["password"]
+        self.endpointtablename = "endpoints"
+        self.joblogtablename = "joblogs"
 
         self.CreateDatabase()
 
-        with db_connect_histogram.time():
-            self.conn = mysql.connector.connect(user=username, password=password,
-                                                host=server, database=self.database)
+        self.conn = get_connection_pool().GetConnection()
+        self.conn_pid = os.getpid()
 
         self.CreateTable()
 
@@ -114,12 +287,17 @@ class DataHandler(object):
                     `jobLog` LONGTEXT  NULL,
                     `retries`             int    NULL DEFAULT 0,
                     `lastUpdated` DATETIME     DEFAULT CURRENT_TIMESTAMP NOT NULL,
+                    `gpuType` varchar(255) NULL,
+                    `totalGpu` INT NULL,
+                    `preemptionAllowed` TINYINT(1) NULL,
+                    `userId` varchar(255) NULL,
+                    `jobTrainingType` varchar(255) NULL,
                     PRIMARY KEY (`id`),
                     UNIQUE(`jobId`),
-                    INDEX (`userName`),
-                    INDEX (`jobTime`),
-                    INDEX (`jobId`),
-                    INDEX (`jobStatus`)
+                    INDEX `jobTime` (`jobTime`),
+                    INDEX `jobStatus_jobTime` (`jobStatus`, `jobTime`),
+                    INDEX `vcName_jobStatus_jobTime` (`vcName`, `jobStatus`, `jobTime`),
+                    INDEX `userName_vcName_jobTime` (`userName`, `vcName`, `jobTime`)
                 );
                 """ % (self.jobtablename)
 
@@ -128,6 +306,18 @@ class DataHandler(object):
             self.conn.commit()
             cursor.close()
 
+            # columns added after the table was first released
+            self.AddColumnsIfNotExist(self.jobtablename, [
+                ("gpuType", "varchar(255) NULL"),
+                ("totalGpu", "INT NULL"),
+                ("preemptionAllowed", "TINYINT(1) NULL"),
+                ("userId", "varchar(255) NULL"),
+                ("jobTrainingType", "varchar(255) NULL"),
+                ])
+            self.BackfillSchedulingFields()
+            self.UpdateIndexes(self.jobtablename, JOB_TABLE_INDEXES,
+                    JOB_TABLE_REDUNDANT_INDEXES)
+
             sql = """
                 CREATE TABLE IF NOT EXISTS `%s`
                 (
@@ -143,6 +333,50 @@ class DataHandler(object):
             self.conn.commit()
             cursor.close()
 
+            # history rows written by UpdateClusterStatus have status '' and
+            # the compressed snapshot or diff in payload
+            self.AddColumnsIfNotExist(self.clusterstatustablename, [
+                ("payload", "LONGBLOB NULL"),
+                ("keyframe", "TINYINT(1) NOT NULL DEFAULT 1"),
+                ])
+            self.UpdateIndexes(self.clusterstatustablename,
+                    [("time", ("time",), False)], [])
+
+            sql = """
+                CREATE TABLE IF NOT EXISTS `%s`
+                (
+                    `id`        INT   NOT NULL,
+                    `status`         LONGBLOB NOT NULL,
+                    `time` DATETIME     DEFAULT CURRENT_TIMESTAMP NOT NULL,
+                    `historyStatus`  LONGBLOB NULL,
+                    `historyTime` DATETIME NULL,
+                    `historyCount` INT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (`id`)
+                )
+                """ % (self.clusterstatuslatesttablename)
+
+            cursor = self.conn.cursor()
+            cursor.execute(sql)
+            self.conn.commit()
+            cursor.close()
+
+            # one row per vc, usage of the vc materialized by job manager,
+            # see UpdateVcUsage
+            sql = """
+                CREATE TABLE IF NOT EXISTS `%s`
+                (
+                    `vcName`    VARCHAR(255) NOT NULL,
+                    `status`    LONGTEXT     NOT NULL,
+                    `time`      DATETIME     DEFAULT CURRENT_TIMESTAMP NOT NULL,
+                    PRIMARY KEY (`vcName`)
+                )
+                """ % (self.vcusagetablename)
+
+            cursor = self.conn.cursor()
+            cursor.execute(sql)
+            self.conn.commit()
+            cursor.close()
+
             sql = """
                 CREATE TABLE IF NOT EXISTS `%s`
                 (
@@ -161,6 +395,13 @@ class DataHandler(object):
             self.conn.commit()
             cursor.close()
 
+            # result of the command besides stdout in output
+            self.AddColumnsIfNotExist(self.commandtablename, [
+                ("stderr", "TEXT NULL"),
+                ("exitCode", "INT NULL"),
+                ("finishTime", "DATETIME NULL"),
+                ])
+
             sql = """
                 CREATE TABLE IF NOT EXISTS  `%s`
                 (
@@ -249,6 +490,22 @@ class DataHandler(object):
             self.conn.commit()
             cursor.close()
 
+            # one row, version is increased by every change of acl and
+            # identities, see GetAclVersion
+            sql = """
+                CREATE TABLE IF NOT EXISTS `%s`
+                (
+                    `id`        INT     NOT NULL,
+                    `version`   BIGINT  NOT NULL,
+                    PRIMARY KEY (`id`)
+                )
+                """ % (self.aclversiontablename)
+
+            cursor = self.conn.cursor()
+            cursor.execute(sql)
+            self.conn.commit()
+            cursor.close()
+
 
             sql = """
                 CREATE TABLE IF NOT EXISTS `%s`
@@ -286,6 +543,150 @@ class DataHandler(object):
             self.conn.commit()
             cursor.close()
 
+            sql = """
+                CREATE TABLE IF NOT EXISTS  `%s`
+                (
+                    `id`             INT     NOT NULL AUTO_INCREMENT,
+                    `endpointId`     varchar(255) NOT NULL,
+                    `jobId`          varchar(50)   NOT NULL,
+                    `status`         varchar(32) NOT NULL,
+                    `endpoint`       LONGTEXT NOT NULL,
+                    `lastUpdated`    DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP NOT NULL,
+                    PRIMARY KEY (`id`),
+                    UNIQUE(`endpointId`),
+                    INDEX `status_jobId` (`status`, `jobId`),
+                    INDEX `jobId` (`jobId`)
+                )
+                """ % (self.endpointtablename)
+
+            cursor = self.conn.cursor()
+            cursor.execute(sql)
+            self.conn.commit()
+            cursor.close()
+
+            self.BackfillEndpoints()
+
+            # zlib compressed job log in chunks of JOB_LOG_CHUNK_SIZE bytes,
+            # offset is where the chunk starts in uncompressed log
+            sql = """
+                CREATE TABLE IF NOT EXISTS `%s`
+                (
+                    `jobId`          varchar(50)   NOT NULL,
+                    `chunk`          INT     NOT NULL,
+                    `offset`         BIGINT  NOT NULL,
+                    `size`           INT     NOT NULL,
+                    `data`           MEDIUMBLOB NOT NULL,
+                    PRIMARY KEY (`jobId`, `chunk`)
+                )
+                """ % (self.joblogtablename)
+
+            cursor = self.conn.cursor()
+            cursor.execute(sql)
+            self.conn.commit()
+            cursor.close()
+
+    def AddColumnsIfNotExist(self, table, columns):
+        """ columns is a list of (name, definition), missing ones are added by
+        one ALTER TABLE """
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("SELECT `COLUMN_NAME` FROM information_schema.COLUMNS WHERE `TABLE_SCHEMA` = %s AND `TABLE_NAME` = %s",
+                    (self.database, table))
+            existing = set([name for (name,) in cursor.fetchall()])
+            missing = [(name, definition) for name, definition in columns if name not in existing]
+            if len(missing) > 0:
+                logger.info("adding columns %s to table %s", [name for name, _ in missing], table)
+                sql = "ALTER TABLE `%s` %s" % (table, ", ".join(["ADD COLUMN `%s` %s" % column for column in missing]))
+                cursor.execute(sql)
+            self.conn.commit()
+        except mysql.connector.Error as e:
+            # other process may have added them at the same time
+            if e.errno != errorcode.ER_DUP_FIELDNAME:
+                raise
+            logger.info("columns already added to table %s", table)
+        finally:
+            cursor.close()
+
+    def UpdateIndexes(self, table, indexes, redundant):
+        """ indexes is a list of (name, columns, unique). Missing indexes are
+        added and non-unique indexes on one of the `redundant` column tuples
+        are dropped by one ALTER TABLE. Indexes are matched by columns, not by
+        name, since tables created by older versions use generated names. """
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("SELECT `INDEX_NAME`, `COLUMN_NAME`, `NON_UNIQUE` FROM information_schema.STATISTICS WHERE `TABLE_SCHEMA` = %s AND `TABLE_NAME` = %s ORDER BY `INDEX_NAME`, `SEQ_IN_INDEX`",
+                    (self.database, table))
+            existing = {}
+            for (name, column, non_unique) in cursor.fetchall():
+                columns, _ = existing.get(name, ((), True))
+                existing[name] = (columns + (column,), not non_unique)
+
+            def has_index(columns, unique):
+                return any(c == columns and (u or not unique) for c, u in existing.values())
+
+            changes = ["ADD %sINDEX `%s` (%s)" % ("UNIQUE " if unique else "", name,
+                        ", ".join(["`%s`" % column for column in columns]))
+                    for name, columns, unique in indexes if not has_index(tuple(columns), unique)]
+            changes += ["DROP INDEX `%s`" % name
+                    for name, (columns, unique) in sorted(existing.items())
+                    if not unique and columns in redundant]
+            if len(changes) > 0:
+                logger.info("updating indexes of table %s: %s", table, changes)
+                cursor.execute("ALTER TABLE `%s` %s" % (table, ", ".join(changes)))
+            self.conn.commit()
+        except mysql.connector.Error as e:
+            # queries still work without the indexes, only slower
+            logger.error("failed to update indexes of table %s: %s", table, str(e))
+        finally:
+            cursor.close()
+
+    def BackfillSchedulingFields(self):
+        """ Fill scheduling columns of unfinished jobs added before the columns
+        existed. Finished jobs are left, readers decode jobParams for them. """
+        cursor = self.conn.cursor()
+        query = "SELECT `jobId`, `jobParams` FROM `%s` WHERE `totalGpu` IS NULL AND `jobStatus` IN ('unapproved', 'queued', 'scheduling', 'running', 'pausing', 'killing')" % (self.jobtablename)
+        cursor.execute(query)
+        data = cursor.fetchall()
+        self.conn.commit()
+        cursor.close()
+
+        jobFields = {}
+        for (jobId, jobParams) in data:
+            try:
+                jobFields[jobId] = GetSchedulingFields(DecodeJobParams({"jobId": jobId, "jobParams": jobParams}))
+            except Exception:
+                logger.warning("failed to decode jobParams of job %s", jobId, exc_info=True)
+        logger.info("backfilling scheduling fields of %d jobs", len(jobFields))
+        jobIds = jobFields.keys()
+        for i in range(0, len(jobIds), 500):
+            self.BatchUpdateJobFields(dict([(jobId, jobFields[jobId]) for jobId in jobIds[i:i+500]]))
+
+    def BackfillEndpoints(self):
+        """ Endpoints used to be kept as a json blob in jobs.endpoints, copy
+        them to endpoints table if it is still empty. """
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("SELECT 1 FROM `%s` LIMIT 1" % (self.endpointtablename))
+            if len(cursor.fetchall()) > 0:
+                self.conn.commit()
+                return
+
+            cursor.execute("SELECT `jobId`, `endpoints` FROM `%s` WHERE `endpoints` IS NOT NULL AND `endpoints` <> ''" % (self.jobtablename))
+            rows = []
+            for (jobId, endpoints) in cursor.fetchall():
+                for endpoint_id, endpoint in self.load_json(endpoints).items():
+                    rows.append((endpoint_id, jobId, endpoint["status"], json.dumps(endpoint)))
+            self.conn.commit()
+
+            logger.info("backfilling %d endpoints", len(rows))
+            # IGNORE, other process may be doing the same
+            sql = "INSERT IGNORE INTO `%s` (`endpointId`, `jobId`, `status`, `endpoint`) VALUES (%%s, %%s, %%s, %%s)" % (self.endpointtablename)
+            for i in range(0, len(rows), 500):
+                cursor.executemany(sql, rows[i:i+500])
+                self.conn.commit()
+        finally:
+            cursor.close()
+
     @record
     def AddStorage(self, vcName, url, storageType, metadata, defaultMountPath):
         try:
@@ -448,6 +849,8 @@ class DataHandler(object):
                 sql = """update `%s` set uid = '%s', gid = '%s', groups = '%s' where `identityName` = '%s' """ % (self.identitytablename, uid, gid, groups, identityName)
                 cursor.execute(sql)
 
+            if cursor.rowcount > 0:
+                self.IncreaseAclVersion(cursor)
             self.conn.commit()
             cursor.close()
             return True
@@ -483,6 +886,8 @@ class DataHandler(object):
                 sql = """update `%s` set permissions = '%s' where `identityName` = '%s' and `resource` = '%s' """ % (self.acltablename, permissions, identityName, resource)
                 cursor.execute(sql)
 
+            if cursor.rowcount > 0:
+                self.IncreaseAclVersion(cursor)
             self.conn.commit()
             cursor.close()
             return True
@@ -498,6 +903,8 @@ class DataHandler(object):
             sql = """update `%s` set identityId = '%s' where `identityName` = '%s' """ % (self.acltablename, identityId, identityName)
             cursor.execute(sql)
 
+            if cursor.rowcount > 0:
+                self.IncreaseAclVersion(cursor)
             self.conn.commit()
             cursor.close()
             return True
@@ -514,6 +921,8 @@ class DataHandler(object):
             sql = "DELETE FROM `%s` WHERE `resource` = '%s'" % (self.acltablename, resource)
             cursor.execute(sql)
 
+            if cursor.rowcount > 0:
+                self.IncreaseAclVersion(cursor)
             self.conn.commit()
             cursor.close()
             return True
@@ -530,6 +939,8 @@ class DataHandler(object):
             sql = "DELETE FROM `%s` WHERE `identityName` = '%s' and `resource` = '%s'" % (self.acltablename, identityName, resource)
             cursor.execute(sql)
 
+            if cursor.rowcount > 0:
+                self.IncreaseAclVersion(cursor)
             self.conn.commit()
             cursor.close()
             return True
@@ -538,6 +949,34 @@ class DataHandler(object):
             return False
 
 
+    def IncreaseAclVersion(self, cursor):
+        """ Called with cursor of a change of acl or identities, before it
+        is committed. Callers check rowcount, which counts changed rows rather
+        than matched ones, so that identity info written on every login
+        doesn't reload acl of all processes. """
+        sql = "INSERT INTO `%s` (`id`, `version`) VALUES (1, 1) ON DUPLICATE KEY UPDATE `version` = `version` + 1" % (self.aclversiontablename)
+        cursor.execute(sql)
+
+
+    @record
+    def GetAclVersion(self):
+        """ Version of acl and identities, changed whenever any of them
+        changes """
+        cursor = self.conn.cursor()
+        query = "SELECT `version` FROM `%s` WHERE `id` = 1" % (self.aclversiontablename)
+        ret = 0
+        try:
+            cursor.execute(query)
+            for (version,) in cursor.fetchall():
+                ret = version
+        except Exception as e:
+            logger.error('Exception: %s', str(e))
+            ret = None
+        self.conn.commit()
+        cursor.close()
+        return ret
+
+
     @record
     def GetAcl(self):
         cursor = self.conn.cursor()
@@ -586,10 +1025,12 @@ class DataHandler(object):
     @record
     def AddJob(self, jobParams):
         try:
-            sql = "INSERT INTO `"+self.jobtablename+"` (jobId, familyToken, isParent, jobName, userName, vcName, jobType,jobParams ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s)"
+            sql = "INSERT INTO `"+self.jobtablename+"` (jobId, familyToken, isParent, jobName, userName, vcName, jobType,jobParams, gpuType, totalGpu, preemptionAllowed, userId, jobTrainingType ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"
             cursor = self.conn.cursor()
             jobParam = base64.b64encode(json.dumps(jobParams))
-            cursor.execute(sql, (jobParams["jobId"], jobParams["familyToken"], jobParams["isParent"], jobParams["jobName"], jobParams["userName"], jobParams["vcName"], jobParams["jobType"],jobParam))
+            fields = GetSchedulingFields(jobParams)
+            cursor.execute(sql, (jobParams["jobId"], jobParams["familyToken"], jobParams["isParent"], jobParams["jobName"], jobParams["userName"], jobParams["vcName"], jobParams["jobType"],jobParam,
+                fields["gpuType"], fields["totalGpu"], fields["preemptionAllowed"], fields["userId"], fields["jobTrainingType"]))
             self.conn.commit()
             cursor.close()
             return True
@@ -598,54 +1039,56 @@ class DataHandler(object):
             return False
 
 
+    def BuildJobListQuery(self, userName, vcName, num=None, status=None, op=("=", "or"), columns=None, after=None):
+        """ Returns (query, params) of GetJobList. status is comma separated,
+        op ("=", "or") selects jobs in one of the status and ("<>", "and")
+        jobs in none of them. Jobs are ordered by (jobTime, id) desc, after is
+        (jobTime, id) of the last job of previous page. """
+        if columns is None:
+            columns = JOB_LIST_COLUMNS
+        query = "SELECT %s FROM `%s` WHERE 1" % (", ".join(["`%s`" % column for column in columns]), self.jobtablename)
+        params = []
+        if userName != "all":
+            query += " AND `userName` = %s"
+            params.append(userName)
+
+        if vcName != "all":
+            query += " AND `vcName` = %s"
+            params.append(vcName)
+
+        if status is not None:
+            status_list = status.split(",")
+            query += " AND `jobStatus` %s (%s)" % ("IN" if op[0] == "=" else "NOT IN",
+                    ", ".join(["%s"] * len(status_list)))
+            params.extend(status_list)
+
+        if after is not None:
+            query += " AND (`jobTime` < %s OR (`jobTime` = %s AND `id` < %s))"
+            params.extend([after[0], after[0], after[1]])
+
+        # id is part of every secondary index, so it doesn't add a filesort
+        query += " ORDER BY `jobTime` DESC, `id` DESC"
+
+        if num is not None:
+            query += " LIMIT %d" % int(num)
+        return query, params
+
     @record
-    def GetJobList(self, userName, vcName, num = None, status = None, op = ("=","or")):
+    def GetJobList(self, userName, vcName, num = None, status = None, op = ("=","or"), columns = None, after = None):
+        """ columns defaults to JOB_LIST_COLUMNS, callers which only need a few
+        of them should pass them to save fetching LONGTEXT columns. """
         ret = []
         cursor = self.conn.cursor()
         try:
-            query = "SELECT `jobId`,`jobName`,`userName`, `vcName`, `jobStatus`, `jobStatusDetail`, `jobType`, `jobDescriptionPath`, `jobDescription`, `jobTime`, `endpoints`, `jobParams`,`errorMsg` ,`jobMeta` FROM `%s` where 1" % (self.jobtablename)
-            if userName != "all":
-                query += " and `userName` = '%s'" % userName
-
-            if vcName != "all":
-                query += " and `vcName` = '%s'" % vcName
-
-            if status is not None:
-                if "," not in status:
-                    query += " and `jobStatus` %s '%s'" % (op[0], status)
-                else:
-                    status_list = [" `jobStatus` %s '%s' " % (op[0], s) for s in status.split(',')]
-                    status_statement = (" "+op[1]+" ").join(status_list)
-                    query += " and ( %s ) " % status_statement
-
-            query += " order by `jobTime` Desc"
-
-            if num is not None:
-                query += " limit %s " % str(num)
-
-            cursor.execute(query)
+            query, params = self.BuildJobListQuery(userName, vcName, num, status, op, columns, after)
+            cursor.execute(query, params)
 
             fetch_start_time = timeit.default_timer()
             data = cursor.fetchall()
             fetch_elapsed = timeit.default_timer() - fetch_start_time
             logger.info("(fetchall time: %f)", fetch_elapsed)
-            for (jobId,jobName,userName, vcName, jobStatus,jobStatusDetail, jobType, jobDescriptionPath, jobDescription, jobTime, endpoints, jobParams,errorMsg, jobMeta) in data:
-                record = {}
-                record["jobId"] = jobId
-                record["jobName"] = jobName
-                record["userName"] = userName
-                record["vcName"] = vcName
-                record["jobStatus"] = jobStatus
-                record["jobStatusDetail"] = jobStatusDetail
-                record["jobType"] = jobType
-                record["jobDescriptionPath"] = jobDescriptionPath
-                record["jobDescription"] = jobDescription
-                record["jobTime"] = jobTime
-                record["endpoints"] = endpoints
-                record["jobParams"] = jobParams
-                record["errorMsg"] = errorMsg
-                record["jobMeta"] = jobMeta
-                ret.append(record)
+            names = [column[0] for column in cursor.description]
+            ret = [dict(zip(names, row)) for row in data]
         except Exception as e:
             logger.error('Exception: %s', str(e))
         self.conn.commit()
@@ -657,18 +1100,23 @@ class DataHandler(object):
         ret = []
         cursor = self.conn.cursor()
         try:
-            query = "SELECT `jobId`, `userName`, `vcName`, `jobParams`, `jobStatus` FROM `%s` WHERE `jobStatus` = 'scheduling' OR `jobStatus` = 'running'" % (self.jobtablename)
+            query = "SELECT `jobId`, `userName`, `vcName`, `jobParams`, `jobStatus`, `gpuType`, `totalGpu`, `preemptionAllowed`, `userId`, `jobTrainingType` FROM `%s` WHERE `jobStatus` IN ('scheduling', 'running')" % (self.jobtablename)
 
             cursor.execute(query)
             data = cursor.fetchall()
 
-            for (jobId,userName,vcName,jobParams,jobStatus) in data:
+            for (jobId,userName,vcName,jobParams,jobStatus,gpuType,totalGpu,preemptionAllowed,userId,jobTrainingType) in data:
                 record = {}
                 record["jobId"] = jobId
                 record["userName"] = userName
                 record["vcName"] = vcName
                 record["jobParams"] = jobParams
                 record["jobStatus"] = jobStatus
+                record["gpuType"] = gpuType
+                record["totalGpu"] = totalGpu
+                record["preemptionAllowed"] = preemptionAllowed
+                record["userId"] = userId
+                record["jobTrainingType"] = jobTrainingType
                 ret.append(record)
         except Exception as e:
             logger.error('Exception: %s', str(e))
@@ -676,6 +1124,43 @@ class DataHandler(object):
         cursor.close()
         return ret
 
+    @record
+    def GetJobStatuses(self, status):
+        """ Returns dict of jobId -> jobStatus for jobs in one of the comma
+        separated status. Exceptions are raised to caller, so an empty dict
+        always means there is no such job. """
+        status_list = status.split(",")
+        cursor = self.conn.cursor()
+        try:
+            query = "SELECT `jobId`, `jobStatus` FROM `%s` WHERE `jobStatus` IN (%s)" % (
+                    self.jobtablename, ",".join(["%s"] * len(status_list)))
+            cursor.execute(query, status_list)
+            ret = {}
+            for (jobId, jobStatus) in cursor.fetchall():
+                ret[jobId] = jobStatus
+            self.conn.commit()
+            return ret
+        finally:
+            cursor.close()
+
+    @record
+    def GetJobsByIds(self, job_ids):
+        """ Same columns as GetJobList, but only for jobs in job_ids.
+        Exceptions are raised to caller. """
+        if len(job_ids) == 0:
+            return []
+        cursor = self.conn.cursor()
+        try:
+            query = "SELECT `jobId`,`jobName`,`userName`, `vcName`, `jobStatus`, `jobStatusDetail`, `jobType`, `jobDescriptionPath`, `jobDescription`, `jobTime`, `endpoints`, `jobParams`,`errorMsg` ,`jobMeta`, `gpuType`, `totalGpu`, `preemptionAllowed`, `userId`, `jobTrainingType` FROM `%s` WHERE `jobId` IN (%s)" % (
+                    self.jobtablename, ",".join(["%s"] * len(job_ids)))
+            cursor.execute(query, list(job_ids))
+            columns = [column[0] for column in cursor.description]
+            ret = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            self.conn.commit()
+            return ret
+        finally:
+            cursor.close()
+
     @record
     def GetJob(self, **kwargs):
         valid_keys = ["jobId", "familyToken", "isParent", "jobName", "userName", "vcName", "jobStatus", "jobType", "jobTime"]
@@ -723,11 +1208,11 @@ class DataHandler(object):
         return ret
 
     @record
-    def FinishCommand(self, commandId):
+    def FinishCommand(self, commandId, status="run", output=None, stderr=None, exitCode=None):
         try:
-            sql = """update `%s` set status = 'run' where `id` = '%s' """ % (self.commandtablename, commandId)
+            sql = "UPDATE `%s` SET `status` = %%s, `output` = %%s, `stderr` = %%s, `exitCode` = %%s, `finishTime` = UTC_TIMESTAMP() WHERE `id` = %%s" % (self.commandtablename)
             cursor = self.conn.cursor()
-            cursor.execute(sql)
+            cursor.execute(sql, (status, output, stderr, exitCode, commandId))
             self.conn.commit()
             cursor.close()
             return True
@@ -738,15 +1223,17 @@ class DataHandler(object):
     @record
     def GetCommands(self, jobId):
         cursor = self.conn.cursor()
-        query = "SELECT `time`, `command`, `status`, `output` FROM `%s` WHERE `jobId` = '%s' order by `time`" % (self.commandtablename, jobId)
-        cursor.execute(query)
+        query = "SELECT `time`, `command`, `status`, `output`, `stderr`, `exitCode` FROM `%s` WHERE `jobId` = %%s order by `time`" % (self.commandtablename)
+        cursor.execute(query, (jobId,))
         ret = []
-        for (time, command, status, output) in cursor:
+        for (time, command, status, output, stderr, exitCode) in cursor:
             record = {}
             record["time"] = time
             record["command"] = command
             record["status"] = status
             record["output"] = output
+            record["stderr"] = stderr
+            record["exitCode"] = exitCode
             ret.append(record)
         self.conn.commit()
         cursor.close()
@@ -760,18 +1247,27 @@ class DataHandler(object):
         except:
             return {}
 
+    def QueryEndpoints(self, query, params):
+        """ query selects `endpointId` and `endpoint` of endpoints table as e,
+        returns a dict of endpoint id -> endpoint """
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(query, params)
+            endpoints = {}
+            for (endpoint_id, endpoint) in cursor.fetchall():
+                endpoints[endpoint_id] = self.load_json(endpoint)
+            self.conn.commit()
+            return endpoints
+        finally:
+            cursor.close()
+
     @record
     def GetPendingEndpoints(self):
+        """ pending endpoints of running jobs """
         try:
-            jobs = self.GetJob(jobStatus="running")
-
-            # [ {endpoint1:{},endpoint2:{}}, {endpoint3:{}, ... }, ... ]
-            endpoints = map(lambda job: self.load_json(job["endpoints"]), jobs)
-            # {endpoint1: {}, endpoint2: {}, ... }
-            # endpoint["status"] == "pending"
-            pendingEndpoints = {k: v for d in endpoints for k, v in d.items() if v["status"] == "pending"}
-
-            return pendingEndpoints
+            query = "SELECT e.`endpointId`, e.`endpoint` FROM `%s` e JOIN `%s` j ON e.`jobId` = j.`jobId` WHERE e.`status` = 'pending' AND j.`jobStatus` = 'running'" % (
+                    self.endpointtablename, self.jobtablename)
+            return self.QueryEndpoints(query, ())
         except Exception as e:
             logger.exception("Query pending endpoints failed!")
             return {}
@@ -779,33 +1275,40 @@ class DataHandler(object):
     @record
     def GetJobEndpoints(self, job_id):
         try:
-            jobs = self.GetJob(jobId=job_id)
-
-            # [ {endpoint1:{},endpoint2:{}}, {endpoint3:{}, ... }, ... ]
-            endpoints = map(lambda job: self.load_json(job["endpoints"]), jobs)
-            # {endpoint1: {}, endpoint2: {}, ... }
-            # endpoint["status"] == "pending"
-            endpoints = {k: v for d in endpoints for k, v in d.items()}
-
-            return endpoints
+            query = "SELECT e.`endpointId`, e.`endpoint` FROM `%s` e WHERE e.`jobId` = %%s" % (self.endpointtablename)
+            return self.QueryEndpoints(query, (job_id,))
         except Exception as e:
             logger.warning("Query job endpoints failed! Job {}".format(job_id), exc_info=True)
             return {}
 
     @record
-    def GetDeadEndpoints(self):
+    def GetEndpointsByJobIds(self, job_ids):
+        """ Returns dict of jobId -> endpoints of the job """
+        ret = {}
+        if len(job_ids) == 0:
+            return ret
         try:
+            query = "SELECT e.`jobId`, e.`endpointId`, e.`endpoint` FROM `%s` e WHERE e.`jobId` IN (%s)" % (
+                    self.endpointtablename, ", ".join(["%s"] * len(job_ids)))
             cursor = self.conn.cursor()
-            # TODO we need job["lastUpdated"] for filtering
-            query = "SELECT `endpoints` FROM jobs WHERE `jobStatus` <> 'running' and `jobStatus` <> 'pending' and `jobStatus` <> 'queued' and `jobStatus` <> 'scheduling' order by `jobTime` DESC"
-            cursor.execute(query)
-            dead_endpoints = {}
-            for [endpoints] in cursor:
-                endpoint_list = {k: v for k, v in self.load_json(endpoints).items() if v["status"] == "running"}
-                dead_endpoints.update(endpoint_list)
-            self.conn.commit()
-            cursor.close()
-            return dead_endpoints
+            try:
+                cursor.execute(query, list(job_ids))
+                for (job_id, endpoint_id, endpoint) in cursor.fetchall():
+                    ret.setdefault(job_id, {})[endpoint_id] = self.load_json(endpoint)
+                self.conn.commit()
+            finally:
+                cursor.close()
+        except Exception as e:
+            logger.warning("Query endpoints of jobs failed!", exc_info=True)
+        return ret
+
+    @record
+    def GetDeadEndpoints(self):
+        """ running endpoints of jobs not running any more """
+        try:
+            query = "SELECT e.`endpointId`, e.`endpoint` FROM `%s` e JOIN `%s` j ON e.`jobId` = j.`jobId` WHERE e.`status` = 'running' AND j.`jobStatus` NOT IN ('running', 'pending', 'queued', 'scheduling')" % (
+                    self.endpointtablename, self.jobtablename)
+            return self.QueryEndpoints(query, ())
         except Exception as e:
             logger.exception("Query dead endpoints failed!")
             return {}
@@ -813,16 +1316,9 @@ class DataHandler(object):
     @record
     def UpdateEndpoint(self, endpoint):
         try:
-            job_id = endpoint["jobId"]
-            job = self.GetJob(jobId=job_id)[0]
-            job_endpoints = self.load_json(job["endpoints"])
-
-            # update jobEndpoints
-            job_endpoints[endpoint["id"]] = endpoint
-
-            sql = "UPDATE jobs SET endpoints=%s where jobId=%s"
+            sql = "INSERT INTO `%s` (`endpointId`, `jobId`, `status`, `endpoint`) VALUES (%%s, %%s, %%s, %%s) ON DUPLICATE KEY UPDATE `status` = VALUES(`status`), `endpoint` = VALUES(`endpoint`)" % (self.endpointtablename)
             cursor = self.conn.cursor()
-            cursor.execute(sql, (json.dumps(job_endpoints), job_id))
+            cursor.execute(sql, (endpoint["id"], endpoint["jobId"], endpoint["status"], json.dumps(endpoint)))
             self.conn.commit()
             cursor.close()
             return True
@@ -833,8 +1329,8 @@ class DataHandler(object):
     @record
     def GetPendingJobs(self):
         cursor = self.conn.cursor()
-        query = "SELECT `jobId`,`jobName`,`userName`, `vcName`, `jobStatus`, `jobStatusDetail`, `jobType`, `jobDescriptionPath`, `jobDescription`, `jobTime`, `endpoints`, `jobParams`,`errorMsg` ,`jobMeta` FROM `%s` where `jobStatus` <> 'error' and `jobStatus` <> 'failed' and `jobStatus` <> 'finished' and `jobStatus` <> 'killed' order by `jobTime` DESC" % (self.jobtablename)
-        cursor.execute(query)
+        query = "SELECT `jobId`,`jobName`,`userName`, `vcName`, `jobStatus`, `jobStatusDetail`, `jobType`, `jobDescriptionPath`, `jobDescription`, `jobTime`, `endpoints`, `jobParams`,`errorMsg` ,`jobMeta` FROM `%s` WHERE `jobStatus` NOT IN (%s) ORDER BY `jobTime` DESC" % (self.jobtablename, ", ".join(["%s"] * len(FINISHED_JOB_STATUS)))
+        cursor.execute(query, FINISHED_JOB_STATUS)
         ret = []
         for (jobId,jobName,userName,vcName, jobStatus, jobStatusDetail, jobType, jobDescriptionPath, jobDescription, jobTime, endpoints, jobParams,errorMsg, jobMeta) in cursor:
             record = {}
@@ -884,6 +1380,61 @@ class DataHandler(object):
             logger.error('Exception: %s', str(e))
             return False
 
+    @record
+    def UpdateJobFields(self, jobId, fields):
+        """ Update several fields of a job in one statement, fields is a dict
+        of field -> value """
+        return self.BatchUpdateJobFields({jobId: fields})
+
+    @record
+    def BatchUpdateJobFields(self, jobFields, expectedStatuses=None):
+        """ jobFields is a dict of jobId -> dict of field -> value. Updates of
+        all jobs are done in one statement and committed together. A job in
+        expectedStatuses (dict of jobId -> jobStatus) is only updated if it is
+        still in that status, so that e.g. a kill request made meanwhile is
+        not overwritten. """
+        jobFields = dict([(jobId, fields) for jobId, fields in jobFields.items() if len(fields) > 0])
+        if len(jobFields) == 0:
+            return True
+        try:
+            # sorted, so that concurrent batches lock rows in same order
+            jobIds = sorted(jobFields.keys())
+            names = sorted(set([name for fields in jobFields.values() for name in fields]))
+            params = []
+            if len(jobIds) == 1:
+                assignments = ["`%s` = %%s" % name for name in names]
+                params = [jobFields[jobIds[0]][name] for name in names]
+            else:
+                assignments = []
+                for name in names:
+                    cases = []
+                    for jobId in jobIds:
+                        if name in jobFields[jobId]:
+                            cases.append("when %s then %s")
+                            params.extend([jobId, jobFields[jobId][name]])
+                    assignments.append("`%s` = case `jobId` %s else `%s` end" % (name, " ".join(cases), name))
+            if expectedStatuses is None:
+                expectedStatuses = {}
+            conditions = []
+            unguarded = [jobId for jobId in jobIds if jobId not in expectedStatuses]
+            if len(unguarded) > 0:
+                conditions.append("`jobId` in (%s)" % ", ".join(["%s"] * len(unguarded)))
+                params.extend(unguarded)
+            for jobId in jobIds:
+                if jobId in expectedStatuses:
+                    conditions.append("(`jobId` = %s and `jobStatus` = %s)")
+                    params.extend([jobId, expectedStatuses[jobId]])
+            sql = "update `%s` set %s where %s" % (self.jobtablename,
+                    ", ".join(assignments), " or ".join(conditions))
+            cursor = self.conn.cursor()
+            cursor.execute(sql, params)
+            self.conn.commit()
+            cursor.close()
+            return True
+        except Exception as e:
+            logger.error('Exception: %s', str(e))
+            return False
+
     @record
     def GetJobTextField(self, jobId, field):
         cursor = self.conn.cursor()
@@ -900,6 +1451,62 @@ class DataHandler(object):
         cursor.close()
         return ret
 
+    @record
+    def UpdateJobLog(self, jobId, log):
+        """ Replaces log of job in joblogs table, and drops the copy kept in
+        jobLog column of jobs table by older versions """
+        try:
+            chunks = [(jobId, i, offset, len(log[offset:offset + JOB_LOG_CHUNK_SIZE]),
+                bytearray(zlib.compress(log[offset:offset + JOB_LOG_CHUNK_SIZE])))
+                for i, offset in enumerate(range(0, len(log), JOB_LOG_CHUNK_SIZE))]
+            cursor = self.conn.cursor()
+            if len(chunks) > 0:
+                sql = "INSERT INTO `%s` (`jobId`, `chunk`, `offset`, `size`, `data`) VALUES (%%s, %%s, %%s, %%s, %%s) ON DUPLICATE KEY UPDATE `offset` = VALUES(`offset`), `size` = VALUES(`size`), `data` = VALUES(`data`)" % (self.joblogtablename)
+                cursor.executemany(sql, chunks)
+            cursor.execute("DELETE FROM `%s` WHERE `jobId` = %%s AND `chunk` >= %%s" % (self.joblogtablename),
+                    (jobId, len(chunks)))
+            cursor.execute("UPDATE `%s` SET `jobLog` = NULL WHERE `jobId` = %%s AND `jobLog` IS NOT NULL" % (self.jobtablename),
+                    (jobId,))
+            self.conn.commit()
+            cursor.close()
+            return True
+        except Exception as e:
+            logger.error('Exception: %s', str(e))
+            return False
+
+    @record
+    def GetJobLog(self, jobId, tail=None):
+        """ Returns (log, size of whole log). log is the last tail bytes if
+        tail is given, otherwise the whole log, only chunks covering it are
+        read. log is None if job has no log in joblogs table.
+
+        The log is the trimmed view of the latest lines of each pod written
+        by joblog_manager, rewritten on each update rather than appended
+        to, so there is no stable offset to read new lines from. """
+        cursor = self.conn.cursor()
+        ret = (None, 0)
+        try:
+            cursor.execute("SELECT `chunk`, `offset`, `size` FROM `%s` WHERE `jobId` = %%s ORDER BY `chunk`" % (self.joblogtablename),
+                    (jobId,))
+            chunks = cursor.fetchall()
+            if len(chunks) > 0:
+                size = chunks[-1][1] + chunks[-1][2]
+                start = max(size - tail, 0) if tail is not None else 0
+                needed = [chunk for chunk, chunk_offset, chunk_size in chunks if chunk_offset + chunk_size > start]
+                log = ""
+                if len(needed) > 0:
+                    cursor.execute("SELECT `offset`, `data` FROM `%s` WHERE `jobId` = %%s AND `chunk` >= %%s ORDER BY `chunk`" % (self.joblogtablename),
+                            (jobId, needed[0]))
+                    data = cursor.fetchall()
+                    log = "".join([zlib.decompress(bytes(chunk_data)) for _, chunk_data in data])
+                    log = log[start - data[0][0]:]
+                ret = (log, size)
+        except Exception as e:
+            logger.error('Exception: %s', str(e))
+        self.conn.commit()
+        cursor.close()
+        return ret
+
     @record
     def AddandGetJobRetries(self, jobId):
         sql = """update `%s` set `retries` = `retries` + 1 where `jobId` = '%s' """ % (self.jobtablename, jobId)
@@ -921,12 +1528,44 @@ class DataHandler(object):
 
     @record
     def UpdateClusterStatus(self, clusterStatus):
+        """ Overwrites the only row of latest cluster status. At most once
+        per history interval the status is also appended to history, as a
+        diff to the previous history row except every keyframe_interval
+        rows, and history older than retention_days is dropped. """
+        history_config = config.get("cluster_status_history", {})
+        interval = history_config.get("interval", 600)
+        keyframe_interval = history_config.get("keyframe_interval", 36)
+        retention_days = history_config.get("retention_days", 7)
         try:
-            status = base64.b64encode(json.dumps(clusterStatus))
-
-            sql = "INSERT INTO `%s` (status) VALUES ('%s')" % (self.clusterstatustablename, status)
+            payload = bytearray(CompressStatus(clusterStatus))
             cursor = self.conn.cursor()
-            cursor.execute(sql)
+            cursor.execute("SELECT `historyStatus`, `historyCount`, `historyTime` > NOW() - INTERVAL %%s SECOND FROM `%s` WHERE `id` = 1" % (self.clusterstatuslatesttablename),
+                    (interval,))
+            rows = cursor.fetchall()
+            if len(rows) > 0 and rows[0][2]:
+                cursor.execute("UPDATE `%s` SET `status` = %%s, `time` = NOW() WHERE `id` = 1" % (self.clusterstatuslatesttablename),
+                        (payload,))
+            else:
+                history_status, history_count = None, 0
+                if len(rows) > 0 and rows[0][0] is not None:
+                    history_status, history_count = DecompressStatus(rows[0][0]), rows[0][1]
+                if history_status is None or history_count % keyframe_interval == 0:
+                    entry, keyframe = payload, True
+                else:
+                    entry = bytearray(CompressStatus(DiffStatus(ToKeyedStatus(history_status), ToKeyedStatus(clusterStatus))))
+                    keyframe = False
+                cursor.execute("INSERT INTO `%s` (`status`, `payload`, `keyframe`) VALUES ('', %%s, %%s)" % (self.clusterstatustablename),
+                        (entry, keyframe))
+                # a bounded batch per call, not to hold a long lock on a table
+                # filled up by older versions
+                cursor.execute("DELETE FROM `%s` WHERE `time` < NOW() - INTERVAL %%s DAY LIMIT 1000" % (self.clusterstatustablename),
+                        (retention_days,))
+                cursor.execute("""INSERT INTO `%s` (`id`, `status`, `time`, `historyStatus`, `historyTime`, `historyCount`)
+                        VALUES (1, %%s, NOW(), %%s, NOW(), %%s)
+                        ON DUPLICATE KEY UPDATE `status` = VALUES(`status`), `time` = VALUES(`time`),
+                        `historyStatus` = VALUES(`historyStatus`), `historyTime` = VALUES(`historyTime`),
+                        `historyCount` = VALUES(`historyCount`)""" % (self.clusterstatuslatesttablename),
+                        (payload, payload, history_count + 1))
             self.conn.commit()
             cursor.close()
             return True
@@ -937,20 +1576,104 @@ class DataHandler(object):
     @record
     def GetClusterStatus(self):
         cursor = self.conn.cursor()
-        query = "SELECT `time`, `status` FROM `%s` order by `time` DESC limit 1" % (self.clusterstatustablename)
+        query = "SELECT `time`, `status` FROM `%s` WHERE `id` = 1" % (self.clusterstatuslatesttablename)
         ret = None
         time = None
         try:
             cursor.execute(query)
-            for (t, value) in cursor:
-                ret = json.loads(base64.b64decode(value))
+            for (t, value) in cursor.fetchall():
+                ret = DecompressStatus(value)
                 time = t
+            if ret is None:
+                # written by older versions
+                query = "SELECT `time`, `status` FROM `%s` WHERE `payload` IS NULL order by `time` DESC limit 1" % (self.clusterstatustablename)
+                cursor.execute(query)
+                for (t, value) in cursor.fetchall():
+                    ret = json.loads(base64.b64decode(value))
+                    time = t
         except Exception as e:
             logger.error('Exception: %s', str(e))
         self.conn.commit()
         cursor.close()
         return ret, time
 
+    @record
+    def UpdateVcUsage(self, vcUsage):
+        """ Replaces usage of all vcs by vcUsage, vcName -> usage of the vc
+        (see vc_usage.compute_vc_usage), in one transaction """
+        try:
+            cursor = self.conn.cursor()
+            if len(vcUsage) > 0:
+                cursor.execute("DELETE FROM `%s` WHERE `vcName` NOT IN (%s)" % (self.vcusagetablename, ",".join(["%s"] * len(vcUsage))),
+                        tuple(vcUsage.keys()))
+                cursor.executemany("""INSERT INTO `%s` (`vcName`, `status`, `time`) VALUES (%%s, %%s, NOW())
+                        ON DUPLICATE KEY UPDATE `status` = VALUES(`status`), `time` = VALUES(`time`)""" % (self.vcusagetablename),
+                        [(vc_name, json.dumps(usage)) for vc_name, usage in vcUsage.items()])
+            else:
+                cursor.execute("DELETE FROM `%s`" % (self.vcusagetablename))
+            self.conn.commit()
+            cursor.close()
+            return True
+        except Exception as e:
+            logger.error('Exception: %s', str(e))
+            return False
+
+    @record
+    def GetVcUsage(self, vcName=None, maxAge=None):
+        """ vcName -> usage of vcName, or of all vcs if vcName is None. With
+        maxAge, usage not updated in maxAge seconds is left out. """
+        cursor = self.conn.cursor()
+        conditions = []
+        params = []
+        if vcName is not None:
+            conditions.append("`vcName` = %s")
+            params.append(vcName)
+        if maxAge is not None:
+            conditions.append("`time` > NOW() - INTERVAL %s SECOND")
+            params.append(maxAge)
+        query = "SELECT `vcName`, `status` FROM `%s`" % (self.vcusagetablename)
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        ret = {}
+        try:
+            cursor.execute(query, tuple(params))
+            for (vc_name, status) in cursor.fetchall():
+                ret[vc_name] = json.loads(status)
+        except Exception as e:
+            logger.error('Exception: %s', str(e))
+        self.conn.commit()
+        cursor.close()
+        return ret
+
+    @record
+    def GetClusterStatusHistory(self, startTime, endTime):
+        """ Returns [(time, cluster status)] of history between startTime and
+        endTime, replayed from the last keyframe before startTime """
+        cursor = self.conn.cursor()
+        ret = []
+        try:
+            cursor.execute("SELECT MAX(`id`) FROM `%s` WHERE `keyframe` = 1 AND `payload` IS NOT NULL AND `time` <= %%s" % (self.clusterstatustablename),
+                    (startTime,))
+            (start_id,) = cursor.fetchall()[0]
+            cursor.execute("SELECT `id`, `time`, `payload`, `keyframe` FROM `%s` WHERE `id` >= %%s AND `time` <= %%s AND `payload` IS NOT NULL ORDER BY `id`" % (self.clusterstatustablename),
+                    (start_id or 0, endTime))
+            status = None
+            for (id, t, payload, keyframe) in cursor.fetchall():
+                if keyframe:
+                    status = ToKeyedStatus(DecompressStatus(payload))
+                elif status is None:
+                    # its keyframe is dropped by retention
+                    continue
+                else:
+                    status = PatchStatus(status, DecompressStatus(payload))
+                if t >= startTime:
+                    ret.append((t, FromKeyedStatus(status)))
+        except Exception as e:
+            logger.error('Exception: %s', str(e))
+        self.conn.commit()
+        cursor.close()
+        return ret
+
 
     @record
     def GetUsers(self):
@@ -967,6 +1690,22 @@ class DataHandler(object):
         cursor.close()
         return ret
 
+    @record
+    def GetUsersSince(self, lastId, limit=1000):
+        """ [(id, identityName, uid)] of identities added after the one with
+        id lastId, in the order they were added """
+        cursor = self.conn.cursor()
+        query = "SELECT `id`,`identityName`,`uid` FROM `%s` WHERE `id` > %%s ORDER BY `id` LIMIT %%s" % (self.identitytablename)
+        ret = []
+        try:
+            cursor.execute(query, (lastId, limit))
+            ret = [(id, identityName, uid) for (id, identityName, uid) in cursor.fetchall()]
+        except Exception as e:
+            logger.error('Exception: %s', str(e))
+        self.conn.commit()
+        cursor.close()
+        return ret
+
     @record
     def GetActiveJobsCount(self):
         cursor = self.conn.cursor()
@@ -1063,10 +1802,16 @@ class DataHandler(object):
 
     def Close(self):
         ### !!! DataHandler is not threadsafe object, a same object cannot be used in multiple threads
+        conn, self.conn = getattr(self, "conn", None), None
+        if conn is None:
+            return
+        if self.conn_pid != os.getpid():
+            # inherited from parent process, leave it to parent
+            return
         try:
-            self.conn.close()
+            get_connection_pool().ReturnConnection(conn)
         except Exception as e:
-            pass
+            logger.warning("Exception: %s", str(e))
 
 
 if __name__ == '__main__':
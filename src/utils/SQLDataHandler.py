@@ -604,6 +604,11 @@ class DataHandler(object):
             logger.error('Exception: '+ str(e))
             return False
 
+    def GetAclVersion(self):
+        # changes of acl are not versioned here
+        return None
+
+
     @record
     def GetAcl(self):
         cursor = self.conn.cursor()
@@ -663,7 +668,9 @@ class DataHandler(object):
            return False
 
     @record
-    def GetJobList(self, userName, vcName, num = None, status = None, op = ("=","or")):
+    def GetJobList(self, userName, vcName, num = None, status = None, op = ("=","or"), columns = None, after = None):
+        # columns is only a hint, all columns are returned. after (paging) is
+        # not supported, callers can tell by missing id column
         ret = []
         cursor = self.conn.cursor()
         try:
@@ -782,11 +789,12 @@ class DataHandler(object):
         return ret
 
     @record
-    def FinishCommand(self,commandId):
+    def FinishCommand(self,commandId,status="run",output=None,stderr=None,exitCode=None):
+        # this table has no column for stderr and exitCode
         try:
-            sql = """update [%s] set status = 'run' where [id] = '%s' """ % (self.commandtablename, commandId)
+            sql = """update [%s] set status = ?, output = ? where [id] = ? """ % (self.commandtablename)
             cursor = self.conn.cursor()
-            cursor.execute(sql)
+            cursor.execute(sql, status, output, commandId)
             self.conn.commit()
             cursor.close()
             return True
@@ -863,6 +871,61 @@ class DataHandler(object):
             logger.error('Exception: '+ str(e))
             return False
 
+    @record
+    def UpdateJobFields(self,jobId,fields):
+        return self.BatchUpdateJobFields({jobId: fields})
+
+    @record
+    def BatchUpdateJobFields(self,jobFields,expectedStatuses=None):
+        jobFields = dict([(jobId, fields) for jobId, fields in jobFields.items() if len(fields) > 0])
+        if len(jobFields) == 0:
+            return True
+        try:
+            jobIds = sorted(jobFields.keys())
+            names = sorted(set([name for fields in jobFields.values() for name in fields]))
+            params = []
+            if len(jobIds) == 1:
+                assignments = ["[%s] = ?" % name for name in names]
+                params = [jobFields[jobIds[0]][name] for name in names]
+            else:
+                assignments = []
+                for name in names:
+                    cases = []
+                    for jobId in jobIds:
+                        if name in jobFields[jobId]:
+                            cases.append("when ? then ?")
+                            params.extend([jobId, jobFields[jobId][name]])
+                    assignments.append("[%s] = case [jobId] %s else [%s] end" % (name, " ".join(cases), name))
+            if expectedStatuses is None:
+                expectedStatuses = {}
+            conditions = []
+            unguarded = [jobId for jobId in jobIds if jobId not in expectedStatuses]
+            if len(unguarded) > 0:
+                conditions.append("[jobId] in (%s)" % ", ".join(["?"] * len(unguarded)))
+                params.extend(unguarded)
+            for jobId in jobIds:
+                if jobId in expectedStatuses:
+                    conditions.append("([jobId] = ? and [jobStatus] = ?)")
+                    params.extend([jobId, expectedStatuses[jobId]])
+            sql = """update [%s] set %s where %s""" % (self.jobtablename, ", ".join(assignments), " or ".join(conditions))
+            cursor = self.conn.cursor()
+            cursor.execute(sql, params)
+            self.conn.commit()
+            cursor.close()
+            return True
+        except Exception, e:
+            logger.error('Exception: '+ str(e))
+            return False
+
+    @record
+    def UpdateJobLog(self,jobId,log):
+        return self.UpdateJobTextField(jobId,"jobLog",base64.b64encode(log))
+
+    @record
+    def GetJobLog(self,jobId,tail=None):
+        # log is kept in jobLog column
+        return None, 0
+
     @record
     def GetJobTextField(self,jobId,field):
         cursor = self.conn.cursor()
@@ -930,6 +993,13 @@ class DataHandler(object):
         cursor.close()
         return ret, time
 
+    def UpdateVcUsage(self, vcUsage):
+        # usage of vcs is not materialized here, GetVC computes it
+        return False
+
+    def GetVcUsage(self, vcName=None, maxAge=None):
+        return {}
+
     @record
     def GetUsers(self):
         cursor = self.conn.cursor()
@@ -946,6 +1016,22 @@ class DataHandler(object):
         cursor.close()
         return ret
 
+    @record
+    def GetUsersSince(self, lastId, limit=1000):
+        cursor = self.conn.cursor()
+        query = "SELECT TOP %d [id],[identityName],[uid] FROM [%s] WHERE [id] > ? ORDER BY [id]" % (int(limit), self.identitytablename)
+        ret = []
+        try:
+            cursor.execute(query, lastId)
+            for (id,identityName,uid) in cursor:
+                ret.append((id,identityName,uid))
+        except Exception as e:
+            logger.error('Exception: '+ str(e))
+            pass
+        self.conn.commit()
+        cursor.close()
+        return ret
+
     @record
     def GetActiveJobsCount(self):
         cursor = self.conn.cursor()
@@ -0,0 +1,88 @@
+ACL_DELIMITER = "/"
+
+# ids given to identities not found in AD, never match groups of others
+INVALID_RANGE_START = 900000000
+INVALID_RANGE_END = 999999998
+
+
+class AclNode(object):
+    __slots__ = ["children", "aces"]
+
+    def __init__(self):
+        self.children = {}
+        self.aces = []
+
+
+class AclTree(object):
+    """ Access control entries in a trie by components of their resource
+    path, e.g. Cluster/VC:platform is child VC:platform of node Cluster. Aces
+    are records of acl table. """
+    def __init__(self, acl=()):
+        self.root = AclNode()
+        # in the order they are added
+        self.aces = []
+        for ace in acl:
+            self.add(ace)
+
+    def add(self, ace):
+        node = self.root
+        for name in ace["resource"].split(ACL_DELIMITER):
+            node = node.children.setdefault(name, AclNode())
+        node.aces.append(ace)
+        self.aces.append(ace)
+
+    def get_aces(self, resource_path):
+        """ Aces on resource_path and its ancestors """
+        aces = []
+        node = self.root
+        for name in resource_path.split(ACL_DELIMITER):
+            node = node.children.get(name)
+            if node is None:
+                break
+            aces.extend(node.aces)
+        return aces
+
+
+def ace_matches(ace, identity_name, groups):
+    """ groups is a set of int ids of groups the identity is in """
+    if ace["identityName"] == identity_name:
+        return True
+    ace_id = int(ace["identityId"])
+    return ace_id in groups and (ace_id < INVALID_RANGE_START or ace_id > INVALID_RANGE_END)
+
+
+def has_access(tree, identity_name, groups, resource_path, permissions):
+    """ True if aces of identity on resource_path and its ancestors grant
+    all bits of permissions """
+    #TODO: handle isDeny
+    for ace in tree.get_aces(resource_path):
+        if ace_matches(ace, identity_name, groups):
+            permissions = permissions & (~ace["permissions"])
+            if not permissions:
+                return True
+    return False
+
+
+def get_effective_permissions(tree, identity_name, groups):
+    """ resource path -> permissions of identity on it, from aces on the path
+    and its ancestors, for every resource in tree. One pass over the tree. """
+    effective = {}
+    # (node, path, permissions granted by ancestors)
+    stack = [(child, name, 0) for name, child in tree.root.children.items()]
+    while len(stack) > 0:
+        node, path, permissions = stack.pop()
+        for ace in node.aces:
+            if ace_matches(ace, identity_name, groups):
+                permissions |= ace["permissions"]
+        effective[path] = permissions
+        for name, child in node.children.items():
+            stack.append((child, path + ACL_DELIMITER + name, permissions))
+    return effective
+
+
+def get_accessible_aces(tree, identity_name, groups, permissions):
+    """ Aces of tree on resources identity has permissions on, same as
+    has_access for each ace but in one pass """
+    effective = get_effective_permissions(tree, identity_name, groups)
+    return [ace for ace in tree.aces
+            if (effective.get(ace["resource"], 0) & permissions) == permissions]
@@ -6,6 +6,8 @@ import random
 from config import config
 import time
 import threading
+from cachetools import LRUCache
+from acl import AclTree, has_access, get_accessible_aces, INVALID_RANGE_START, INVALID_RANGE_END
 
 logger = logging.getLogger(__name__)
 
@@ -18,8 +20,6 @@ def enum(*sequential, **named):
 Permission = enum(Unauthorized=0, User=1, Collaborator=3, Admin=7)
 ResourceType = enum(Cluster=1, VC=2, Job=3)
 
-INVALID_RANGE_START = 900000000
-INVALID_RANGE_END = 999999998
 INVALID_ID = 999999999
 
 INVALID_INFO = {
@@ -31,28 +31,94 @@ INVALID_INFO = {
 
 DEFAULT_EXPIRATION = 30 * 60
 
+# seconds between checks of acl version in db, for changes made by other
+# processes. Changes made by this process are seen at once.
+ACL_VERSION_CHECK_INTERVAL = 5
 
-# TODO: Replace with TTLCache in cachetools after refactoring
-class SimpleCache(object):
-    def __init__(self, expiration=DEFAULT_EXPIRATION):
+
+class AclCache(object):
+    """ All access control entries in an AclTree, and groups of identities
+    seen, so that access checks need no db query. Both are reloaded when
+    acl version in db changes. Data handlers without acl version reload
+    every DEFAULT_EXPIRATION seconds. """
+    def __init__(self, check_interval=ACL_VERSION_CHECK_INTERVAL, expiration=DEFAULT_EXPIRATION):
+        self.check_interval = check_interval
         self.expiration = expiration
         self.lock = threading.Lock()
-        self.cache = dict()
-
-    def get(self, key):
+        # only one thread reloads, others keep using the old tree
+        self.refresh_lock = threading.Lock()
+        self.tree = None
+        self.version = None
+        self.loaded_time = 0
+        self.checked_time = 0
+        # increased by invalidate, a reload in progress then keeps
+        # checked_time so that the next refresh reloads again
+        self.invalidations = 0
+        # identity name -> set of group ids
+        self.groups = LRUCache(maxsize=100000)
+
+    def invalidate(self):
         with self.lock:
-            if key in self.cache:
-                value, timestamp = self.cache[key]
-                if time.time() - timestamp <= self.expiration:
-                    return value
-            return None
+            self.checked_time = 0
+            self.loaded_time = 0
+            self.invalidations += 1
+
+    def refresh(self):
+        now = time.time()
+        if self.tree is not None and now - self.checked_time < self.check_interval:
+            return
+        if not self.refresh_lock.acquire(self.tree is None):
+            return
+        try:
+            if self.tree is not None and time.time() - self.checked_time < self.check_interval:
+                return
+            with self.lock:
+                invalidations = self.invalidations
+            data_handler = DataHandler()
+            try:
+                version = data_handler.GetAclVersion()
+                expired = version is None and now - self.loaded_time > self.expiration
+                if self.tree is None or version != self.version or expired:
+                    start_time = time.time()
+                    tree = AclTree(data_handler.GetAcl())
+                    with self.lock:
+                        self.tree = tree
+                        self.version = version
+                        if invalidations == self.invalidations:
+                            self.loaded_time = now
+                        self.groups.clear()
+                    logger.info("loaded %d aces of version %s in time %s", len(tree.aces), version, time.time() - start_time)
+                with self.lock:
+                    if invalidations == self.invalidations:
+                        self.checked_time = now
+            finally:
+                data_handler.Close()
+        finally:
+            self.refresh_lock.release()
 
-    def add(self, key, value):
+    def get_groups(self, identity_name):
         with self.lock:
-            self.cache[key] = (value, time.time())
+            groups = self.groups.get(identity_name)
+        if groups is not None:
+            return groups
+
+        data_handler = DataHandler()
+        try:
+            info = get_identity_info_from_db(data_handler, identity_name)
+            groups = set([int(x) for x in info["groups"]])
+        except Exception as e:
+            logger.warn("Failed to get identities list: %s" % e)
+            return set()
+        finally:
+            data_handler.Close()
+        # not found or failed to read, looked up again next time
+        if info is not INVALID_INFO:
+            with self.lock:
+                self.groups[identity_name] = groups
+        return groups
 
 
-resource_acl_cache = SimpleCache()
+acl_cache = AclCache()
 
 
 def get_identity_info_from_db(data_handler, identity_name):
@@ -70,8 +136,6 @@ def get_identity_info_from_db(data_handler, identity_name):
 
 
 class AuthorizationManager:
-    #TODO : Add Cache to aovid frequent DB calls
-
     CLUSTER_ACL_PATH = "Cluster"
     ACL_DELIMITER = "/"
     TYPE_NAME_DELIMITER = ":"
@@ -82,53 +146,18 @@ class AuthorizationManager:
         start_time = time.time()
         requested_access = "%s;%s;%s" % (str(identity_name), resource_acl_path, str(permissions))
 
-        value = resource_acl_cache.get(requested_access)
-        if value is not None:
-            logger.info('[cached] Yes for %s in time %s' % (requested_access, time.time() - start_time))
-            return value
-
-        data_handler = None
         try:
-            data_handler = DataHandler()
-
-            identities = []
-            try:
-                identities = get_identity_info_from_db(data_handler, identity_name)["groups"]
-                identities = map(lambda x: int(x), identities)
-            except Exception as e:
-                logger.warn("Failed to get identities list: %s" % e)
-                identities = []
-
-            #TODO: handle isDeny
-            while resource_acl_path:
-                acl = data_handler.GetResourceAcl(resource_acl_path)
-
-                for ace in acl:
-                    ace_id = int(ace["identityId"])
-                    id_in_identities = ace_id in identities
-                    id_in_range = ace_id < INVALID_RANGE_START or ace_id > INVALID_RANGE_END
-                    if ace["identityName"] == identity_name or (id_in_identities and id_in_range):
-                        permissions = permissions & (~ace["permissions"])
-                        if not permissions:
-                            logger.info('Yes for %s in time %s' % (requested_access, time.time() - start_time))
-                            resource_acl_cache.add(requested_access, True)
-                            return True
-
-                resource_acl_path = AuthorizationManager.__GetParentPath(resource_acl_path)
-
-            logger.info("No for %s in time %s" % (requested_access, time.time() - start_time))
-            resource_acl_cache.add(requested_access, False)
-            return False
+            acl_cache.refresh()
+            groups = acl_cache.get_groups(identity_name)
+            ret = has_access(acl_cache.tree, identity_name, groups, resource_acl_path, permissions)
+            logger.debug("%s for %s in time %s" % ("Yes" if ret else "No", requested_access, time.time() - start_time))
+            return ret
 
         except Exception as e:
             logger.error("Exception: %s" % e)
             logger.warn("No (exception) for %s in time %s" % (requested_access, time.time() - start_time))
             return False
 
-        finally:
-            if data_handler is not None:
-                data_handler.Close()
-
 
     @staticmethod
     def HasAccess(identityName, resourceType, resourceName, permissions):
@@ -159,6 +188,7 @@ class AuthorizationManager:
 
         finally:
             dataHandler.Close()
+            acl_cache.invalidate()
 
 
     @staticmethod
@@ -174,6 +204,7 @@ class AuthorizationManager:
 
         finally:
             dataHandler.Close()
+            acl_cache.invalidate()
 
 
     @staticmethod
@@ -189,30 +220,22 @@ class AuthorizationManager:
 
         finally:
             dataHandler.Close()
+            acl_cache.invalidate()
 
 
     # Return all access control entries (for resources on which user has read access).
     @staticmethod
     def __GetAccessibleAcl(userName, permissions):
-        dataHandler = DataHandler()
         try:           
-            acl = dataHandler.GetAcl()
-            ret = []
-
-            for ace in acl:
-                if AuthorizationManager._HasAccess(userName, ace["resource"], permissions): #resource
-                    ret.append(ace)
-
-            return ret
+            acl_cache.refresh()
+            groups = acl_cache.get_groups(userName)
+            return get_accessible_aces(acl_cache.tree, userName, groups, permissions)
 
         except Exception as e:
             logger.error('Exception: '+ str(e))
             logger.warn("Fail to get ACL for user %s, return empty list" % userName)
             return []
 
-        finally:
-            dataHandler.Close()
-
 
     @staticmethod
     def GetAcl(username):
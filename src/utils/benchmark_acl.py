@@ -0,0 +1,31 @@
+import argparse
+import random
+import timeit
+
+from acl import AclTree, has_access, get_accessible_aces
+from test_acl import random_acl
+
+
+def accessible_aces_by_has_access(tree, identity_name, groups, permissions):
+    return [ace for ace in tree.aces
+            if has_access(tree, identity_name, groups, ace["resource"], permissions)]
+
+
+def main(args):
+    rand = random.Random(args.seed)
+    tree = AclTree(random_acl(rand, args.ace_count, args.vc_count))
+    groups = set([20000 + rand.randrange(20) for _ in range(3)])
+
+    for fn in [accessible_aces_by_has_access, get_accessible_aces]:
+        elapsed = min(timeit.repeat(lambda: fn(tree, "user1", groups, 1), repeat=args.repeat, number=args.number))
+        print "%s: %.3f ms per call" % (fn.__name__, elapsed * 1000 / args.number)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmark getting acl accessible by a user")
+    parser.add_argument("--ace_count", type=int, default=10000)
+    parser.add_argument("--vc_count", type=int, default=500)
+    parser.add_argument("--number", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,25 @@
+import argparse
+import random
+import timeit
+
+import quota
+from test_quota import random_quota_input
+
+
+def main(args):
+    rand = random.Random(args.seed)
+    quota_input = random_quota_input(rand, args.vc_count, args.gpu_type_count)
+
+    for fn in [quota.calculate_vc_gpu_counts_by_dict, quota.calculate_vc_gpu_counts]:
+        elapsed = min(timeit.repeat(lambda: fn(*quota_input), repeat=args.repeat, number=args.number))
+        print "%s: %.3f ms per call" % (fn.__name__, elapsed * 1000 / args.number)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmark vc gpu counts calculation")
+    parser.add_argument("--vc_count", type=int, default=500)
+    parser.add_argument("--gpu_type_count", type=int, default=10)
+    parser.add_argument("--number", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
@@ -1,97 +1,264 @@
 from functools import wraps
+import os
 import threading
-from datetime import datetime
-from datetime import timedelta
 import time
 import Queue
 import copy
+import cPickle
 import logging
 
+from cachetools import LRUCache
+from prometheus_client import Counter, Histogram
+
+from command_channel import GetRedisConn
+
 logger = logging.getLogger(__name__)
 
+cache_request_counter = Counter("cache_requests",
+        "requests of cached functions by result (hit, stale, shared_hit or miss)",
+        labelnames=("cache", "result"))
+
+cache_refresh_histogram = Histogram("cache_refresh_latency_seconds",
+        "latency for computing a value of a cached function (seconds)",
+        buckets=(.01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0,
+            7.5, 10.0, float("inf")),
+        labelnames=("cache",))
+
+REFRESH_WORKERS = 4
+# seconds between checks of the version of a shared cache in redis
+SHARED_VERSION_CHECK_INTERVAL = 5
+# seconds redis is not used by a shared cache after it failed
+REDIS_RETRY_INTERVAL = 30
+
+
 # decorator (with different TTL for each function)
-# No removal of entries (designed for small number of entries to be always kept in memory)
-# option to invalidate specific entries
-# non-blocking (updates done by background thread; stale data returned while fetching in progress) : avoids thundering herd for data source
-def fcache(TTLInSec=30):
+# values are kept for TTLInSec, then the stale value is returned for another
+# TTLInSec while it is refreshed by a worker thread, which avoids thundering
+# herd for data source. A key is computed by one thread at a time. Values are
+# deep copied when returned unless immutable. With shared, values are also
+# kept in redis of job manager so that processes share them, and invalidate
+# of any process drops values of other processes within
+# SHARED_VERSION_CHECK_INTERVAL.
+def fcache(TTLInSec=30, maxsize=1024, immutable=False, shared=False):
     def fcache_decorator(func):
+        cache = Cache(func.__name__, func, TTLInSec, maxsize, immutable, shared)
+
         @wraps(func)
-        def wrapped_function(*args, **kwargs):
-            val = CacheManager.GetValue(func, TTLInSec, args)
-            if (None == val):
-                return func(*args)
-            return copy.deepcopy(val[0])
+        def wrapped_function(*args):
+            return cache.get(args)
+        wrapped_function.invalidate = lambda *args: cache.invalidate(args)
+        wrapped_function.cache = cache
         return wrapped_function
     return fcache_decorator
 
 
+class RefreshPool(object):
+    """ Worker threads refreshing stale values, started on first use """
+    def __init__(self, workers=REFRESH_WORKERS):
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.pid = None
 
-class CacheManager(object):
-    data = {}
-    taskQueue = Queue.Queue()
-    pendingTasks = set()
-
-    @staticmethod
-    def Invalidate(funcName, *args):
-        key = CacheManager._GetKey(funcName, args)
-        if key in CacheManager.data:
-            val = CacheManager.data[key]
-            CacheManager.data[key] = [val[0], datetime.now()]
-            logger.info("Cache invalidated %s", key)
-
-    @staticmethod
-    def GetValue(func, ttl, args):
-        val = None
-        key = CacheManager._GetKey(func.__name__, args)
-        needUpdate = False
-        if key not in CacheManager.data:
-            logger.info("Cache miss %s", key)
-            needUpdate = True
-        else:
-            val = CacheManager.data[key]
-            logger.info("Cache hit %s %s %s %s", key, str(val[1]), str(len(CacheManager.data)), str(CacheManager.taskQueue.qsize()))
-            if CacheManager._Invalid(val):
-                needUpdate = True
-
-        if needUpdate and key not in CacheManager.pendingTasks:
-            CacheManager.taskQueue.put((func, ttl, args))
-            CacheManager.pendingTasks.add(key)
-
-        return val
-
-
-    @staticmethod
-    def _GetKey(funcName, args):
-        key = funcName
-        for arg in args:
-            key += "__"
-            key += str(arg)
-        return key
-
-    @staticmethod
-    def _Invalid(value):
-        if value[1] < datetime.now():
-            return True
-        return False
-
-    @staticmethod
-    def _WorkerThreadFunc():
-        while (True):
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.pid != os.getpid():
+                # threads are not inherited by forked processes
+                self.pid = os.getpid()
+                self.queue = Queue.Queue()
+                for i in range(self.workers):
+                    t = threading.Thread(target=self.run, name="cache-refresh-" + str(i), args=(self.queue,))
+                    t.daemon = True
+                    t.start()
+            self.queue.put((fn, args))
+
+    def run(self, queue):
+        while True:
+            fn, args = queue.get()
             try:
-                while not CacheManager.taskQueue.empty():
-                    task = CacheManager.taskQueue.get()
-                    key = CacheManager._GetKey(task[0].__name__, task[2])
-                    if key in CacheManager.pendingTasks:
-                        if key not in CacheManager.data or CacheManager._Invalid(CacheManager.data[key]):
-                            result = task[0](*(task[2]))
-                            CacheManager.data[key] = [result, datetime.now() + timedelta(seconds=int(task[1]))]
-                            logger.info("Cache inserted %s", key)
-                        CacheManager.pendingTasks.remove(key)
-                time.sleep(0.001)
+                fn(*args)
             except Exception as e:
-                logger.warning('cache exception: %s', str(e))
+                logger.warning("cache refresh failed", exc_info=True)
+
+
+refresh_pool = RefreshPool()
+
+
+class Cache(object):
+    def __init__(self, name, func, ttl, maxsize=1024, immutable=False, shared=False):
+        self.name = name
+        self.func = func
+        self.ttl = ttl
+        self.immutable = immutable
+        self.shared = shared
+        self.lock = threading.Lock()
+        # args -> (value, time computed)
+        self.data = LRUCache(maxsize=maxsize)
+        # args -> Event set when the value being computed is stored
+        self.pending = {}
+        # increased by invalidate, values computed before are not stored
+        self.version = 0
+        # version in redis when shared, increased by invalidate of any process
+        self.shared_version = None
+        self.shared_checked_time = 0
+        # redis is not used before this time after it failed
+        self.redis_retry_time = 0
+
+    def get(self, args):
+        if self.shared:
+            self._check_shared_version()
+        now = time.time()
+        with self.lock:
+            entry = self.data.get(args)
+        if entry is not None and now - entry[1] < self.ttl:
+            cache_request_counter.labels(self.name, "hit").inc()
+            return self._copy(entry[0])
+
+        if entry is None and self.shared:
+            entry = self._get_shared(args)
+            if entry is not None:
+                with self.lock:
+                    self.data[args] = entry
+                if now - entry[1] < self.ttl:
+                    cache_request_counter.labels(self.name, "shared_hit").inc()
+                    return self._copy(entry[0])
+
+        if entry is not None and now - entry[1] < 2 * self.ttl:
+            cache_request_counter.labels(self.name, "stale").inc()
+            with self.lock:
+                refreshing = args in self.pending
+                if not refreshing:
+                    self.pending[args] = threading.Event()
+            if not refreshing:
+                refresh_pool.submit(self._refresh, args)
+            return self._copy(entry[0])
+
+        cache_request_counter.labels(self.name, "miss").inc()
+        with self.lock:
+            event = self.pending.get(args)
+            if event is None:
+                self.pending[args] = threading.Event()
+        if event is None:
+            return self._copy(self._refresh(args))
+        # computed by another thread
+        event.wait()
+        with self.lock:
+            entry = self.data.get(args)
+        if entry is None:
+            # failed in the other thread
+            return self._copy(self.func(*args))
+        return self._copy(entry[0])
+
+    def invalidate(self, args):
+        """ Next get of args computes a new value """
+        with self.lock:
+            self.data.pop(args, None)
+            self.version += 1
+        if self.shared:
+            # tried even when backing off, other processes keep stale values
+            # if this is lost
+            conn = GetRedisConn()
+            if conn is not None:
+                try:
+                    pipe = conn.pipeline()
+                    pipe.delete(self._get_shared_key(args))
+                    pipe.incr(self._get_version_key())
+                    pipe.execute()
+                except Exception:
+                    logger.warning("failed to invalidate %s in redis", self.name, exc_info=True)
+                    self._redis_failed()
+        logger.info("Cache invalidated %s %s", self.name, args)
+
+    def _refresh(self, args):
+        """ Computes value of args, the caller has put args in pending """
+        try:
+            with self.lock:
+                version = self.version
+                shared_version = self.shared_version
+            with cache_refresh_histogram.labels(self.name).time():
+                value = self.func(*args)
+            entry = (value, time.time())
+            with self.lock:
+                if version != self.version:
+                    return value
+                self.data[args] = entry
+            if self.shared and self._get_shared_version() == shared_version:
+                self._set_shared(args, entry)
+            return value
+        finally:
+            with self.lock:
+                event = self.pending.pop(args)
+            event.set()
+
+    def _copy(self, value):
+        if self.immutable:
+            return value
+        return copy.deepcopy(value)
+
+    def _get_redis_conn(self):
+        """ None if redis is not configured or failed recently """
+        if time.time() < self.redis_retry_time:
+            return None
+        return GetRedisConn()
+
+    def _redis_failed(self):
+        self.redis_retry_time = time.time() + REDIS_RETRY_INTERVAL
+
+    def _get_version_key(self):
+        return "cache:%s:version" % (self.name)
+
+    def _get_shared_version(self):
+        """ Version in redis, False if redis is not available """
+        conn = self._get_redis_conn()
+        if conn is None:
+            return False
+        try:
+            return conn.get(self._get_version_key())
+        except Exception:
+            logger.warning("failed to get version of %s from redis", self.name, exc_info=True)
+            self._redis_failed()
+            return False
+
+    def _check_shared_version(self):
+        """ Drops values computed before the last invalidate of any process,
+        checked at most every SHARED_VERSION_CHECK_INTERVAL seconds """
+        now = time.time()
+        with self.lock:
+            if now - self.shared_checked_time < SHARED_VERSION_CHECK_INTERVAL:
+                return
+            self.shared_checked_time = now
+        version = self._get_shared_version()
+        if version is False:
+            return
+        with self.lock:
+            if version != self.shared_version:
+                self.data.clear()
+                self.version += 1
+                self.shared_version = version
+
+    def _get_shared_key(self, args):
+        return "cache:%s:%s" % (self.name, "__".join([str(arg) for arg in args]))
 
-workerThread = threading.Thread(target=CacheManager._WorkerThreadFunc, args=())
-workerThread.daemon = True
-workerThread.start()
+    def _get_shared(self, args):
+        conn = self._get_redis_conn()
+        if conn is None:
+            return None
+        try:
+            data = conn.get(self._get_shared_key(args))
+            if data is not None:
+                return cPickle.loads(data)
+        except Exception:
+            logger.warning("failed to get %s from redis", self.name, exc_info=True)
+            self._redis_failed()
+        return None
 
+    def _set_shared(self, args, entry):
+        conn = self._get_redis_conn()
+        if conn is None:
+            return
+        try:
+            conn.setex(self._get_shared_key(args), int(2 * self.ttl) + 1,
+                    cPickle.dumps(entry, cPickle.HIGHEST_PROTOCOL))
+        except Exception:
+            logger.warning("failed to set %s in redis", self.name, exc_info=True)
+            self._redis_failed()
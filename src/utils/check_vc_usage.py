@@ -0,0 +1,37 @@
+""" Compares usage of vcs materialized by job manager (vcusage table) with
+usage computed from active jobs in db, as GetVC did before it was
+materialized. Differences of jobs changing status between the two reads go
+away when run again after a scheduling pass.
+
+    python check_vc_usage.py
+"""
+import argparse
+import sys
+
+from DataHandler import DataHandler
+from job_params import GetJobSchedulingFields
+from vc_usage import compute_vc_usage, diff_vc_usage
+
+
+def main(args):
+    data_handler = DataHandler()
+    try:
+        materialized = data_handler.GetVcUsage(maxAge=args.max_age)
+        cluster_status, _ = data_handler.GetClusterStatus()
+        vc_list = data_handler.ListVCs()
+        jobs = [(job, GetJobSchedulingFields(job)) for job in data_handler.GetActiveJobList()]
+    finally:
+        data_handler.Close()
+
+    diffs = diff_vc_usage(compute_vc_usage(cluster_status, vc_list, jobs), materialized)
+    for vc_name, field, expected, actual in diffs:
+        print "%s %s: expected %s, materialized %s" % (vc_name, field, expected, actual)
+    print "%d vcs materialized, %d differences" % (len(materialized), len(diffs))
+    return 1 if len(diffs) > 0 else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="check usage of vcs materialized by job manager")
+    parser.add_argument("--max_age", type=int, default=None,
+            help="seconds, usage updated earlier is taken as missing")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,65 @@
+import json
+import zlib
+
+# lists in cluster status which are diffed item by item, list -> key of item
+KEYED_LISTS = {
+    "node_status": "name",
+    "user_status": "userName",
+    "user_status_preemptable": "userName",
+}
+
+
+def CompressStatus(status):
+    return zlib.compress(json.dumps(status))
+
+
+def DecompressStatus(payload):
+    return json.loads(zlib.decompress(bytes(payload)))
+
+
+def ToKeyedStatus(status):
+    """ Copy of status with KEYED_LISTS turned into dicts by key of items """
+    keyed = dict(status)
+    for name, key in KEYED_LISTS.items():
+        if isinstance(keyed.get(name), list):
+            keyed[name] = dict([(item[key], item) for item in keyed[name]])
+    return keyed
+
+
+def FromKeyedStatus(keyed):
+    status = dict(keyed)
+    for name, key in KEYED_LISTS.items():
+        if isinstance(status.get(name), dict):
+            status[name] = [status[name][item_key] for item_key in sorted(status[name])]
+    return status
+
+
+def DiffStatus(old, new):
+    """ Diff between two dicts as {"set": {key: value}, "del": [key],
+    "sub": {key: diff}}, where sub is the diff of values which are dicts on
+    both sides. Empty parts are left out. """
+    diff = {}
+    removed = [key for key in old if key not in new]
+    if len(removed) > 0:
+        diff["del"] = removed
+    for key, value in new.iteritems():
+        if key in old and old[key] == value:
+            continue
+        if isinstance(value, dict) and isinstance(old.get(key), dict):
+            diff.setdefault("sub", {})[key] = DiffStatus(old[key], value)
+        else:
+            diff.setdefault("set", {})[key] = value
+    return diff
+
+
+def PatchStatus(old, diff):
+    """ Applies DiffStatus(old, new) to old and returns new. Changed dicts
+    are copied, old is kept as it is. """
+    new = dict(old)
+    for key in diff.get("del", []):
+        new.pop(key, None)
+    for key, value in diff.get("set", {}).iteritems():
+        new[key] = value
+    for key, sub_diff in diff.get("sub", {}).iteritems():
+        new[key] = PatchStatus(new[key], sub_diff)
+    return new
@@ -0,0 +1,41 @@
+import logging
+
+import redis
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# published on when a command is added, command_manager runs pending
+# commands as soon as a message comes instead of on its next poll
+COMMAND_CHANNEL = "dlws-command-added"
+
+redis_conn = None
+
+
+def GetRedisConn():
+    """ Redis of job manager in config["job-manager"]["redis"], None if it
+    is not configured """
+    global redis_conn
+    if redis_conn is None:
+        redis_config = config.get("job-manager", {}).get("redis")
+        if not redis_config:
+            return None
+        redis_conn = redis.StrictRedis(host=redis_config["host"],
+                port=redis_config.get("port", 9300), db=0,
+                socket_timeout=redis_config.get("timeout", 1))
+    return redis_conn
+
+
+def PublishCommandAdded(jobId):
+    """ Best effort, command_manager still polls for commands when this is
+    lost """
+    conn = GetRedisConn()
+    if conn is None:
+        return False
+    try:
+        conn.publish(COMMAND_CHANNEL, jobId)
+        return True
+    except Exception:
+        logger.warning("failed to publish new command of job %s", jobId, exc_info=True)
+        return False
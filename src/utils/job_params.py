@@ -0,0 +1,72 @@
+import json
+import base64
+import logging
+import threading
+
+from cachetools import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# jobs table columns promoted from jobParams, see GetSchedulingFields
+SCHEDULING_FIELDS = ["gpuType", "totalGpu", "preemptionAllowed", "userId", "jobTrainingType"]
+
+# columns returned by GetJobList by default
+JOB_LIST_COLUMNS = ["jobId", "jobName", "userName", "vcName", "jobStatus",
+        "jobStatusDetail", "jobType", "jobDescriptionPath", "jobDescription",
+        "jobTime", "endpoints", "jobParams", "errorMsg", "jobMeta"] + SCHEDULING_FIELDS
+
+# jobId -> (jobParams blob, decoded jobParams)
+decoded_params_cache = LRUCache(maxsize=10000)
+decoded_params_lock = threading.Lock()
+
+
+def GetJobTotalGpu(jobParams):
+    numWorkers = 1
+    if "numpsworker" in jobParams:
+        numWorkers = int(jobParams["numpsworker"])
+    return int(jobParams["resourcegpu"]) * numWorkers
+
+
+def DecodeJobParams(job):
+    """ Returns decoded jobParams of a job record. Decoded result is cached by
+    jobId and reused as long as the jobParams blob is the same, so the
+    returned dict is shared and should not be modified. """
+    job_id = job["jobId"]
+    blob = job["jobParams"]
+    with decoded_params_lock:
+        cached = decoded_params_cache.get(job_id)
+    if cached is not None and cached[0] == blob:
+        return cached[1]
+
+    job_params = json.loads(base64.b64decode(blob))
+    with decoded_params_lock:
+        decoded_params_cache[job_id] = (blob, job_params)
+    return job_params
+
+
+def GetSchedulingFields(jobParams):
+    """ Values of SCHEDULING_FIELDS columns for a job """
+    try:
+        total_gpu = GetJobTotalGpu(jobParams)
+    except Exception:
+        logger.warning("invalid gpu number in jobParams of job %s", jobParams.get("jobId"))
+        total_gpu = None
+    user_id = jobParams.get("userId")
+    return {
+        "gpuType": jobParams.get("gpuType"),
+        "totalGpu": total_gpu,
+        "preemptionAllowed": bool(jobParams.get("preemptionAllowed", False)),
+        "userId": str(user_id) if user_id is not None else None,
+        "jobTrainingType": jobParams.get("jobtrainingtype"),
+    }
+
+
+def GetJobSchedulingFields(job):
+    """ SCHEDULING_FIELDS of a job record, read from columns when they are
+    filled, otherwise decoded from jobParams (jobs added before the columns
+    existed, or a data handler without these columns). """
+    if job.get("totalGpu") is not None:
+        fields = dict([(name, job.get(name)) for name in SCHEDULING_FIELDS])
+        fields["preemptionAllowed"] = bool(fields["preemptionAllowed"])
+        return fields
+    return GetSchedulingFields(DecodeJobParams(job))
@@ -22,43 +22,87 @@ from config import config, GetStoragePath
 import base64
 
 import re
+import shlex
 
 import thread
 import threading
 import random
-import pycurl
-from StringIO import StringIO
+
+from kubernetes import client, config as k8s_config, utils as k8s_client_utils
+from kubernetes.stream import stream
+from kubernetes.stream.ws_client import ERROR_CHANNEL, STDOUT_CHANNEL, STDERR_CHANNEL
 
 logger = logging.getLogger(__name__)
 
+namespace = "default"
+
+# (pid, api for requests, api for exec), created on first use so importing
+# this module needs no kubeconfig, and again in forked children, which must
+# not share connections with their parent
+k8s_api = None
+k8s_api_lock = threading.Lock()
+
+
+def get_k8s_api():
+    global k8s_api
+    with k8s_api_lock:
+        if k8s_api is None or k8s_api[0] != os.getpid():
+            k8s_config.load_kube_config()
+            # stream() swaps the request function of the api client it
+            # works on, so exec calls get an api client of their own
+            k8s_api = (os.getpid(), client.ApiClient(), client.ApiClient())
+        return k8s_api
+
+
+def get_api_client():
+    return get_k8s_api()[1]
+
+
+def get_core_api():
+    return client.CoreV1Api(get_k8s_api()[1])
+
+
+def read_json(response):
+    """ Decode response of an api call made with _preload_content=False,
+    plain dicts in the same shape as `kubectl get -o yaml` without building
+    the model objects """
+    return json.loads(response.data)
+
+
 def localize_time(date):
-    if type(date) == str:
+    if isinstance(date, basestring):
         date = datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ")
     return pytz.utc.localize(date).isoformat()
 
-def curl_get(url):
-    curl = pycurl.Curl()
-    curl.setopt(pycurl.URL, url)
-    curl.setopt(pycurl.SSL_VERIFYPEER, 1)
-    curl.setopt(pycurl.SSL_VERIFYHOST, 0)
-    curl.setopt(pycurl.CAINFO, config["certificate-authority"])
-    curl.setopt(pycurl.SSLKEYTYPE, "PEM")
-    curl.setopt(pycurl.SSLKEY, config["client-key"])
-    curl.setopt(pycurl.SSLCERTTYPE, "PEM")
-    curl.setopt(pycurl.SSLCERT, config["client-certificate"])
-    curl.setopt(curl.FOLLOWLOCATION, True)
-    buff = StringIO()
-    curl.setopt(pycurl.WRITEFUNCTION, buff.write)
-    curl.perform()
-    responseStr = buff.getvalue()
-    curl.close()
-    return responseStr
-
-
-def kubectl_create(jobfile, EXEC=True):
+
+def load_yaml_documents(jobfile):
+    with open(jobfile) as f:
+        return [doc for doc in yaml.safe_load_all(f) if doc is not None]
+
+
+def get_api_of(api_client, doc):
+    """ Api object serving doc, the same way kubernetes.utils.create_from_yaml
+    finds it """
+    group, _, version = doc["apiVersion"].partition("/")
+    if version == "":
+        version = group
+        group = "core"
+    # e.g. rbac.authorization.k8s.io is served by RbacAuthorizationV1Api
+    group = "".join(group.rsplit(".k8s.io", 1))
+    group = "".join(word.capitalize() for word in group.split("."))
+    return getattr(client, "{0}{1}Api".format(group, version.capitalize()))(api_client)
+
+
+def kind_to_snake(kind):
+    return re.sub("([a-z0-9])([A-Z])", r"\1_\2", re.sub("(.)([A-Z][a-z]+)", r"\1_\2", kind)).lower()
+
+
+def kubectl_create(jobfile, EXEC=True, timeout=None):
     if EXEC:
         try:
-            output = subprocess32.check_output(["bash", "-c", config["kubelet-path"] + " create -f " + jobfile])
+            k8s_client_utils.create_from_yaml(get_api_client(), jobfile,
+                    namespace=namespace, _request_timeout=timeout)
+            output = jobfile + " created"
         except Exception as e:
             logger.exception("kubectl create")
             output = ""
@@ -70,9 +114,15 @@ def kubectl_create(jobfile, EXEC=True):
 def kubectl_delete(jobfile, EXEC=True):
     if EXEC:
         try:
-            cmd = "bash -c '" + config["kubelet-path"] + " delete -f " + jobfile + "'"
-            logger.info("executing %s", cmd)
-            output = os.system(cmd)
+            logger.info("deleting %s", jobfile)
+            api_client = get_api_client()
+            for doc in load_yaml_documents(jobfile):
+                api = get_api_of(api_client, doc)
+                delete = getattr(api, "delete_namespaced_" + kind_to_snake(doc["kind"]))
+                delete(doc["metadata"]["name"],
+                        doc["metadata"].get("namespace", namespace),
+                        body=client.V1DeleteOptions())
+            output = 0
         except Exception as e:
             logger.exception("kubectl delete")
             output = -1
@@ -80,6 +130,60 @@ def kubectl_delete(jobfile, EXEC=True):
         output = -1
     return output
 
+
+def exec_pod_command(pod_name, command, timeout=None):
+    """ Runs `kubectl exec pod_name -- command`, command is a list or a string
+    split as a shell would. Returns (exit code, stdout, stderr), exit code is
+    None if command timed out. Raises if exec could not be started. """
+    if isinstance(command, basestring):
+        command = shlex.split(command)
+    exec_api = client.CoreV1Api(get_k8s_api()[2])
+    resp = stream(exec_api.connect_get_namespaced_pod_exec,
+            pod_name,
+            namespace,
+            command=command,
+            stderr=True,
+            stdin=False,
+            stdout=True,
+            tty=False,
+            _preload_content=False)
+    try:
+        resp.run_forever(timeout=timeout)
+        stdout = resp.read_channel(STDOUT_CHANNEL)
+        stderr = resp.read_channel(STDERR_CHANNEL)
+        err = resp.read_channel(ERROR_CHANNEL)
+        if not err:
+            return None, stdout, stderr
+        err = json.loads(err)
+        if err["status"] == "Success":
+            return 0, stdout, stderr
+        try:
+            exit_code = int(err["details"]["causes"][0]["message"])
+        except Exception:
+            # failed to run the command at all, e.g. executable not found
+            exit_code = -1
+            stderr += err.get("message", "")
+        return exit_code, stdout, stderr
+    finally:
+        resp.close()
+
+
+def pod_exec(pod_name, command, timeout=None):
+    """ Same as `kubectl exec pod_name -- command`, see exec_pod_command.
+    Returns stdout, "" if command failed or timed out. """
+    try:
+        exit_code, stdout, stderr = exec_pod_command(pod_name, command, timeout)
+        if exit_code is None:
+            logger.warning("exec on pod %s timeout, cmd: %s", pod_name, command)
+            return ""
+        if exit_code != 0:
+            logger.warning("exec on pod %s failed, cmd: %s, exit code: %s, stderr: %s", pod_name, command, exit_code, stderr)
+            return ""
+        return stdout
+    except Exception as e:
+        logger.exception("exec on pod %s", pod_name)
+        return ""
+
 # timeout=0 means never timeout
 
 
@@ -103,6 +207,18 @@ def Split(text, spliter):
     return [x for x in text.split(spliter) if len(x.strip()) > 0]
 
 
+def kubectl_get_pod(selector):
+    podInfo = {}
+    try:
+        output = kubectl_exec(" get pod -o yaml -l " + selector)
+        podInfo = yaml.load(output)
+    except Exception as e:
+        logger.exception("kubectl get pod")
+        podInfo = None
+    return podInfo
+
+
+# used by deploy.py, which only has kubectl but no kubeconfig
 def GetServiceAddress(jobId):
     ret = []
 
@@ -145,7 +261,7 @@ def GetServiceAddress(jobId):
             selector += "{0}={1}".format(label, svc["spec"]["selector"][label])
             labelIndex += 1
         if selector is not None:
-            podInfo = GetPod(selector)
+            podInfo = kubectl_get_pod(selector)
             if podInfo is not None and "items" in podInfo:
                 for item in podInfo["items"]:
                     if "status" in item and "hostIP" in item["status"]:
@@ -170,14 +286,28 @@ def GetServiceAddress(jobId):
 def GetPod(selector):
     podInfo = {}
     try:
-        output = kubectl_exec(" get pod -o yaml -l " + selector)
-        podInfo = yaml.load(output)
+        podInfo = read_json(get_core_api().list_namespaced_pod(
+            namespace, label_selector=selector, _preload_content=False))
     except Exception as e:
-        logger.exception("kubectl get pod")
+        logger.exception("get pod")
         podInfo = None
     return podInfo
 
 
+def read_pod_log(pod_name, tail=None, since_seconds=None, timestamps=False):
+    """ Same as `kubectl logs pod_name`, "" if failed """
+    kwargs = {"_preload_content": False, "timestamps": timestamps}
+    if tail is not None:
+        kwargs["tail_lines"] = int(tail)
+    if since_seconds is not None:
+        kwargs["since_seconds"] = int(since_seconds)
+    try:
+        return get_core_api().read_namespaced_pod_log(pod_name, namespace, **kwargs).data
+    except Exception as e:
+        logger.exception("read log of pod %s", pod_name)
+        return ""
+
+
 def GetLog(jobId, tail=None):
     # assume our job only one container per pod.
 
@@ -194,10 +324,7 @@ def GetLog(jobId, tail=None):
                 if "status" in item and "containerStatuses" in item["status"] and "containerID" in item["status"]["containerStatuses"][0]:
                     containerID = item["status"]["containerStatuses"][0]["containerID"].replace("docker://", "")
                     log["containerID"] = containerID
-                    if tail is not None:
-                        log["containerLog"] = kubectl_exec(" logs %s --tail=%s" % (log["podName"], str(tail)))
-                    else:
-                        log["containerLog"] = kubectl_exec(" logs " + log["podName"])
+                    log["containerLog"] = read_pod_log(log["podName"], tail)
                     logs.append(log)
     return logs
 
@@ -243,19 +370,11 @@ def check_pod_status(pod):
     return "Unknown"
 
 
-def get_pod_events(pod):
-    description = kubectl_exec("describe pod %s" % pod["metadata"]["name"])
-    ret = []
-    for line in description.split("\n"):
-        if "fit failure summary on nodes" in line:
-             ret += [item.strip() for item in line.replace("fit failure summary on nodes : ", "").replace("(.*)", "").strip().split(",")]
-    return ret
-
-
 def get_pod_pending_detail(pod):
-    description = kubectl_exec("describe pod %s" % pod["metadata"]["name"])
+    events = get_pod_events(pod["metadata"]["name"])
     ret = []
-    for line in description.split("\n"):
+    for event in events.get("items", []):
+        line = event.get("message") or ""
         if "fit failure summary on nodes" in line:
              ret += [item.strip() for item in line.replace("fit failure summary on nodes : ", "").replace("(.*)", "").strip().split(",")]
     return ret
@@ -267,10 +386,8 @@ def check_pending_reason(pod, reason):
 
 
 def get_pod_events(podname):
-    url = "%s/api/v1/namespaces/default/events?fieldSelector=involvedObject.name=%s" % (config["apiserver"], podname)
-    responseStr = curl_get(url)
-    events = json.loads(responseStr)
-    return events
+    return read_json(get_core_api().list_namespaced_event(namespace,
+        field_selector="involvedObject.name=%s" % podname, _preload_content=False))
 
 
 def get_pod_unscheduled_reason(podname):
@@ -366,10 +483,13 @@ def GetJobStatus(jobId):
     return output, detail
 
 
+def get_nodes():
+    """ Same as `kubectl get nodes -o yaml` """
+    return read_json(get_core_api().list_node(_preload_content=False))
+
+
 def get_node_labels(key):
-    url = "%s/api/v1/nodes" % (config["apiserver"])
-    responseStr = curl_get(url)
-    nodes = json.loads(responseStr)
+    nodes = get_nodes()
     ret = []
 
     if "items" in nodes:
@@ -2,6 +2,8 @@ import math
 import collections
 import logging
 
+import numpy as np
+
 logger = logging.getLogger(__name__)
 
 
@@ -22,6 +24,9 @@ logger = logging.getLogger(__name__)
 # * used gpu: Ui
 # * available gpu: Ai
 # * unschedulable gpu: Qi - Ui - Ai
+#
+# All the above is computed on matrices indexed by (vc, gpu_type), see
+# calculate_vc_gpu_counts_by_dict for the same computation on maps.
 def calculate_vc_gpu_counts(cluster_total, cluster_available, cluster_unschedulable, vc_info, vc_usage):
     logger.debug("cluster_total %s, cluster_available %s, cluster_unschedulable %s",
             cluster_total, cluster_available, cluster_unschedulable)
@@ -31,6 +36,86 @@ def calculate_vc_gpu_counts(cluster_total, cluster_available, cluster_unschedula
     vc_available = collections.defaultdict(lambda : {})
     vc_unschedulable = collections.defaultdict(lambda : {})
 
+    vc_names = list(vc_info.keys())
+    gpu_types = sorted(set(gpu_type for gpu_info in vc_info.values() for gpu_type in gpu_info))
+    gpu_index = dict((gpu_type, i) for i, gpu_type in enumerate(gpu_types))
+
+    for vc_name, vc_usage_info in vc_usage.items():
+        if vc_name not in vc_info:
+            if len(vc_usage_info) > 0:
+                logger.warning("ignore used gpu in %s, but vc quota do not have this vc, possible due to job template error", vc_name)
+            continue
+        ignored = [gpu_type for gpu_type in vc_usage_info if gpu_type not in vc_info[vc_name]]
+        if len(ignored) > 0:
+            logger.warning("ignore used gpu %s in %s, but vc quota do not have this gpu_type", ignored, vc_name)
+
+    # one row a vc, one column a gpu type, cells without quota stay 0. cells
+    # holds (vc_name, gpu_type) of each quota in the same order as rows/cols
+    cells = []
+    rows = []
+    cols = []
+    totals = []
+    useds = []
+    for row, vc_name in enumerate(vc_names):
+        usage_info = vc_usage.get(vc_name, {})
+        for gpu_type, total in vc_info[vc_name].items():
+            cells.append((vc_name, gpu_type))
+            rows.append(row)
+            cols.append(gpu_index[gpu_type])
+            totals.append(total)
+            useds.append(usage_info.get(gpu_type, 0))
+
+    shape = (len(vc_names), len(gpu_types))
+    quota = np.zeros(shape)
+    quota[rows, cols] = totals
+    used = np.zeros(shape)
+    used[rows, cols] = useds
+
+    # cluster wide counts, as a row to broadcast over vcs
+    unschedulable = np.array([float(cluster_unschedulable.get(gpu_type, 0)) for gpu_type in gpu_types])
+    available = np.array([float(cluster_available.get(gpu_type, 0)) for gpu_type in gpu_types])
+
+    vc_quota_sum = quota.sum()
+    if vc_quota_sum == 0:
+        vc_quota = quota
+    else:
+        vc_quota = quota - np.ceil(unschedulable * quota / vc_quota_sum)
+
+    ratio = np.maximum(vc_quota - used, 0)
+    ratio_sum = ratio.sum()
+
+    logger.debug("ratio %s, ratio_sum %s", ratio, ratio_sum)
+
+    if ratio_sum == 0:
+        vc_avail = np.zeros(shape)
+    else:
+        vc_avail = np.floor(available * ratio / ratio_sum)
+    vc_unsched = np.maximum(quota - used - vc_avail, 0)
+
+    cell_avail = vc_avail[rows, cols].astype(int).tolist()
+    cell_unsched = vc_unsched[rows, cols].astype(int).tolist()
+    for (vc_name, gpu_type), total, cur_used, avail, unsched in zip(cells, totals, useds, cell_avail, cell_unsched):
+        vc_total[vc_name][gpu_type] = total
+        vc_used[vc_name][gpu_type] = cur_used
+        vc_available[vc_name][gpu_type] = avail
+        vc_unschedulable[vc_name][gpu_type] = unsched
+
+    logger.debug("vc_total %s, vc_used %s, vc_available %s, vc_unschedulable %s",
+            vc_total, vc_used, vc_available, vc_unschedulable)
+    return vc_total, vc_used, vc_available, vc_unschedulable
+
+
+# Original implementation of calculate_vc_gpu_counts, kept as the reference of
+# its tests and benchmark.
+def calculate_vc_gpu_counts_by_dict(cluster_total, cluster_available, cluster_unschedulable, vc_info, vc_usage):
+    logger.debug("cluster_total %s, cluster_available %s, cluster_unschedulable %s",
+            cluster_total, cluster_available, cluster_unschedulable)
+    logger.debug("vc_info %s, vc_usage %s", vc_info, vc_usage)
+    vc_total = collections.defaultdict(lambda : {})
+    vc_used = collections.defaultdict(lambda : {})
+    vc_available = collections.defaultdict(lambda : {})
+    vc_unschedulable = collections.defaultdict(lambda : {})
+
     vc_quota_sum = 0
     for vc_name, gpu_info in vc_info.items():
         for gpu_type, total in gpu_info.items():
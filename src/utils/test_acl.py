@@ -0,0 +1,93 @@
+import random
+import unittest
+
+from acl import AclTree, has_access, get_effective_permissions, get_accessible_aces, INVALID_RANGE_START
+
+
+def ace(identity_name, identity_id, resource, permissions):
+    return {
+        "identityName": identity_name,
+        "identityId": identity_id,
+        "resource": resource,
+        "permissions": permissions,
+        "isDeny": 0,
+    }
+
+
+class TestAclTree(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = AclTree([
+            ace("Administrator", 0, "Cluster", 7),
+            ace("alice", 10001, "Cluster/VC:platform", 3),
+            ace("CCSAdmins", 20000, "Cluster/VC:vc1", 1),
+            ace("bob", INVALID_RANGE_START + 1, "Cluster/VC:vc1", 7),
+        ])
+
+    def test_get_aces(self):
+        self.assertEqual(["Administrator", "alice"],
+                [a["identityName"] for a in self.tree.get_aces("Cluster/VC:platform")])
+        self.assertEqual(["Administrator"],
+                [a["identityName"] for a in self.tree.get_aces("Cluster/VC:unknown")])
+        self.assertEqual([], self.tree.get_aces("Other"))
+        self.assertEqual(4, len(self.tree.aces))
+
+    def test_inherited(self):
+        self.assertTrue(has_access(self.tree, "Administrator", set(), "Cluster/VC:vc1", 7))
+        self.assertTrue(has_access(self.tree, "alice", set(), "Cluster/VC:platform", 3))
+        self.assertFalse(has_access(self.tree, "alice", set(), "Cluster/VC:platform", 7))
+        self.assertFalse(has_access(self.tree, "alice", set(), "Cluster/VC:vc1", 1))
+
+    def test_groups(self):
+        self.assertTrue(has_access(self.tree, "carol", set([20000]), "Cluster/VC:vc1", 1))
+        self.assertFalse(has_access(self.tree, "carol", set([20000]), "Cluster/VC:vc1", 3))
+        # ids of identities not in AD never match by group
+        self.assertFalse(has_access(self.tree, "dave", set([INVALID_RANGE_START + 1]), "Cluster/VC:vc1", 1))
+        self.assertTrue(has_access(self.tree, "bob", set(), "Cluster/VC:vc1", 7))
+
+    def test_permissions_combined(self):
+        tree = AclTree([
+            ace("alice", 10001, "Cluster", 1),
+            ace("Users", 20001, "Cluster/VC:vc1", 2),
+        ])
+        self.assertTrue(has_access(tree, "alice", set([20001]), "Cluster/VC:vc1", 3))
+        self.assertFalse(has_access(tree, "alice", set(), "Cluster/VC:vc1", 3))
+
+
+def random_acl(rand, ace_count, vc_count=50, user_count=200, group_count=20):
+    acl = [ace("Administrator", 0, "Cluster", 7)]
+    for i in range(ace_count):
+        if rand.random() < 0.5:
+            identity_name, identity_id = "user%d" % rand.randrange(user_count), 10000 + i
+        else:
+            group = rand.randrange(group_count)
+            identity_name, identity_id = "group%d" % group, 20000 + group
+        resource = rand.choice(["Cluster", "Cluster/VC:vc%d" % rand.randrange(vc_count)])
+        acl.append(ace(identity_name, identity_id, resource, rand.choice([1, 3, 7])))
+    return acl
+
+
+class TestAccessibleAces(unittest.TestCase):
+
+    def test_effective_permissions(self):
+        tree = AclTree([
+            ace("alice", 10001, "Cluster", 1),
+            ace("Users", 20001, "Cluster/VC:vc1", 2),
+            ace("bob", 10002, "Cluster/VC:vc2", 7),
+        ])
+        self.assertEqual({"Cluster": 1, "Cluster/VC:vc1": 3, "Cluster/VC:vc2": 1},
+                get_effective_permissions(tree, "alice", set([20001])))
+
+    def test_same_as_has_access(self):
+        rand = random.Random(0)
+        tree = AclTree(random_acl(rand, 1000))
+        for identity_name in ["user1", "user2", "group3", "Administrator"]:
+            groups = set([20000 + rand.randrange(20) for _ in range(3)])
+            for permissions in [1, 3, 7]:
+                expected = [a for a in tree.aces
+                        if has_access(tree, identity_name, groups, a["resource"], permissions)]
+                self.assertEqual(expected, get_accessible_aces(tree, identity_name, groups, permissions))
+
+
+if __name__ == '__main__':
+    unittest.main()
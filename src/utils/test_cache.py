@@ -0,0 +1,213 @@
+import unittest
+import threading
+import time
+
+import cache
+from cache import fcache, Cache
+
+
+class Counter(object):
+    def __init__(self, delay=0):
+        self.calls = 0
+        self.delay = delay
+        self.lock = threading.Lock()
+
+    def __call__(self, key):
+        with self.lock:
+            self.calls += 1
+            calls = self.calls
+        time.sleep(self.delay)
+        return {"key": key, "calls": calls}
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.calls = []
+
+    def delete(self, key):
+        self.calls.append(lambda: self.conn.delete(key))
+
+    def incr(self, key):
+        self.calls.append(lambda: self.conn.incr(key))
+
+    def execute(self):
+        for call in self.calls:
+            call()
+
+
+class FailingRedis(object):
+    def __init__(self):
+        self.calls = 0
+
+    def get(self, key):
+        self.calls += 1
+        raise IOError("redis is down")
+
+    def setex(self, key, ttl, value):
+        self.calls += 1
+        raise IOError("redis is down")
+
+
+class TestCache(unittest.TestCase):
+
+    def test_hit(self):
+        func = Counter()
+        cache = Cache("test_hit", func, 30)
+        self.assertEqual(1, cache.get(("a",))["calls"])
+        self.assertEqual(1, cache.get(("a",))["calls"])
+        self.assertEqual(2, cache.get(("b",))["calls"])
+        self.assertEqual(2, func.calls)
+
+    def test_copy(self):
+        cache = Cache("test_copy", Counter(), 30)
+        cache.get(("a",))["calls"] = 100
+        self.assertEqual(1, cache.get(("a",))["calls"])
+
+        cache = Cache("test_immutable", Counter(), 30, immutable=True)
+        self.assertTrue(cache.get(("a",)) is cache.get(("a",)))
+
+    def test_maxsize(self):
+        func = Counter()
+        cache = Cache("test_maxsize", func, 30, maxsize=2)
+        for key in ["a", "b", "c", "a"]:
+            cache.get((key,))
+        self.assertEqual(4, func.calls)
+
+    def test_invalidate(self):
+        func = Counter()
+        cache = Cache("test_invalidate", func, 30)
+        cache.get(("a",))
+        cache.invalidate(("a",))
+        self.assertEqual(2, cache.get(("a",))["calls"])
+
+    def test_stale_refreshed_in_background(self):
+        func = Counter()
+        cache = Cache("test_stale", func, 0.2)
+        cache.get(("a",))
+        time.sleep(0.25)
+        # stale value is returned while refreshing
+        self.assertEqual(1, cache.get(("a",))["calls"])
+        for _ in range(50):
+            if func.calls == 2 and cache.get(("a",))["calls"] == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(2, cache.get(("a",))["calls"])
+
+    def test_expired(self):
+        func = Counter()
+        cache = Cache("test_expired", func, 0.1)
+        cache.get(("a",))
+        time.sleep(0.25)
+        self.assertEqual(2, cache.get(("a",))["calls"])
+
+    def test_single_flight(self):
+        func = Counter(delay=0.2)
+        cache = Cache("test_single_flight", func, 30)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get(("a",))["calls"]))
+                for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([1] * 5, results)
+        self.assertEqual(1, func.calls)
+
+    def test_decorator(self):
+        func = Counter()
+
+        @fcache(TTLInSec=30)
+        def cached(key):
+            return func(key)
+
+        self.assertEqual(1, cached("a")["calls"])
+        self.assertEqual(1, cached("a")["calls"])
+        cached.invalidate("a")
+        self.assertEqual(2, cached("a")["calls"])
+
+
+class TestSharedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.get_redis_conn = cache.GetRedisConn
+        self.check_interval = cache.SHARED_VERSION_CHECK_INTERVAL
+        self.redis_conn = FakeRedis()
+        cache.GetRedisConn = lambda: self.redis_conn
+        cache.SHARED_VERSION_CHECK_INTERVAL = 0
+
+    def tearDown(self):
+        cache.GetRedisConn = self.get_redis_conn
+        cache.SHARED_VERSION_CHECK_INTERVAL = self.check_interval
+
+    def test_shared(self):
+        func = Counter()
+        # caches of two processes
+        cache1 = Cache("test_shared", func, 30, shared=True)
+        cache2 = Cache("test_shared", func, 30, shared=True)
+        self.assertEqual(1, cache1.get(("a",))["calls"])
+        self.assertEqual(1, cache2.get(("a",))["calls"])
+        self.assertEqual(1, func.calls)
+
+    def test_invalidate_by_other_process(self):
+        func = Counter()
+        cache1 = Cache("test_shared_invalidate", func, 30, shared=True)
+        cache2 = Cache("test_shared_invalidate", func, 30, shared=True)
+        cache1.get(("a",))
+        cache2.get(("a",))
+        cache1.invalidate(("a",))
+        # not served from the local values of cache2
+        self.assertEqual(2, cache2.get(("a",))["calls"])
+        self.assertEqual(2, cache1.get(("a",))["calls"])
+        self.assertEqual(2, func.calls)
+
+    def test_version_checked_every_interval(self):
+        cache.SHARED_VERSION_CHECK_INTERVAL = 5
+        func = Counter()
+        cache1 = Cache("test_shared_interval", func, 30, shared=True)
+        cache2 = Cache("test_shared_interval", func, 30, shared=True)
+        cache1.get(("a",))
+        cache2.get(("a",))
+        cache1.invalidate(("a",))
+        # invalidated at once in the process itself only
+        self.assertEqual(1, cache2.get(("a",))["calls"])
+        self.assertEqual(2, cache1.get(("a",))["calls"])
+        cache2.shared_checked_time -= 5
+        self.assertEqual(3, cache2.get(("a",))["calls"])
+
+    def test_redis_failure_backed_off(self):
+        self.redis_conn = FailingRedis()
+        func = Counter()
+        cache1 = Cache("test_shared_failure", func, 30, shared=True)
+        self.assertEqual(1, cache1.get(("a",))["calls"])
+        calls = self.redis_conn.calls
+        self.assertEqual(1, calls)
+        self.assertEqual(2, cache1.get(("b",))["calls"])
+        self.assertEqual(calls, self.redis_conn.calls)
+        cache1.redis_retry_time = 0
+        cache1.get(("c",))
+        self.assertEqual(calls + 1, self.redis_conn.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
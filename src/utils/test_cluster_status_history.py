@@ -0,0 +1,56 @@
+import unittest
+import copy
+
+from cluster_status_history import CompressStatus, DecompressStatus, ToKeyedStatus, FromKeyedStatus, DiffStatus, PatchStatus
+
+
+def make_status(used=1, users=("user1",)):
+    return {
+        "gpu_used": {"P40": used},
+        "gpu_capacity": {"P40": 8},
+        "AvaliableJobNum": 3,
+        "node_status": [
+            {"name": "node1", "gpu_used": {"P40": used}, "pods": ["pod1"]},
+            {"name": "node2", "gpu_used": {}, "pods": []},
+        ],
+        "user_status": [{"userName": user, "userGPU": {"P40": used}} for user in users],
+    }
+
+
+class TestClusterStatusHistory(unittest.TestCase):
+
+    def test_compress(self):
+        status = make_status()
+        self.assertEqual(status, DecompressStatus(bytearray(CompressStatus(status))))
+
+    def test_keyed(self):
+        status = make_status(users=("user2", "user1"))
+        keyed = ToKeyedStatus(status)
+        self.assertEqual(["node1", "node2"], sorted(keyed["node_status"]))
+        self.assertEqual(["user1", "user2"],
+                [user["userName"] for user in FromKeyedStatus(keyed)["user_status"]])
+
+    def test_diff_only_changed(self):
+        old = ToKeyedStatus(make_status(used=1))
+        new = ToKeyedStatus(make_status(used=2, users=("user1", "user2")))
+        new.pop("AvaliableJobNum")
+        diff = DiffStatus(old, new)
+
+        self.assertEqual(["AvaliableJobNum"], diff["del"])
+        self.assertNotIn("gpu_capacity", diff.get("set", {}))
+        self.assertEqual(["node1"], diff["sub"]["node_status"]["sub"].keys())
+        self.assertEqual(["user2"], diff["sub"]["user_status"]["set"].keys())
+
+    def test_patch(self):
+        old = ToKeyedStatus(make_status(used=1))
+        new = ToKeyedStatus(make_status(used=3, users=("user2",)))
+        new["node_status"]["node3"] = {"name": "node3"}
+        kept = copy.deepcopy(old)
+
+        self.assertEqual(new, PatchStatus(old, DiffStatus(old, new)))
+        self.assertEqual(kept, old)
+        self.assertEqual(old, PatchStatus(old, DiffStatus(old, old)))
+
+
+if __name__ == '__main__':
+    unittest.main()
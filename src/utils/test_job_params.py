@@ -0,0 +1,77 @@
+import unittest
+import json
+import base64
+
+from job_params import DecodeJobParams, GetSchedulingFields, GetJobSchedulingFields
+
+
+def encode(job_params):
+    return base64.b64encode(json.dumps(job_params))
+
+
+class TestJobParams(unittest.TestCase):
+
+    def test_decode_cached(self):
+        job = {"jobId": "test-decode-cached", "jobParams": encode({"resourcegpu": 1})}
+        decoded = DecodeJobParams(job)
+        self.assertEqual({"resourcegpu": 1}, decoded)
+        # same blob, same object
+        self.assertIs(decoded, DecodeJobParams(dict(job)))
+
+        job["jobParams"] = encode({"resourcegpu": 2})
+        self.assertEqual({"resourcegpu": 2}, DecodeJobParams(job))
+
+    def test_scheduling_fields(self):
+        fields = GetSchedulingFields({
+            "jobId": "job1",
+            "resourcegpu": 2,
+            "numpsworker": 3,
+            "gpuType": "P40",
+            "preemptionAllowed": True,
+            "userId": 1000,
+            "jobtrainingtype": "PSDistJob",
+        })
+        self.assertEqual({
+            "gpuType": "P40",
+            "totalGpu": 6,
+            "preemptionAllowed": True,
+            "userId": "1000",
+            "jobTrainingType": "PSDistJob",
+        }, fields)
+
+    def test_scheduling_fields_default(self):
+        fields = GetSchedulingFields({"jobId": "job1", "resourcegpu": 0})
+        self.assertIsNone(fields["gpuType"])
+        self.assertEqual(0, fields["totalGpu"])
+        self.assertFalse(fields["preemptionAllowed"])
+        self.assertIsNone(fields["userId"])
+
+        self.assertIsNone(GetSchedulingFields({"jobId": "job1"})["totalGpu"])
+
+    def test_job_scheduling_fields_from_columns(self):
+        job = {
+            "jobId": "job1",
+            "jobParams": "not decodable",
+            "gpuType": "P40",
+            "totalGpu": 4,
+            "preemptionAllowed": 1,
+            "userId": "1000",
+            "jobTrainingType": "RegularJob",
+        }
+        fields = GetJobSchedulingFields(job)
+        self.assertEqual(4, fields["totalGpu"])
+        self.assertIs(True, fields["preemptionAllowed"])
+
+    def test_job_scheduling_fields_from_blob(self):
+        job = {
+            "jobId": "test-fields-from-blob",
+            "jobParams": encode({"resourcegpu": 1, "gpuType": "K80"}),
+            "totalGpu": None,
+        }
+        fields = GetJobSchedulingFields(job)
+        self.assertEqual(1, fields["totalGpu"])
+        self.assertEqual("K80", fields["gpuType"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+
+from kubernetes import client
+from kubernetes.stream.ws_client import ERROR_CHANNEL, STDOUT_CHANNEL, STDERR_CHANNEL
+
+import k8sUtils
+
+
+class FakeExecResponse(object):
+    def __init__(self, channels):
+        self.channels = channels
+        self.closed = False
+
+    def run_forever(self, timeout=None):
+        pass
+
+    def read_channel(self, channel):
+        return self.channels.get(channel, "")
+
+    def close(self):
+        self.closed = True
+
+
+class FakeStream(object):
+    def __init__(self, channels):
+        self.resp = FakeExecResponse(channels)
+        self.calls = []
+
+    def __call__(self, func, pod_name, namespace, **kwargs):
+        self.calls.append((pod_name, kwargs["command"]))
+        return self.resp
+
+
+class TestExecPodCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = k8sUtils.stream
+        self.get_k8s_api = k8sUtils.get_k8s_api
+        k8sUtils.get_k8s_api = lambda: (os.getpid(), client.ApiClient(), client.ApiClient())
+
+    def tearDown(self):
+        k8sUtils.stream = self.stream
+        k8sUtils.get_k8s_api = self.get_k8s_api
+
+    def exec_with(self, error, stdout="out", stderr="err"):
+        fake_stream = FakeStream({STDOUT_CHANNEL: stdout, STDERR_CHANNEL: stderr,
+            ERROR_CHANNEL: json.dumps(error) if error is not None else ""})
+        k8sUtils.stream = fake_stream
+        ret = k8sUtils.exec_pod_command("pod1", "ls -l '/a b'", timeout=10)
+        self.assertEqual([("pod1", ["ls", "-l", "/a b"])], fake_stream.calls)
+        self.assertTrue(fake_stream.resp.closed)
+        return ret
+
+    def test_success(self):
+        self.assertEqual((0, "out", "err"), self.exec_with({"metadata": {}, "status": "Success"}))
+
+    def test_non_zero_exit_code(self):
+        error = {
+            "status": "Failure",
+            "reason": "NonZeroExitCode",
+            "message": "command terminated with non-zero exit code",
+            "details": {"causes": [{"reason": "ExitCode", "message": "2"}]},
+        }
+        self.assertEqual((2, "out", "err"), self.exec_with(error))
+
+    def test_failure_without_exit_code(self):
+        error = {"status": "Failure", "message": "executable file not found"}
+        self.assertEqual((-1, "out", "errexecutable file not found"), self.exec_with(error))
+
+    def test_timeout(self):
+        self.assertEqual((None, "out", "err"), self.exec_with(None))
+
+    def test_pod_exec(self):
+        k8sUtils.stream = FakeStream({STDOUT_CHANNEL: "out",
+            ERROR_CHANNEL: json.dumps({"status": "Success"})})
+        self.assertEqual("out", k8sUtils.pod_exec("pod1", ["ls"]))
+        k8sUtils.stream = FakeStream({STDOUT_CHANNEL: "out"})
+        self.assertEqual("", k8sUtils.pod_exec("pod1", ["ls"]))
+
+
+class FakeServiceApi(object):
+    def __init__(self):
+        self.deleted = []
+
+    def delete_namespaced_service(self, name, namespace, body=None):
+        self.deleted.append((name, namespace))
+
+
+class TestKubectl(unittest.TestCase):
+
+    def test_kind_to_snake(self):
+        self.assertEqual("service", k8sUtils.kind_to_snake("Service"))
+        self.assertEqual("config_map", k8sUtils.kind_to_snake("ConfigMap"))
+        self.assertEqual("persistent_volume_claim", k8sUtils.kind_to_snake("PersistentVolumeClaim"))
+        self.assertEqual("stateful_set", k8sUtils.kind_to_snake("StatefulSet"))
+
+    def test_get_api_of(self):
+        api_client = client.ApiClient()
+        api = k8sUtils.get_api_of(api_client, {"apiVersion": "v1"})
+        self.assertTrue(isinstance(api, client.CoreV1Api))
+        self.assertTrue(api.api_client is api_client)
+        self.assertTrue(isinstance(k8sUtils.get_api_of(api_client, {"apiVersion": "apps/v1"}), client.AppsV1Api))
+        self.assertTrue(isinstance(k8sUtils.get_api_of(api_client, {"apiVersion": "batch/v1"}), client.BatchV1Api))
+        self.assertTrue(isinstance(k8sUtils.get_api_of(api_client, {"apiVersion": "rbac.authorization.k8s.io/v1"}),
+            client.RbacAuthorizationV1Api))
+
+    def test_kubectl_delete(self):
+        tmpdir = tempfile.mkdtemp()
+        get_api_client, get_api_of = k8sUtils.get_api_client, k8sUtils.get_api_of
+        try:
+            jobfile = os.path.join(tmpdir, "endpoint.yaml")
+            with open(jobfile, "w") as f:
+                f.write("kind: Service\napiVersion: v1\nmetadata:\n  name: endpoint1\n")
+            api = FakeServiceApi()
+            k8sUtils.get_api_client = lambda: None
+            k8sUtils.get_api_of = lambda api_client, doc: api
+            self.assertEqual(0, k8sUtils.kubectl_delete(jobfile))
+            self.assertEqual([("endpoint1", "default")], api.deleted)
+            # not existing
+            self.assertEqual(-1, k8sUtils.kubectl_delete(os.path.join(tmpdir, "missing.yaml")))
+        finally:
+            k8sUtils.get_api_client, k8sUtils.get_api_of = get_api_client, get_api_of
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+import time
+import threading
+
+from MySQLDataHandler import MySQLConnManager
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.connected = True
+        self.closed = False
+        self.rollbacks = 0
+
+    def is_connected(self):
+        return self.connected
+
+    def rollback(self):
+        if not self.connected:
+            raise Exception("lost connection")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class TestMySQLConnManager(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+        self.origin_connect = MySQLConnManager.Connect
+
+        def connect():
+            conn = FakeConnection()
+            self.created.append(conn)
+            return conn
+        MySQLConnManager.Connect = staticmethod(connect)
+
+    def tearDown(self):
+        MySQLConnManager.Connect = self.origin_connect
+
+    def test_reuse(self):
+        pool = MySQLConnManager(max_size=2, max_idle=2)
+        conn = pool.GetConnection()
+        pool.ReturnConnection(conn)
+        self.assertEqual(1, conn.rollbacks)
+        self.assertIs(conn, pool.GetConnection())
+        self.assertEqual(1, len(self.created))
+
+    def test_max_idle(self):
+        pool = MySQLConnManager(max_size=3, max_idle=1)
+        conns = [pool.GetConnection() for _ in range(3)]
+        for conn in conns:
+            pool.ReturnConnection(conn)
+        self.assertEqual(1, len(pool.idle))
+        self.assertEqual(1, pool.size)
+        self.assertEqual([False, True, True], [conn.closed for conn in conns])
+
+    def test_wait_for_returned(self):
+        pool = MySQLConnManager(max_size=1, wait_timeout=5)
+        conn = pool.GetConnection()
+
+        timer = threading.Timer(0.1, pool.ReturnConnection, args=(conn,))
+        timer.start()
+        self.assertIs(conn, pool.GetConnection())
+        timer.join()
+
+    def test_wait_timeout(self):
+        pool = MySQLConnManager(max_size=1, wait_timeout=0.1)
+        pool.GetConnection()
+        self.assertRaises(RuntimeError, pool.GetConnection)
+
+    def test_health_check(self):
+        pool = MySQLConnManager(max_size=1, check_interval=0)
+        conn = pool.GetConnection()
+        pool.ReturnConnection(conn)
+        conn.connected = False
+        time.sleep(0.01)
+
+        new_conn = pool.GetConnection()
+        self.assertIsNot(conn, new_conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(1, pool.size)
+
+    def test_broken_connection_not_returned(self):
+        pool = MySQLConnManager(max_size=1)
+        conn = pool.GetConnection()
+        conn.connected = False
+        pool.ReturnConnection(conn)
+        self.assertEqual(0, len(pool.idle))
+        self.assertEqual(0, pool.size)
+        self.assertTrue(conn.closed)
+
+    def test_connect_failure_release_slot(self):
+        def connect():
+            raise Exception("db is down")
+        MySQLConnManager.Connect = staticmethod(connect)
+
+        pool = MySQLConnManager(max_size=1, wait_timeout=0.1)
+        self.assertRaises(Exception, pool.GetConnection)
+        self.assertEqual(0, pool.size)
+
+    def test_fork(self):
+        pool = MySQLConnManager(max_size=1)
+        conn = pool.GetConnection()
+        pool.ReturnConnection(conn)
+
+        # pretend running in a forked child
+        pool.pid = -1
+        new_conn = pool.GetConnection()
+        self.assertIsNot(conn, new_conn)
+        self.assertFalse(conn.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,485 @@
+import unittest
+import os
+import json
+import base64
+import zlib
+import datetime
+
+import mysql.connector
+
+import MySQLDataHandler
+from config import config, global_vars
+from MySQLDataHandler import DataHandler, JOB_TABLE_INDEXES, JOB_TABLE_REDUNDANT_INDEXES
+from cluster_status_history import CompressStatus, DecompressStatus, ToKeyedStatus, DiffStatus
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = conn.rowcount
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append((" ".join(sql.split()), params))
+
+    def executemany(self, sql, params):
+        self.conn.executed.append((" ".join(sql.split()), params))
+
+    def fetchall(self):
+        return self.conn.results.pop(0)
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.executed = []
+        self.commits = 0
+        self.results = []
+        # rows changed by each statement
+        self.rowcount = 1
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+def create_data_handler():
+    # skip __init__, which connects to db
+    data_handler = DataHandler.__new__(DataHandler)
+    data_handler.database = "DLWSCluster-test"
+    data_handler.jobtablename = "jobs"
+    data_handler.endpointtablename = "endpoints"
+    data_handler.clusterstatustablename = "clusterstatus"
+    data_handler.clusterstatuslatesttablename = "clusterstatuslatest"
+    data_handler.joblogtablename = "joblogs"
+    data_handler.commandtablename = "commands"
+    data_handler.acltablename = "acl"
+    data_handler.aclversiontablename = "aclversion"
+    data_handler.vcusagetablename = "vcusage"
+    data_handler.conn = FakeConnection()
+    data_handler.conn_pid = None
+    return data_handler
+
+
+class TestUpdateJobFields(unittest.TestCase):
+
+    def test_update_job_fields(self):
+        data_handler = create_data_handler()
+        self.assertTrue(data_handler.UpdateJobFields("job1",
+            {"jobStatus": "running", "errorMsg": "it's ok"}))
+
+        self.assertEqual([("update `jobs` set `errorMsg` = %s, `jobStatus` = %s where `jobId` in (%s)",
+            ["it's ok", "running", "job1"])], data_handler.conn.executed)
+        self.assertEqual(1, data_handler.conn.commits)
+
+    def test_batch_update_job_fields(self):
+        data_handler = create_data_handler()
+        self.assertTrue(data_handler.BatchUpdateJobFields({
+            "job2": {"jobStatus": "running", "jobStatusDetail": "d2"},
+            "job1": {"jobStatusDetail": "d1"},
+            "job3": {},
+            }))
+
+        self.assertEqual([("update `jobs` set "
+            "`jobStatus` = case `jobId` when %s then %s else `jobStatus` end, "
+            "`jobStatusDetail` = case `jobId` when %s then %s when %s then %s else `jobStatusDetail` end "
+            "where `jobId` in (%s, %s)",
+            ["job2", "running", "job1", "d1", "job2", "d2", "job1", "job2"])],
+            data_handler.conn.executed)
+        self.assertEqual(1, data_handler.conn.commits)
+
+    def test_batch_update_job_fields_expected_status(self):
+        data_handler = create_data_handler()
+        self.assertTrue(data_handler.BatchUpdateJobFields({
+            "job2": {"jobStatus": "running"},
+            "job1": {"jobStatusDetail": "d1"},
+            }, {"job2": "scheduling"}))
+
+        self.assertEqual([("update `jobs` set "
+            "`jobStatus` = case `jobId` when %s then %s else `jobStatus` end, "
+            "`jobStatusDetail` = case `jobId` when %s then %s else `jobStatusDetail` end "
+            "where `jobId` in (%s) or (`jobId` = %s and `jobStatus` = %s)",
+            ["job2", "running", "job1", "d1", "job1", "job2", "scheduling"])],
+            data_handler.conn.executed)
+
+    def test_nothing_to_update(self):
+        data_handler = create_data_handler()
+        self.assertTrue(data_handler.BatchUpdateJobFields({"job1": {}}))
+        self.assertEqual([], data_handler.conn.executed)
+
+
+class TestJobListQuery(unittest.TestCase):
+
+    def test_all(self):
+        query, params = create_data_handler().BuildJobListQuery("all", "all",
+                columns=["jobId", "jobStatus"])
+        self.assertEqual("SELECT `jobId`, `jobStatus` FROM `jobs` WHERE 1 ORDER BY `jobTime` DESC, `id` DESC", query)
+        self.assertEqual([], params)
+
+    def test_in_status(self):
+        query, params = create_data_handler().BuildJobListQuery("all", "platform",
+                status="running,queued", columns=["jobId"])
+        self.assertEqual("SELECT `jobId` FROM `jobs` WHERE 1 AND `vcName` = %s "
+                "AND `jobStatus` IN (%s, %s) ORDER BY `jobTime` DESC, `id` DESC", query)
+        self.assertEqual(["platform", "running", "queued"], params)
+
+    def test_not_in_status(self):
+        query, params = create_data_handler().BuildJobListQuery("user", "platform",
+                num=10, status="running,queued", op=("<>", "and"), columns=["jobId"])
+        self.assertEqual("SELECT `jobId` FROM `jobs` WHERE 1 AND `userName` = %s "
+                "AND `vcName` = %s AND `jobStatus` NOT IN (%s, %s) "
+                "ORDER BY `jobTime` DESC, `id` DESC LIMIT 10", query)
+        self.assertEqual(["user", "platform", "running", "queued"], params)
+
+    def test_after(self):
+        job_time = datetime.datetime(2019, 1, 1)
+        query, params = create_data_handler().BuildJobListQuery("user", "platform",
+                num=10, columns=["jobId"], after=(job_time, 42))
+        self.assertEqual("SELECT `jobId` FROM `jobs` WHERE 1 AND `userName` = %s "
+                "AND `vcName` = %s AND (`jobTime` < %s OR (`jobTime` = %s AND `id` < %s)) "
+                "ORDER BY `jobTime` DESC, `id` DESC LIMIT 10", query)
+        self.assertEqual(["user", "platform", job_time, job_time, 42], params)
+
+
+class TestUpdateIndexes(unittest.TestCase):
+
+    def test_old_table(self):
+        data_handler = create_data_handler()
+        # indexes of jobs table created by older versions
+        data_handler.conn.results.append([
+            ("PRIMARY", "id", 0),
+            ("jobId", "jobId", 0),
+            ("jobId_2", "jobId", 1),
+            ("jobStatus", "jobStatus", 1),
+            ("jobTime", "jobTime", 1),
+            ("userName", "userName", 1),
+            ])
+        data_handler.UpdateIndexes("jobs", JOB_TABLE_INDEXES, JOB_TABLE_REDUNDANT_INDEXES)
+
+        self.assertEqual(("ALTER TABLE `jobs` "
+            "ADD INDEX `jobStatus_jobTime` (`jobStatus`, `jobTime`), "
+            "ADD INDEX `vcName_jobStatus_jobTime` (`vcName`, `jobStatus`, `jobTime`), "
+            "ADD INDEX `userName_vcName_jobTime` (`userName`, `vcName`, `jobTime`), "
+            "DROP INDEX `jobId_2`, DROP INDEX `jobStatus`, DROP INDEX `userName`", None),
+            data_handler.conn.executed[1])
+
+    def test_up_to_date(self):
+        data_handler = create_data_handler()
+        data_handler.conn.results.append([
+            ("jobId", "jobId", 0),
+            ("jobStatus_jobTime", "jobStatus", 1),
+            ("jobStatus_jobTime", "jobTime", 1),
+            ("jobTime", "jobTime", 1),
+            ("userName_vcName_jobTime", "userName", 1),
+            ("userName_vcName_jobTime", "vcName", 1),
+            ("userName_vcName_jobTime", "jobTime", 1),
+            ("vcName_jobStatus_jobTime", "vcName", 1),
+            ("vcName_jobStatus_jobTime", "jobStatus", 1),
+            ("vcName_jobStatus_jobTime", "jobTime", 1),
+            ])
+        data_handler.UpdateIndexes("jobs", JOB_TABLE_INDEXES, JOB_TABLE_REDUNDANT_INDEXES)
+        self.assertEqual(1, len(data_handler.conn.executed))
+
+
+class TestEndpoints(unittest.TestCase):
+
+    def test_update_endpoint(self):
+        data_handler = create_data_handler()
+        endpoint = {"id": "e-job1-ssh", "jobId": "job1", "status": "running"}
+        self.assertTrue(data_handler.UpdateEndpoint(endpoint))
+
+        sql, params = data_handler.conn.executed[0]
+        self.assertTrue(sql.startswith("INSERT INTO `endpoints`"))
+        self.assertEqual(("e-job1-ssh", "job1", "running"), params[:3])
+        self.assertEqual(endpoint, json.loads(params[3]))
+
+    def test_get_dead_endpoints(self):
+        data_handler = create_data_handler()
+        data_handler.conn.results.append([("e-job1-ssh", '{"id": "e-job1-ssh"}')])
+        self.assertEqual({"e-job1-ssh": {"id": "e-job1-ssh"}}, data_handler.GetDeadEndpoints())
+
+    def test_backfill(self):
+        data_handler = create_data_handler()
+        data_handler.conn.results.append([])
+        data_handler.conn.results.append([
+            ("job1", json.dumps({"e-job1-ssh": {"id": "e-job1-ssh", "status": "running"}})),
+            ("job2", "not json"),
+            ])
+        data_handler.BackfillEndpoints()
+
+        sql, params = data_handler.conn.executed[2]
+        self.assertTrue(sql.startswith("INSERT IGNORE INTO `endpoints`"))
+        self.assertEqual([("e-job1-ssh", "job1", "running", json.dumps({"id": "e-job1-ssh", "status": "running"}))],
+                params)
+
+    def test_no_backfill_once_filled(self):
+        data_handler = create_data_handler()
+        data_handler.conn.results.append([(1,)])
+        data_handler.BackfillEndpoints()
+        self.assertEqual(1, len(data_handler.conn.executed))
+
+
+class TestClusterStatus(unittest.TestCase):
+
+    def test_update_within_interval(self):
+        data_handler = create_data_handler()
+        data_handler.conn.results.append([(bytearray(CompressStatus({"gpu_used": {}})), 3, 1)])
+        self.assertTrue(data_handler.UpdateClusterStatus({"gpu_used": {"P40": 1}}))
+
+        executed = data_handler.conn.executed
+        self.assertEqual(2, len(executed))
+        self.assertTrue(executed[1][0].startswith("UPDATE `clusterstatuslatest` SET `status` = %s"))
+        self.assertEqual({"gpu_used": {"P40": 1}}, DecompressStatus(executed[1][1][0]))
+
+    def test_first_update_is_keyframe(self):
+        data_handler = create_data_handler()
+        data_handler.conn.results.append([])
+        self.assertTrue(data_handler.UpdateClusterStatus({"gpu_used": {"P40": 1}}))
+
+        executed = data_handler.conn.executed
+        self.assertTrue(executed[1][0].startswith("INSERT INTO `clusterstatus`"))
+        self.assertEqual({"gpu_used": {"P40": 1}}, DecompressStatus(executed[1][1][0]))
+        self.assertTrue(executed[1][1][1])
+        self.assertTrue(executed[2][0].startswith("DELETE FROM `clusterstatus`"))
+        self.assertTrue(executed[3][0].startswith("INSERT INTO `clusterstatuslatest`"))
+        self.assertEqual(1, executed[3][1][2])
+
+    def test_history_diff(self):
+        old = {"gpu_used": {"P40": 1}, "gpu_capacity": {"P40": 8}}
+        new = {"gpu_used": {"P40": 2}, "gpu_capacity": {"P40": 8}}
+        data_handler = create_data_handler()
+        data_handler.conn.results.append([(bytearray(CompressStatus(old)), 1, 0)])
+        self.assertTrue(data_handler.UpdateClusterStatus(new))
+
+        executed = data_handler.conn.executed
+        entry, keyframe = executed[1][1]
+        self.assertFalse(keyframe)
+        self.assertEqual({"sub": {"gpu_used": {"set": {"P40": 2}}}}, DecompressStatus(entry))
+        self.assertEqual(2, executed[3][1][2])
+
+    def test_get_old_status(self):
+        data_handler = create_data_handler()
+        data_handler.conn.results.append([])
+        data_handler.conn.results.append([("t1", base64.b64encode(json.dumps({"gpu_used": {}})))])
+        self.assertEqual(({"gpu_used": {}}, "t1"), data_handler.GetClusterStatus())
+
+    def test_history(self):
+        t = [datetime.datetime(2019, 1, 1, 0, i) for i in range(4)]
+        s = [{"node_status": [{"name": "node1", "gpu_used": {"P40": i}}]} for i in range(4)]
+        def diff(i):
+            return bytearray(CompressStatus(DiffStatus(ToKeyedStatus(s[i - 1]), ToKeyedStatus(s[i]))))
+
+        data_handler = create_data_handler()
+        data_handler.conn.results.append([(10,)])
+        data_handler.conn.results.append([
+            (10, t[0], bytearray(CompressStatus(s[0])), 1),
+            (11, t[1], diff(1), 0),
+            (12, t[2], diff(2), 0),
+            (13, t[3], diff(3), 0),
+            ])
+        self.assertEqual(list(zip(t[1:], s[1:])), data_handler.GetClusterStatusHistory(t[1], t[3]))
+
+
+class TestJobLog(unittest.TestCase):
+
+    def setUp(self):
+        self.chunk_size = MySQLDataHandler.JOB_LOG_CHUNK_SIZE
+        MySQLDataHandler.JOB_LOG_CHUNK_SIZE = 4
+
+    def tearDown(self):
+        MySQLDataHandler.JOB_LOG_CHUNK_SIZE = self.chunk_size
+
+    def chunk_rows(self, log):
+        return [(i, i * 4, len(log[i * 4:i * 4 + 4])) for i in range((len(log) + 3) // 4)]
+
+    def data_rows(self, log, first):
+        return [(i * 4, bytearray(zlib.compress(log[i * 4:i * 4 + 4])))
+                for i in range(first, (len(log) + 3) // 4)]
+
+    def test_update_job_log(self):
+        data_handler = create_data_handler()
+        self.assertTrue(data_handler.UpdateJobLog("job1", "0123456789"))
+
+        executed = data_handler.conn.executed
+        self.assertTrue(executed[0][0].startswith("INSERT INTO `joblogs`"))
+        self.assertEqual([("job1", 0, 0, 4), ("job1", 1, 4, 4), ("job1", 2, 8, 2)],
+                [row[:4] for row in executed[0][1]])
+        self.assertEqual("89", zlib.decompress(bytes(executed[0][1][2][4])))
+        self.assertEqual(("job1", 3), executed[1][1])
+        self.assertTrue(executed[2][0].startswith("UPDATE `jobs` SET `jobLog` = NULL"))
+
+    def test_tail(self):
+        log = "0123456789"
+        data_handler = create_data_handler()
+        data_handler.conn.results.append(self.chunk_rows(log))
+        data_handler.conn.results.append(self.data_rows(log, 1))
+        self.assertEqual(("789", 10), data_handler.GetJobLog("job1", tail=3))
+        # only chunks from the one with offset 7
+        self.assertEqual(("job1", 1), data_handler.conn.executed[1][1])
+
+    def test_whole_log(self):
+        log = "0123456789"
+        data_handler = create_data_handler()
+        data_handler.conn.results.append(self.chunk_rows(log))
+        data_handler.conn.results.append(self.data_rows(log, 0))
+        self.assertEqual((log, 10), data_handler.GetJobLog("job1"))
+
+        data_handler.conn.results.append(self.chunk_rows(log))
+        data_handler.conn.results.append(self.data_rows(log, 0))
+        self.assertEqual((log, 10), data_handler.GetJobLog("job1", tail=20))
+
+    def test_no_log(self):
+        data_handler = create_data_handler()
+        data_handler.conn.results.append([])
+        self.assertEqual((None, 0), data_handler.GetJobLog("job1"))
+
+
+class TestCommands(unittest.TestCase):
+
+    def test_finish_command(self):
+        data_handler = create_data_handler()
+        self.assertTrue(data_handler.FinishCommand(7, "failed", "out", "err", 2))
+        sql, params = data_handler.conn.executed[0]
+        self.assertTrue(sql.startswith("UPDATE `commands` SET `status` = %s"))
+        self.assertEqual(("failed", "out", "err", 2, 7), params)
+
+    def test_finish_command_default(self):
+        data_handler = create_data_handler()
+        self.assertTrue(data_handler.FinishCommand(7))
+        self.assertEqual(("run", None, None, None, 7), data_handler.conn.executed[0][1])
+
+
+class TestAclVersion(unittest.TestCase):
+
+    def test_delete_ace_increases_version(self):
+        data_handler = create_data_handler()
+        self.assertTrue(data_handler.DeleteAce("alice", "Cluster/VC:vc1"))
+        executed = [sql for sql, _ in data_handler.conn.executed]
+        self.assertTrue(executed[0].startswith("DELETE FROM `acl`"))
+        self.assertTrue(executed[1].startswith("INSERT INTO `aclversion`"))
+        self.assertEqual(1, data_handler.conn.commits)
+
+    def test_unchanged_identity_keeps_version(self):
+        data_handler = create_data_handler()
+        data_handler.conn.rowcount = 0
+        self.assertTrue(data_handler.UpdateAclIdentityId("alice", 10001))
+        executed = [sql for sql, _ in data_handler.conn.executed]
+        self.assertEqual(1, len(executed))
+        self.assertTrue(executed[0].startswith("update `acl`"))
+
+    def test_get_acl_version(self):
+        data_handler = create_data_handler()
+        data_handler.conn.results.append([(3,)])
+        self.assertEqual(3, data_handler.GetAclVersion())
+        data_handler.conn.results.append([])
+        self.assertEqual(0, data_handler.GetAclVersion())
+
+
+class TestVcUsage(unittest.TestCase):
+
+    def test_update_vc_usage(self):
+        data_handler = create_data_handler()
+        self.assertTrue(data_handler.UpdateVcUsage({"vc1": {"AvaliableJobNum": 1}}))
+        executed = data_handler.conn.executed
+        self.assertEqual(("DELETE FROM `vcusage` WHERE `vcName` NOT IN (%s)", ("vc1",)), executed[0])
+        self.assertTrue(executed[1][0].startswith("INSERT INTO `vcusage`"))
+        self.assertEqual([("vc1", '{"AvaliableJobNum": 1}')], executed[1][1])
+        self.assertEqual(1, data_handler.conn.commits)
+
+    def test_get_vc_usage(self):
+        data_handler = create_data_handler()
+        data_handler.conn.results.append([("vc1", '{"AvaliableJobNum": 1}')])
+        self.assertEqual({"vc1": {"AvaliableJobNum": 1}}, data_handler.GetVcUsage("vc1", 120))
+        self.assertEqual(("SELECT `vcName`, `status` FROM `vcusage` WHERE `vcName` = %s AND `time` > NOW() - INTERVAL %s SECOND",
+                ("vc1", 120)), data_handler.conn.executed[0])
+
+
+@unittest.skipUnless(os.environ.get("MYSQL_TEST_HOST"),
+        "set MYSQL_TEST_HOST, MYSQL_TEST_USER and MYSQL_TEST_PASSWORD to run against a disposable mysql")
+class TestJobsTableExplain(unittest.TestCase):
+    """ Checks hot queries of jobs table are served by an index. The test
+    database is dropped afterwards, never point it to a production server. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.origin_config = dict(config)
+        config["clusterId"] = "test-explain"
+        config["mysql"] = {
+            "hostname": os.environ["MYSQL_TEST_HOST"],
+            "username": os.environ.get("MYSQL_TEST_USER", "root"),
+            "password": os.environ.get("MYSQL_TEST_PASSWORD", ""),
+            }
+        for key in ["initSQLDB", "initSQLTable", "mysql_pool"]:
+            global_vars.pop(key, None)
+
+        cls.data_handler = DataHandler()
+        statuses = ["finished"] * 8 + ["failed", "killed", "queued", "running", "unapproved"]
+        start = datetime.datetime(2019, 1, 1)
+        rows = [("job-%d" % i, "", 0, "job", "user%d" % (i % 50), "vc%d" % (i % 5),
+            statuses[i % len(statuses)], "training", start + datetime.timedelta(minutes=i), "")
+            for i in range(5000)]
+        cursor = cls.data_handler.conn.cursor()
+        cursor.executemany("INSERT INTO `jobs` (`jobId`, `familyToken`, `isParent`, `jobName`, `userName`, `vcName`, `jobStatus`, `jobType`, `jobTime`, `jobParams`) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", rows)
+        cls.data_handler.conn.commit()
+        cursor.execute("ANALYZE TABLE `jobs`")
+        cursor.fetchall()
+        cursor.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        cursor = cls.data_handler.conn.cursor()
+        cursor.execute("DROP DATABASE `%s`" % cls.data_handler.database)
+        cursor.close()
+        cls.data_handler.Close()
+        config.clear()
+        config.update(cls.origin_config)
+        for key in ["initSQLDB", "initSQLTable", "mysql_pool"]:
+            global_vars.pop(key, None)
+
+    def explain(self, query, params=None):
+        cursor = self.data_handler.conn.cursor(dictionary=True)
+        cursor.execute("EXPLAIN " + query, params)
+        plan = cursor.fetchall()
+        cursor.close()
+        self.assertEqual(1, len(plan))
+        return plan[0]
+
+    def assertUsesIndex(self, plan, index):
+        self.assertEqual(index, plan["key"], plan)
+        self.assertNotEqual("ALL", plan["type"], plan)
+
+    def test_list_by_status(self):
+        query, params = self.data_handler.BuildJobListQuery("all", "all",
+                status="running,queued,scheduling")
+        self.assertUsesIndex(self.explain(query, params), "jobStatus_jobTime")
+
+    def test_list_by_vc_and_status(self):
+        query, params = self.data_handler.BuildJobListQuery("all", "vc1",
+                status="running,queued,scheduling,unapproved,pausing,paused")
+        self.assertUsesIndex(self.explain(query, params), "vcName_jobStatus_jobTime")
+
+    def test_list_by_user(self):
+        query, params = self.data_handler.BuildJobListQuery("user1", "vc1", num=20,
+                status="running,queued,scheduling,unapproved,pausing,paused", op=("<>", "and"))
+        plan = self.explain(query, params)
+        self.assertUsesIndex(plan, "userName_vcName_jobTime")
+        self.assertNotIn("filesort", plan["Extra"] or "")
+
+    def test_list_by_user_next_page(self):
+        query, params = self.data_handler.BuildJobListQuery("user1", "vc1", num=20,
+                status="running,queued,scheduling,unapproved,pausing,paused", op=("<>", "and"),
+                after=(datetime.datetime(2019, 1, 2), 1000))
+        plan = self.explain(query, params)
+        self.assertUsesIndex(plan, "userName_vcName_jobTime")
+        self.assertNotIn("filesort", plan["Extra"] or "")
+
+    def test_job_by_id(self):
+        plan = self.explain("SELECT `jobStatus` FROM `jobs` WHERE `jobId` = %s", ["job-1"])
+        self.assertEqual("const", plan["type"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,7 @@ import json
 import logging
 import logging.config
 import collections
+import random
 
 import quota
 
@@ -197,6 +198,47 @@ class TestQuota(unittest.TestCase):
 
         self.assertEqual(target_vc_unschedulable, vc_unschedulable)
 
+
+def random_quota_input(rand, vc_count, gpu_type_count):
+    gpu_types = ["gpu%d" % i for i in range(gpu_type_count)]
+    vc_info = {}
+    vc_usage = {}
+    for i in range(vc_count):
+        vc_name = "vc%d" % i
+        vc_info[vc_name] = dict((gpu_type, rand.randint(0, 100))
+                for gpu_type in rand.sample(gpu_types, rand.randint(0, gpu_type_count)))
+        # mostly on gpu types in quota, rarely on others
+        vc_usage[vc_name] = dict((gpu_type, rand.randint(0, 120)) for gpu_type in gpu_types
+                if rand.random() < (0.5 if gpu_type in vc_info[vc_name] else 0.02))
+    # usage of vc not in quota, possible due to job template error
+    vc_usage["unknown"] = {gpu_types[0]: 1}
+
+    cluster_total = dict((gpu_type, sum(info.get(gpu_type, 0) for info in vc_info.values()))
+            for gpu_type in gpu_types)
+    cluster_available = dict((gpu_type, rand.randint(0, total))
+            for gpu_type, total in cluster_total.items())
+    cluster_unschedulable = dict((gpu_type, rand.randint(0, total - cluster_available[gpu_type]))
+            for gpu_type, total in cluster_total.items() if rand.random() < 0.7)
+    return cluster_total, cluster_available, cluster_unschedulable, vc_info, vc_usage
+
+
+class TestQuotaByDict(unittest.TestCase):
+    """
+    calculate_vc_gpu_counts should be the same as calculate_vc_gpu_counts_by_dict
+    """
+    def test_same_as_by_dict(self):
+        rand = random.Random(0)
+        for i in range(200):
+            args = random_quota_input(rand, rand.randint(0, 20), rand.randint(1, 5))
+            self.assertEqual(quota.calculate_vc_gpu_counts_by_dict(*args),
+                    quota.calculate_vc_gpu_counts(*args), "input %s" % (args,))
+
+    def test_no_vc(self):
+        result = quota.calculate_vc_gpu_counts({"P40": 4}, {"P40": 4}, {}, {}, {})
+        self.assertEqual(({}, {}, {}, {}), result)
+        self.assertEqual({}, result[0]["not-exist"])
+
+
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s',
             level=logging.INFO)
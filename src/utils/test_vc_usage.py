@@ -0,0 +1,80 @@
+import json
+import unittest
+
+from vc_usage import compute_vc_usage, diff_vc_usage
+
+
+def job(job_id, user_name, vc_name, job_status, gpu_type, total_gpu, preemption_allowed=False):
+    return {
+        "jobId": job_id,
+        "userName": user_name,
+        "vcName": vc_name,
+        "jobStatus": job_status,
+        "gpuType": gpu_type,
+        "totalGpu": total_gpu,
+        "preemptionAllowed": preemption_allowed,
+    }
+
+
+CLUSTER_STATUS = {
+    "gpu_capacity": {"P40": 8},
+    "gpu_avaliable": {"P40": 3},
+    "gpu_reserved": {"P40": 1},
+}
+
+VC_LIST = [
+    {"vcName": "vc1", "quota": json.dumps({"P40": 5})},
+    {"vcName": "vc2", "quota": json.dumps({"P40": 3})},
+]
+
+
+class TestVcUsage(unittest.TestCase):
+
+    def setUp(self):
+        self.jobs = [
+            job("job1", "alice@example.com", "vc1", "running", "P40", 2),
+            job("job2", "bob@example.com", "vc1", "running", "P40", 1),
+            job("job3", "alice@example.com", "vc1", "scheduling", "P40", 1),
+            job("job4", "bob@example.com", "vc1", "running", "P40", 1, True),
+            job("job5", "carol@example.com", "vc2", "running", None, 1),
+        ]
+
+    def test_compute(self):
+        usage = compute_vc_usage(CLUSTER_STATUS, VC_LIST, [(j, j) for j in self.jobs])
+        self.assertEqual({
+            "gpu_capacity": {"P40": 5},
+            "gpu_used": {"P40": 4},
+            "gpu_preemptable_used": {"P40": 1},
+            "gpu_unschedulable": {"P40": 1},
+            "gpu_avaliable": {"P40": 0},
+            "AvaliableJobNum": 3,
+            "user_status": [
+                {"userName": "alice", "userGPU": {"P40": 2}},
+                {"userName": "bob", "userGPU": {"P40": 1}},
+            ],
+            "user_status_preemptable": [{"userName": "bob", "userGPU": {"P40": 1}}],
+        }, usage["vc1"])
+        # jobs without gpu type are counted but take no gpu
+        self.assertEqual(1, usage["vc2"]["AvaliableJobNum"])
+        self.assertEqual({"P40": 0}, usage["vc2"]["gpu_used"])
+        self.assertEqual([], usage["vc2"]["user_status"])
+
+    def test_diff(self):
+        expected = compute_vc_usage(CLUSTER_STATUS, VC_LIST, [(j, j) for j in self.jobs])
+        # as read back from db
+        materialized = json.loads(json.dumps(expected))
+        self.assertEqual([], diff_vc_usage(expected, materialized))
+
+        self.jobs[1]["jobStatus"] = "finished"
+        actual = compute_vc_usage(CLUSTER_STATUS, VC_LIST,
+                [(j, j) for j in self.jobs if j["jobStatus"] != "finished"])
+        self.assertEqual(["AvaliableJobNum", "gpu_avaliable", "gpu_used", "user_status"],
+                [field for vc_name, field, _, _ in diff_vc_usage(expected, actual) if vc_name == "vc1"])
+
+        del materialized["vc2"]
+        self.assertEqual([("vc2", None, expected["vc2"], None)],
+                diff_vc_usage(expected, materialized))
+
+
+if __name__ == '__main__':
+    unittest.main()
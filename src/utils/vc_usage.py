@@ -0,0 +1,86 @@
+import json
+import collections
+
+import quota
+
+
+def get_alias(user_name):
+    # TODO: job_manager.getAlias should be put in a util file
+    return user_name.split("@")[0].strip()
+
+
+def to_user_status(user_usage):
+    return [{"userName": get_alias(user_name), "userGPU": dict(user_usage[user_name])}
+            for user_name in sorted(user_usage)]
+
+
+def compute_vc_usage(cluster_status, vc_list, jobs):
+    """ vcName -> usage of the vc as shown by GetVC, from cluster status,
+    records of vc table and active (scheduling or running) jobs. jobs are
+    (job, fields), fields are scheduling fields of the job (see
+    job_params.GetJobSchedulingFields) or an entry of job_queue. """
+    vc_info = {}
+    for vc in vc_list:
+        vc_info[vc["vcName"]] = json.loads(vc["quota"])
+
+    vc_usage = collections.defaultdict(lambda :
+            collections.defaultdict(lambda : 0))
+    vc_preemptable_usage = collections.defaultdict(lambda :
+            collections.defaultdict(lambda : 0))
+    # vcName -> userName -> gpuType -> count, of running jobs
+    user_status = collections.defaultdict(lambda :
+            collections.defaultdict(lambda : collections.defaultdict(lambda : 0)))
+    user_status_preemptable = collections.defaultdict(lambda :
+            collections.defaultdict(lambda : collections.defaultdict(lambda : 0)))
+    running_jobs = collections.defaultdict(lambda : 0)
+
+    for job, fields in jobs:
+        vc_name = job["vcName"]
+        running = job["jobStatus"] == "running"
+        if running:
+            running_jobs[vc_name] += 1
+        if fields["gpuType"] is None or fields["totalGpu"] is None:
+            continue
+        if not fields["preemptionAllowed"]:
+            vc_usage[vc_name][fields["gpuType"]] += fields["totalGpu"]
+            if running:
+                user_status[vc_name][job["userName"]][fields["gpuType"]] += fields["totalGpu"]
+        else:
+            vc_preemptable_usage[vc_name][fields["gpuType"]] += fields["totalGpu"]
+            if running:
+                user_status_preemptable[vc_name][job["userName"]][fields["gpuType"]] += fields["totalGpu"]
+
+    vc_total, vc_used, vc_available, vc_unschedulable = quota.calculate_vc_gpu_counts(
+            cluster_status["gpu_capacity"], cluster_status["gpu_avaliable"],
+            cluster_status["gpu_reserved"], vc_info, vc_usage)
+
+    ret = {}
+    for vc_name in vc_info:
+        ret[vc_name] = {
+            "gpu_capacity": dict(vc_total[vc_name]),
+            "gpu_used": dict(vc_used[vc_name]),
+            "gpu_preemptable_used": dict(vc_preemptable_usage[vc_name]),
+            "gpu_unschedulable": dict(vc_unschedulable[vc_name]),
+            "gpu_avaliable": dict(vc_available[vc_name]),
+            "AvaliableJobNum": running_jobs[vc_name],
+            "user_status": to_user_status(user_status[vc_name]),
+            "user_status_preemptable": to_user_status(user_status_preemptable[vc_name]),
+        }
+    return ret
+
+
+def diff_vc_usage(expected, actual):
+    """ [(vcName, field, expected value, actual value)] of fields differing
+    between two results of compute_vc_usage, compared as they are kept in db
+    (json) """
+    expected = json.loads(json.dumps(expected))
+    actual = json.loads(json.dumps(actual))
+    diffs = []
+    for vc_name in sorted(set(expected.keys()) | set(actual.keys())):
+        if vc_name not in actual or vc_name not in expected:
+            diffs.append((vc_name, None, expected.get(vc_name), actual.get(vc_name)))
+            continue
+        for field in sorted(set(expected[vc_name].keys()) | set(actual[vc_name].keys())):
+            if expected[vc_name].get(field) != actual[vc_name].get(field):
+                diffs.append((vc_name, field, expected[vc_name].get(field), actual[vc_name].get(field)))
+    return diffs